@@ -1,6 +1,11 @@
 import logging
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import asdict
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, Iterable, Iterator, Union
 
 from dependency_injector.wiring import Provide, inject
 from event_core.adapters.pubsub import RedisConsumer
@@ -15,8 +20,14 @@ from event_core.domain.types import (
 )
 
 from bootstrap import DIContainer, bootstrap
+from cache import UnitCache
+from config import DEFAULT_LANE, LANES, READY_FILE
+from metrics import METRICS, doc_ext_label, peak_rss_bytes, start_sink
 from processors import extract_elems_and_assets
-from processors.common import Unit, resize_to_thumb
+from processors.common import Unit, UnitMeta, resize_to_thumb
+from profiling import PROFILER
+from workers import DocAbandoned, Lane, LaneScheduler
+from writer import UnitWriteError, UnitWriter, WriteCounts
 
 logger = logging.getLogger(__name__)
 
@@ -35,11 +46,23 @@ def _generate_key(key: Union[str, Path], unit: Unit) -> str:
     )
 
 
+@contextmanager
+def _spool_doc(storage: StorageClient, doc_key: str) -> Iterator[Path]:
+    """Persist a doc to a temp file, so that it is not held
+    in memory while it is being processed"""
+    with tempfile.NamedTemporaryFile(suffix=Path(doc_key).suffix) as f:
+        with METRICS.timer("download"):
+            f.write(storage[doc_key])
+            f.flush()
+        yield Path(f.name)
+
+
 @inject
 def _handle_doc_callback(
     event: DocStored,
     storage: StorageClient = Provide[DIContainer.storage],
     meta: AbstractMetaMapping = Provide[DIContainer.meta],
+    unit_cache: UnitCache = Provide[DIContainer.unit_cache],
 ) -> None:
     """
     Perform the following preprocessing steps:
@@ -48,44 +71,171 @@ def _handle_doc_callback(
     2. Store units
     3. Map out unit metas
     """
+    doc_key = event.key
+    doc_ext = path_to_ext(doc_key)
+    start = time.perf_counter()
+    start_rss = peak_rss_bytes()
+    try:
+        with (
+            doc_ext_label(doc_ext),
+            PROFILER.profile(doc_key, doc_ext) as profile,
+            _spool_doc(storage, doc_key) as doc_path,
+        ):
+            profile.size_bytes = doc_path.stat().st_size
+            _process_doc(doc_key, doc_ext, doc_path, storage, meta, unit_cache)
+    finally:
+        rss = peak_rss_bytes()
+        METRICS.observe(
+            "preprocessor_doc_seconds",
+            time.perf_counter() - start,
+            file_ext=doc_ext,
+        )
+        METRICS.observe(
+            "preprocessor_rss_growth_bytes", rss - start_rss, file_ext=doc_ext
+        )
+        METRICS.set_max("preprocessor_peak_rss_bytes", rss, file_ext=doc_ext)
+        METRICS.dump()
+
+
+def _process_doc(
+    doc_key: str,
+    doc_ext: FileExt,
+    doc_path: Path,
+    storage: StorageClient,
+    meta: AbstractMetaMapping,
+    unit_cache: UnitCache,
+) -> None:
     chunks_by_seq: Dict[int, str] = {}
     thumbs_by_seq: Dict[int, str] = {}
+    units_by_type: Counter[str] = Counter()
+    n_bytes_out = 0
 
-    doc_key = event.key
-    doc_ext = path_to_ext(doc_key)
-    doc_data = storage[doc_key]
+    n_bytes_in = doc_path.stat().st_size
+    METRICS.observe("preprocessor_doc_bytes", n_bytes_in, file_ext=doc_ext)
+    METRICS.inc("preprocessor_bytes_in_total", n_bytes_in, file_ext=doc_ext)
 
-    # map doc key to default thumbnail key if applicable
-    if default_thumb_key := (DEFAULT_THUMBNAILS.get(doc_ext)):
-        meta[Meta.DOC_THUMB][doc_key] = str(default_thumb_key)
+    with METRICS.timer("cache_key"):
+        cache_key = unit_cache.key_for(doc_path, doc_ext)
+    units: Iterable[Unit]
+    if (cached := unit_cache.get(cache_key)) is not None:
+        units = METRICS.timed(cached, "replay")
+        logger.info(f"Replaying cached units for {doc_key}")
+    else:
+        units = unit_cache.record(
+            cache_key,
+            METRICS.timed(
+                extract_elems_and_assets(doc_path, doc_ext), "process"
+            ),
+        )
 
-    try:
-        for unit in extract_elems_and_assets(doc_data, doc_ext):
-            unit_key = _generate_key(doc_key, unit)
-            storage[unit_key] = Payload(data=unit.data, type=unit.type)
-
-            if unit.type == Asset.DOC_THUMBNAIL:
-                meta[Meta.DOC_THUMB][doc_key] = unit_key
-            elif unit.type == Asset.ELEM_THUMBNAIL:
-                thumbs_by_seq[unit.seq] = unit_key
-            elif isinstance(unit.type, Element):
-                meta[Meta.PARENT][unit_key] = doc_key
-                chunks_by_seq[unit.seq] = unit_key
-            else:
-                logger.warning(f"Unrecognized unit type: {unit.type}")
-
-            # add meta
-            if unit.meta:
-                for meta_key, meta_val in unit.meta.items():
-                    meta[meta_key][unit_key] = meta_val
-
-    except Exception as e:
-        logger.warning(f"Failed to process {doc_key}. Error: {e}")
-
-    # map chunks to chunk thumbnails
-    for thumb_seq, thumb_key in thumbs_by_seq.items():
-        chunk_key = chunks_by_seq[thumb_seq]
-        meta[Meta.CHUNK_THUMB][chunk_key] = thumb_key
+    complete = True
+    with UnitWriter(storage, meta, doc_key=doc_key) as writer:
+        # map doc key to default thumbnail key if applicable
+        if default_thumb_key := (DEFAULT_THUMBNAILS.get(doc_ext)):
+            writer.set_meta(Meta.DOC_THUMB, doc_key, str(default_thumb_key))
+
+        try:
+            for unit in units:
+                units_by_type[unit.type] += 1
+                n_bytes_out += len(unit.data)
+                unit_key = _generate_key(doc_key, unit)
+                writer.store(unit_key, Payload(data=unit.data, type=unit.type))
+
+                if unit.type == Asset.DOC_THUMBNAIL:
+                    writer.set_meta(Meta.DOC_THUMB, doc_key, unit_key)
+                    # show the doc before its first chunks are ready
+                    writer.flush()
+                elif unit.type == Asset.ELEM_THUMBNAIL:
+                    thumbs_by_seq[unit.seq] = unit_key
+                elif isinstance(unit.type, Element):
+                    writer.set_meta(Meta.PARENT, unit_key, doc_key)
+                    chunks_by_seq[unit.seq] = unit_key
+                else:
+                    logger.warning(f"Unrecognized unit type: {unit.type}")
+
+                # add meta
+                if unit.meta:
+                    for meta_key, meta_val in unit.meta.items():
+                        writer.set_meta(meta_key, unit_key, meta_val)
+
+                # map chunk to chunk thumbnail, once both are stored
+                if (chunk_key := chunks_by_seq.get(unit.seq)) and (
+                    thumb_key := thumbs_by_seq.pop(unit.seq, None)
+                ):
+                    writer.set_meta(Meta.CHUNK_THUMB, chunk_key, thumb_key)
+
+        except MemoryError:
+            raise  # for the worker to be replaced
+        except Exception as e:
+            complete = False
+            logger.warning(f"Failed to process {doc_key}. Error: {e}")
+            writer.set_meta(UnitMeta.FAILURE, doc_key, repr(e))
+
+        for thumb_key in thumbs_by_seq.values():
+            logger.warning(f"No chunk for thumbnail {thumb_key}")
+
+        try:
+            # units of a doc that failed midway may be missing,
+            # so only a complete doc replaces its last units
+            writer.commit(prune=complete)
+        except UnitWriteError as e:
+            complete = False
+            logger.warning(f"Failed to store {doc_key}. Error: {e}")
+
+        counts = writer.counts
+        _record_doc(doc_ext, complete, units_by_type, n_bytes_out, counts)
+        logger.info(
+            f"Stored {doc_key}: {counts.written} written,"
+            f" {counts.skipped} unchanged, {counts.deleted} deleted,"
+            f" {counts.failed} failed"
+        )
+
+
+def _record_doc(
+    doc_ext: FileExt,
+    complete: bool,
+    units_by_type: Counter[str],
+    n_bytes_out: int,
+    counts: WriteCounts,
+) -> None:
+    status = "complete" if complete else "incomplete"
+    METRICS.inc("preprocessor_docs_total", file_ext=doc_ext, status=status)
+    METRICS.inc("preprocessor_bytes_out_total", n_bytes_out, file_ext=doc_ext)
+    for unit_type, n_units in units_by_type.items():
+        METRICS.inc(
+            "preprocessor_units_total",
+            n_units,
+            file_ext=doc_ext,
+            type=unit_type,
+        )
+    for result, n_writes in asdict(counts).items():
+        METRICS.inc(
+            "preprocessor_writes_total",
+            n_writes,
+            file_ext=doc_ext,
+            result=result,
+        )
+
+
+@inject
+def _mark_doc_failed(
+    event: DocStored,
+    error: DocAbandoned,
+    storage: StorageClient = Provide[DIContainer.storage],
+    meta: AbstractMetaMapping = Provide[DIContainer.meta],
+) -> None:
+    """Record why a doc failed, when its worker was killed
+    before it could. Like a failure recorded by the worker,
+    it is deleted once the doc is processed fully."""
+    with UnitWriter(storage, meta, doc_key=event.key) as writer:
+        writer.set_meta(UnitMeta.FAILURE, event.key, repr(error))
+        writer.commit(prune=False)
+    METRICS.inc(
+        "preprocessor_docs_total",
+        file_ext=path_to_ext(event.key),
+        status=type(error).__name__,
+    )
+    METRICS.dump()
 
 
 @inject
@@ -101,11 +251,28 @@ def _insert_default_thumbnails(
 
 
 def main():
+    READY_FILE.unlink(missing_ok=True)  # left over by a killed run
     _insert_default_thumbnails()
-    logger.info("Listening to event broker")
-    with RedisConsumer() as consumer:
-        consumer.subscribe(DocStored)
-        consumer.listen(_handle_doc_callback)
+    lanes = {name: Lane(**lane) for name, lane in LANES.items()}
+    scheduler = LaneScheduler(
+        _handle_doc_callback, lanes, DEFAULT_LANE, _mark_doc_failed
+    )
+    scheduler.install_signal_handlers()
+    logger.info(f"Listening to event broker with lanes {list(lanes)}")
+    metrics_sink = start_sink()
+    with scheduler:
+        try:
+            with RedisConsumer() as consumer:
+                consumer.subscribe(DocStored)
+                scheduler.wait_ready()  # workers warmed up
+                READY_FILE.touch()
+                consumer.listen(scheduler.submit)
+        except KeyboardInterrupt:
+            logger.info("Stopped listening, waiting for in-flight docs")
+        finally:
+            READY_FILE.unlink(missing_ok=True)
+    if metrics_sink is not None:
+        metrics_sink.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,296 @@
+"""Reprocess docs that are already stored, e.g. after a change
+of chunk or thumbnail settings.
+
+Doc keys are read from a manifest file, one key per line, or
+listed from the storage service under a prefix, page by page,
+as docs are submitted. Docs go through the same callback and
+lanes as `DocStored` events received by the service. Progress
+is checkpointed, so an interrupted backfill resumes where it
+left off when run again with the same checkpoint.
+
+    python backfill.py --manifest keys.txt --checkpoint backfill.json
+    python backfill.py --prefix user/ --checkpoint backfill.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
+from urllib.parse import urljoin
+
+import requests
+from event_core.domain.events import DocStored
+from event_core.domain.types import path_to_ext
+
+from app import (
+    _handle_doc_callback,
+    _insert_default_thumbnails,
+    _mark_doc_failed,
+)
+from bootstrap import bootstrap
+from config import (
+    BACKFILL_CHECKPOINT_SECONDS,
+    BACKFILL_IN_FLIGHT_PER_WORKER,
+    BACKFILL_LIST_PAGE_SIZE,
+    BACKFILL_LIST_TIMEOUT_SECONDS,
+    BACKFILL_PROGRESS_SECONDS,
+    DEFAULT_LANE,
+    LANES,
+)
+from processors import PROCESSOR_PATHS
+from workers import Lane, LaneScheduler
+
+logger = logging.getLogger(__name__)
+
+# units are stored as {doc parent}/{doc stem}/{seq}__{type}{ext}
+_UNIT_NAME = re.compile(r"\d+__\w+\.\w+")
+
+
+def _is_doc_key(key: str) -> bool:
+    if _UNIT_NAME.fullmatch(Path(key).name):
+        return False
+    try:
+        return path_to_ext(key) in PROCESSOR_PATHS
+    except Exception:
+        return False
+
+
+def read_manifest(path: Path) -> List[str]:
+    """Keys of a manifest, sorted so that it can be resumed
+    from a checkpoint"""
+    with open(path) as f:
+        return sorted({key for line in f if (key := line.strip())})
+
+
+# a page of the keys stored under a prefix, after a key if given,
+# in order, of at most a number of keys
+ListPage = Callable[[str, Optional[str], int], List[str]]
+
+
+def list_keys_page(
+    prefix: str, start_after: Optional[str], limit: int
+) -> List[str]:
+    """A page of the keys stored under `prefix`, listed by the
+    storage service"""
+    params: Dict[str, object] = {"prefix": prefix, "limit": limit}
+    if start_after is not None:
+        params["start_after"] = start_after
+    response = requests.get(
+        urljoin(os.environ["STORAGE_SERVICE_API_URL"], "keys"),
+        params=params,
+        timeout=BACKFILL_LIST_TIMEOUT_SECONDS,
+    )
+    response.raise_for_status()
+    return response.json()["keys"]
+
+
+def list_doc_keys(
+    prefix: str,
+    start_after: Optional[str] = None,
+    list_page: ListPage = list_keys_page,
+) -> Iterator[str]:
+    """Keys of the docs stored under `prefix`, after
+    `start_after` if given, leaving out the units generated
+    from them. Keys are listed in order, so that a listing can
+    be resumed from a checkpoint, `BACKFILL_LIST_PAGE_SIZE` at
+    a time, as they are consumed"""
+    while True:
+        page = list_page(prefix, start_after, BACKFILL_LIST_PAGE_SIZE)
+        yield from (key for key in page if _is_doc_key(key))
+        if len(page) < BACKFILL_LIST_PAGE_SIZE:
+            return
+        start_after = page[-1]
+
+
+class Checkpoint:
+    """The last key of a sorted listing up to which every doc
+    has been processed.
+
+    Docs complete out of order, so docs processed past the
+    first unprocessed one only count once every doc before
+    them is. A resumed backfill may process those again, at
+    most as many as were in flight. Keys listed anew before
+    the checkpoint, like docs stored since, are skipped.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.Lock()
+        self.last_key: Optional[str] = None
+        if path.exists():
+            self.last_key = json.loads(path.read_text())["last_key"]
+        # keys of the docs submitted, by their order of submission,
+        # until every doc before them is processed
+        self._keys: Dict[int, str] = {}
+        self._done_after: Set[int] = set()
+        self._n_done = 0
+
+    def is_done(self, key: str) -> bool:
+        return self.last_key is not None and key <= self.last_key
+
+    def submitted(self, i: int, key: str) -> None:
+        with self._lock:
+            self._keys[i] = key
+
+    def mark_done(self, i: int) -> None:
+        with self._lock:
+            self._done_after.add(i)
+            while self._n_done in self._done_after:
+                self._done_after.remove(self._n_done)
+                self.last_key = self._keys.pop(self._n_done)
+                self._n_done += 1
+
+    def save(self) -> None:
+        with self._lock:
+            if self.last_key is None:
+                return
+            state = {"last_key": self.last_key}
+        tmp_path = self._path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self._path)
+
+
+class RateLimiter:
+    """Spaces out calls to `wait()` to at most `rate` per second"""
+
+    def __init__(self, rate: Optional[float]):
+        self._interval = 1 / rate if rate else 0.0
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        if not self._interval:
+            return
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self._interval
+
+
+class _Progress:
+    def __init__(self, n_todo: Optional[int]):
+        self._n_todo = n_todo  # unknown while keys are being listed
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._n_done = 0
+
+    def done(self) -> None:
+        with self._lock:
+            self._n_done += 1
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self._start
+        rate = self._n_done / elapsed if elapsed else 0.0
+        if self._n_todo is None:
+            logger.info(f"Backfilled {self._n_done} docs, {rate:.1f} docs/s")
+            return
+        eta = (self._n_todo - self._n_done) / rate if rate else float("inf")
+        logger.info(
+            f"Backfilled {self._n_done}/{self._n_todo} docs,"
+            f" {rate:.1f} docs/s, ETA {eta:.0f}s"
+        )
+
+
+def backfill(
+    keys: Iterable[str],
+    submit: Callable[[DocStored], Future],
+    checkpoint: Checkpoint,
+    rate: Optional[float] = None,
+    max_in_flight: int = 1,
+) -> None:
+    """Submit a `DocStored` event per key, in sorted order, not
+    yet checkpointed, with at most `max_in_flight` docs in
+    flight. Keys are consumed as docs are submitted, so they
+    can be listed as the backfill goes"""
+    n_todo = None
+    if isinstance(keys, list):
+        n_todo = sum(1 for key in keys if not checkpoint.is_done(key))
+        logger.info(f"Backfilling {n_todo} of {len(keys)} docs")
+    else:
+        logger.info(f"Backfilling docs after {checkpoint.last_key}")
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    limiter = RateLimiter(rate)
+    progress = _Progress(n_todo)
+    last_saved = last_reported = time.monotonic()
+
+    def on_done(i: int) -> None:
+        checkpoint.mark_done(i)
+        progress.done()
+        in_flight.release()
+
+    todo = (key for key in keys if not checkpoint.is_done(key))
+    try:
+        for i, key in enumerate(todo):
+            in_flight.acquire()
+            limiter.wait()
+            checkpoint.submitted(i, key)
+            future = submit(DocStored(key=key))
+            future.add_done_callback(lambda _, i=i: on_done(i))
+
+            now = time.monotonic()
+            if now - last_saved >= BACKFILL_CHECKPOINT_SECONDS:
+                checkpoint.save()
+                last_saved = now
+            if now - last_reported >= BACKFILL_PROGRESS_SECONDS:
+                progress.report()
+                last_reported = now
+
+        # wait for the docs in flight
+        for _ in range(max_in_flight):
+            in_flight.acquire()
+    finally:
+        checkpoint.save()
+        progress.report()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", type=Path, help="file of doc keys")
+    source.add_argument("--prefix", help="list doc keys from storage")
+    parser.add_argument("--checkpoint", type=Path, required=True)
+    parser.add_argument(
+        "--rate", type=float, default=None, help="max docs per second"
+    )
+    args = parser.parse_args(argv)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    keys: Iterable[str]
+    if args.manifest:
+        keys = read_manifest(args.manifest)
+    else:
+        keys = list_doc_keys(args.prefix, start_after=checkpoint.last_key)
+
+    _insert_default_thumbnails()
+    lanes = {name: Lane(**lane) for name, lane in LANES.items()}
+    scheduler = LaneScheduler(
+        _handle_doc_callback, lanes, DEFAULT_LANE, _mark_doc_failed
+    )
+    scheduler.install_signal_handlers()
+    n_workers = sum(lane.n_workers for lane in lanes.values())
+    with scheduler:
+        try:
+            backfill(
+                keys,
+                scheduler.submit,
+                checkpoint,
+                args.rate,
+                max_in_flight=n_workers * BACKFILL_IN_FLIGHT_PER_WORKER,
+            )
+        except KeyboardInterrupt:
+            logger.info("Stopped backfilling, waiting for in-flight docs")
+    checkpoint.save()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    bootstrap()
+    main()
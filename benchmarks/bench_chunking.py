@@ -0,0 +1,172 @@
+"""Benchmark the throughput of text and code chunking.
+
+Each corpus is chunked by langchain's `RecursiveCharacterTextSplitter`,
+as processors used to, and by `StreamingTextSplitter`, with the same
+settings. Both must produce the same chunks. Text corpora are also
+turned into the texts of units by `chunk_text`, and as `TextProcessor`
+used to, by accumulating langchain chunks into strings.
+
+Both start from UTF-8 bytes and end with UTF-8 chunks, so langchain is
+timed with decoding the doc and encoding its chunks, as processors did.
+
+    python -m benchmarks.bench_chunking [--size-mb MB ...]
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from config import CODE_CHUNK_SIZE, TEXT_CHUNK_MIN_SIZE, TEXT_CHUNK_SIZE
+from processors.chunking import StreamingTextSplitter, check_utf8
+from processors.code import CODE_SPLITTER
+from processors.text import TEXT_SPLITTER, chunk_text
+
+SIZES_MB = (1, 16)
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "elit"]
+# non-ASCII chars are counted differently from ASCII ones
+UTF8_WORDS = [*WORDS, "élan", "naïve", "字", "“quoted”"]
+CODE_LINES = [
+    "def f(x):",
+    "    return x + 1",
+    "class A:",
+    "    value = [i for i in range(10)]",
+    "",
+]
+
+
+def _text_corpus(
+    size: int, rng: random.Random, words: List[str] = WORDS
+) -> str:
+    parts: List[str] = []
+    n = 0
+    while n < size:
+        sentence = " ".join(rng.choices(words, k=rng.randint(4, 20)))
+        part = sentence + rng.choice([". ", ", ", "\n", "\n\n"])
+        parts.append(part)
+        n += len(part)
+    return "".join(parts)
+
+
+def _code_corpus(size: int, rng: random.Random) -> str:
+    parts: List[str] = []
+    n = 0
+    while n < size:
+        line = rng.choice(CODE_LINES) + "\n"
+        parts.append(line)
+        n += len(line)
+    return "".join(parts)
+
+
+CORPORA: Dict[str, Callable[[int, random.Random], str]] = {
+    "text": _text_corpus,
+    "text_utf8": lambda size, rng: _text_corpus(size, rng, UTF8_WORDS),
+    "code": _code_corpus,
+}
+
+LANGCHAIN_TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=TEXT_CHUNK_SIZE - TEXT_CHUNK_MIN_SIZE,
+    chunk_overlap=0,
+    separators=["\n\n", "\n", ". ", ",", " ", ""],
+    keep_separator="end",
+    strip_whitespace=False,
+)
+
+LANGCHAIN_SPLITTERS = {
+    "text": LANGCHAIN_TEXT_SPLITTER,
+    "text_utf8": LANGCHAIN_TEXT_SPLITTER,
+    "code": RecursiveCharacterTextSplitter(
+        chunk_size=CODE_CHUNK_SIZE,
+        chunk_overlap=0,
+        separators=["\n\n", "\n"],
+        strip_whitespace=False,
+    ),
+}
+
+SPLITTERS: Dict[str, StreamingTextSplitter] = {
+    "text": TEXT_SPLITTER,
+    "text_utf8": TEXT_SPLITTER,
+    "code": CODE_SPLITTER,
+}
+
+
+def _langchain_text_units(data: bytes) -> List[bytes]:
+    units = []
+    accumulated = ""
+    for doc in LANGCHAIN_TEXT_SPLITTER.split_text(data.decode("utf-8")):
+        accumulated += doc
+        if len(accumulated) >= TEXT_CHUNK_MIN_SIZE:
+            units.append(accumulated.encode("utf-8").strip())
+            accumulated = ""
+    if accumulated := accumulated.strip():
+        units.append(accumulated.encode("utf-8"))
+    return units
+
+
+def _bench_text_units(data: bytes) -> Dict:
+    start = time.perf_counter()
+    expected = _langchain_text_units(data)
+    langchain_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    units = list(chunk_text(data, check_utf8(data)))
+    seconds = time.perf_counter() - start
+
+    mb = len(data) / 1024 / 1024
+    return {
+        "units_equivalent": units == expected,
+        "units_langchain_mb_per_s": round(mb / langchain_seconds, 3),
+        "units_mb_per_s": round(mb / seconds, 3),
+        "units_speedup": round(langchain_seconds / seconds, 3),
+    }
+
+
+def bench(kind: str, size_mb: int, seed: int = 0) -> Dict:
+    text = CORPORA[kind](size_mb * 1024 * 1024, random.Random(seed))
+    data = text.encode("utf-8")
+
+    start = time.perf_counter()
+    splitter = LANGCHAIN_SPLITTERS[kind]
+    expected = [
+        chunk.encode("utf-8")
+        for chunk in splitter.split_text(data.decode("utf-8"))
+    ]
+    langchain_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    is_ascii = check_utf8(data)
+    chunks = list(SPLITTERS[kind].split(data, is_ascii))
+    seconds = time.perf_counter() - start
+
+    mb = len(data) / 1024 / 1024
+    result = {
+        "corpus": kind,
+        "size_mb": round(mb, 3),
+        "n_chunks": len(chunks),
+        "equivalent": chunks == expected,
+        "langchain_mb_per_s": round(mb / langchain_seconds, 3),
+        "mb_per_s": round(mb / seconds, 3),
+        "speedup": round(langchain_seconds / seconds, 3),
+    }
+    if SPLITTERS[kind] is TEXT_SPLITTER:
+        result.update(_bench_text_units(data))
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size-mb", nargs="*", type=int, default=list(SIZES_MB)
+    )
+    args = parser.parse_args(argv)
+
+    for kind in CORPORA:
+        for size_mb in args.size_mb:
+            print(json.dumps(bench(kind, size_mb)))
+
+
+if __name__ == "__main__":
+    main()
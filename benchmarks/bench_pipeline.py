@@ -0,0 +1,400 @@
+"""Benchmark every processor, and `_handle_doc_callback` end to
+end, on a corpus of docs of fixed sizes per file type.
+
+The corpus is generated from a seed (small, medium and large
+text, markdown and code, images, multi-page PDFs and multi-scene
+videos), or loaded from a directory of docs. Each case runs in a
+freshly forked process, so its peak RSS is its own: the doc is
+processed once to load the processor, then timed over a number
+of repeats. The callback runs against fake storage and meta,
+with the unit cache bypassed.
+
+Results are printed as JSON lines, and saved with `--output`.
+Given a `--baseline` (the output of an earlier run), cases whose
+latency or memory regressed by more than `--threshold` are
+reported, and the benchmark exits with status 1.
+
+    python -m benchmarks.bench_pipeline --output bench.json
+    python -m benchmarks.bench_pipeline --baseline bench.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import psutil
+from event_core.adapters.services.meta import FakeMetaMapping, Meta
+from event_core.adapters.services.storage import FakeStorageClient, Payload
+from event_core.domain.events import DocStored
+from event_core.domain.types import Asset, FileExt, path_to_ext
+from PIL import Image, ImageDraw
+
+from app import _handle_doc_callback
+from benchmarks.bench_chunking import _code_corpus, _text_corpus
+from bootstrap import DIContainer
+from cache import UnitCache
+from config import PROCESSOR_VERSION, WARM_UP_FILE_EXTS
+from metrics import METRICS, peak_rss_bytes
+from processors import PROCESSOR_PATHS, PROCESSORS_BY_EXT
+
+SIZES = ("small", "medium", "large")
+TEXT_BYTES = {"small": 16 * 1024, "medium": 1024**2, "large": 16 * 1024**2}
+IMAGE_SIDES = {"small": 256, "medium": 1024, "large": 4096}
+PDF_PAGES = {"small": 1, "medium": 8, "large": 32}
+# scenes, and seconds per scene
+VIDEO_SCENES = {"small": (2, 2), "medium": (8, 4), "large": (24, 5)}
+
+DEFAULT_CORPUS_DIR = Path(tempfile.gettempdir()) / "preprocessor-bench"
+TARGETS = ("processor", "callback")
+
+# regressions smaller than these are noise
+MIN_SECONDS_DELTA = 0.005
+MIN_MB_DELTA = 16.0
+
+MB = 1024 * 1024
+
+
+def _markdown_corpus(size: int, rng: random.Random) -> str:
+    parts: List[str] = []
+    n = 0
+    while n < size:
+        level = rng.randint(1, 3)
+        part = "#" * level + " " + _text_corpus(20, rng).strip() + "\n\n"
+        part += _text_corpus(rng.randint(200, 2000), rng) + "\n\n"
+        if rng.random() < 0.5:
+            part += "".join(
+                f"- {_text_corpus(40, rng).strip()}\n"
+                for _ in range(rng.randint(2, 6))
+            )
+            part += "\n"
+        if rng.random() < 0.5:
+            code = _code_corpus(rng.randint(100, 1500), rng)
+            part += f"```python\n{code}```\n\n"
+        parts.append(part)
+        n += len(part)
+    return "".join(parts)
+
+
+def _image(side: int, rng: random.Random) -> Image.Image:
+    image = Image.new("RGB", (side, side), "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(64):
+        x0, x1 = sorted(rng.randrange(side) for _ in range(2))
+        y0, y1 = sorted(rng.randrange(side) for _ in range(2))
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        shape = rng.choice([draw.rectangle, draw.ellipse])
+        shape((x0, y0, x1, y1), fill=fill)
+    return image
+
+
+def _encode(image: Image.Image, fmt: str) -> bytes:
+    with tempfile.SpooledTemporaryFile() as f:
+        image.save(f, format=fmt)
+        f.seek(0)
+        return f.read()
+
+
+def _pdf(n_pages: int, rng: random.Random) -> bytes:
+    """Pages of text, with a figure on every 4th page, so that
+    both partitioning strategies are exercised"""
+    import fitz
+
+    with fitz.open() as pdf:
+        for i in range(n_pages):
+            page = pdf.new_page()
+            text = _text_corpus(2500, rng)
+            page.insert_textbox(fitz.Rect(72, 72, 540, 720), text)
+            if i % 4 == 3:
+                figure = _encode(_image(512, rng), "PNG")
+                page.insert_image(fitz.Rect(72, 420, 540, 720), stream=figure)
+        return pdf.tobytes()
+
+
+def _video(n_scenes: int, scene_seconds: int, rng: random.Random) -> bytes:
+    """Scenes of a moving square on a background of their own
+    colour, so that each cut is detected"""
+    import cv2
+    import numpy as np
+
+    width, height, fps = 320, 240, 24
+    with tempfile.NamedTemporaryFile(suffix=FileExt.MP4) as f:
+        writer = cv2.VideoWriter(
+            f.name, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height)
+        )
+        for _ in range(n_scenes):
+            background = [rng.randrange(256) for _ in range(3)]
+            for i in range(scene_seconds * fps):
+                frame = np.full((height, width, 3), background, np.uint8)
+                x = i * 4 % (width - 40)
+                frame[100:140, x : x + 40] = 255 - frame[100:140, x : x + 40]
+                writer.write(frame)
+        writer.release()
+        return Path(f.name).read_bytes()
+
+
+def _generate(file_ext: FileExt, size: str, rng: random.Random) -> bytes:
+    if file_ext == FileExt.TXT:
+        return _text_corpus(TEXT_BYTES[size], rng).encode("utf-8")
+    if file_ext == FileExt.MD:
+        return _markdown_corpus(TEXT_BYTES[size], rng).encode("utf-8")
+    if file_ext == FileExt.PY:
+        return _code_corpus(TEXT_BYTES[size], rng).encode("utf-8")
+    if file_ext in (FileExt.JPG, FileExt.JPEG):
+        return _encode(_image(IMAGE_SIDES[size], rng), "JPEG")
+    if file_ext == FileExt.PNG:
+        return _encode(_image(IMAGE_SIDES[size], rng), "PNG")
+    if file_ext == FileExt.PDF:
+        return _pdf(PDF_PAGES[size], rng)
+    if file_ext == FileExt.MP4:
+        return _video(*VIDEO_SCENES[size], rng)
+    raise ValueError(f"No corpus for {file_ext}")
+
+
+def generate_corpus(
+    corpus_dir: Path, file_exts: List[FileExt], sizes: List[str], seed: int
+) -> List[Path]:
+    """Docs named {size}{ext}, generated unless already in
+    `corpus_dir` from an earlier run with the same seed"""
+    corpus_dir = corpus_dir / f"seed-{seed}"
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for file_ext in file_exts:
+        for size in sizes:
+            path = corpus_dir / f"{size}{file_ext}"
+            if not path.exists():
+                rng = random.Random(f"{seed}-{file_ext}-{size}")
+                path.write_bytes(_generate(file_ext, size, rng))
+            paths.append(path)
+    return paths
+
+
+def load_corpus(corpus_dir: Path, file_exts: List[FileExt]) -> List[Path]:
+    paths = []
+    for path in sorted(corpus_dir.iterdir()):
+        try:
+            if path_to_ext(path) in file_exts:
+                paths.append(path)
+        except ValueError:
+            continue
+    return paths
+
+
+def _processor_run(path: Path, file_ext: FileExt) -> Callable[[], int]:
+    def run() -> int:
+        with PROCESSORS_BY_EXT[file_ext](path) as processor:
+            return sum(1 for _ in processor())
+
+    return run
+
+
+def _callback_run(path: Path, file_ext: FileExt) -> Callable[[], int]:
+    """A doc stored anew, so that none of its units are skipped
+    as unchanged"""
+    storage = FakeStorageClient()
+    meta = FakeMetaMapping()
+    container = DIContainer()
+    container.storage.override(storage)
+    container.meta.override(meta)
+    container.unit_cache.override(
+        UnitCache(DEFAULT_CORPUS_DIR / "unit-cache", max_entry_bytes=0)
+    )
+    container.wire(modules=["app"])
+
+    doc_key = f"bench/{path.name}"
+    storage[doc_key] = Payload(data=path.read_bytes(), type=Asset.DOC)
+
+    def run() -> int:
+        _handle_doc_callback(DocStored(key=doc_key))
+        return len(meta[Meta.PARENT])
+
+    return run
+
+
+RUNS: Dict[str, Callable[[Path, FileExt], Callable[[], int]]] = {
+    "processor": _processor_run,
+    "callback": _callback_run,
+}
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    """Linearly interpolated, as numpy's default"""
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (
+        pos - lo
+    )
+
+
+def _bench_case(target: str, path: Path, repeats: int) -> Dict:
+    file_ext = path_to_ext(path)
+    start_rss = psutil.Process().memory_info().rss
+    RUNS[target](path, file_ext)()  # load the processor
+
+    latencies = []
+    n_units = 0
+    for _ in range(repeats):
+        run = RUNS[target](path, file_ext)
+        start = time.perf_counter()
+        n_units = run()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    size = path.stat().st_size
+    p50 = _percentile(latencies, 0.5)
+    peak_rss = peak_rss_bytes()
+    return {
+        "case": f"{target}:{path.name}",
+        "target": target,
+        "doc": path.name,
+        "file_ext": str(file_ext),
+        "size_bytes": size,
+        # for the callback, the elements stored
+        "n_units": n_units,
+        "repeats": repeats,
+        "latency_p50_s": round(p50, 6),
+        "latency_p90_s": round(_percentile(latencies, 0.9), 6),
+        "latency_max_s": round(latencies[-1], 6),
+        "docs_per_s": round(1 / p50, 3) if p50 else None,
+        "mb_per_s": round(size / MB / p50, 3) if p50 else None,
+        "peak_rss_mb": round(peak_rss / MB, 1),
+        "rss_growth_mb": round((peak_rss - start_rss) / MB, 1),
+    }
+
+
+def _run_isolated(target: str, path: Path, repeats: int) -> Dict:
+    # one process per case, warmed up as a lane worker is
+    warm_up = [ext for ext in WARM_UP_FILE_EXTS if ext == path_to_ext(path)]
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=PROCESSORS_BY_EXT.warm_up,
+        initargs=(warm_up,),
+    ) as pool:
+        return pool.submit(_bench_case, target, path, repeats).result()
+
+
+# metric: noise floor of a regression
+_COMPARED = {
+    "latency_p50_s": MIN_SECONDS_DELTA,
+    "latency_p90_s": MIN_SECONDS_DELTA,
+    "rss_growth_mb": MIN_MB_DELTA,
+}
+
+
+def compare(
+    results: List[Dict], baseline: Dict, threshold: float
+) -> List[Dict]:
+    """Cases of `results` that are worse than in `baseline` by
+    more than `threshold` (relative) and the noise floor"""
+    baseline_cases = {r["case"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        if (before := baseline_cases.get(result["case"])) is None:
+            continue
+        for metric, min_delta in _COMPARED.items():
+            old, new = before[metric], result[metric]
+            if new - old > max(old * threshold, min_delta):
+                regressions.append(
+                    {
+                        "case": result["case"],
+                        "metric": metric,
+                        "baseline": old,
+                        "value": new,
+                        "change": round(new / old - 1, 3) if old else None,
+                    }
+                )
+    return regressions
+
+
+def _environment(args: argparse.Namespace) -> Dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "n_cpus": os.cpu_count(),
+        "processor_version": PROCESSOR_VERSION,
+        "seed": args.seed,
+        "repeats": args.repeats,
+    }
+
+
+def _cases(
+    paths: List[Path], targets: List[str]
+) -> Iterator[Tuple[str, Path]]:
+    for path in paths:
+        for target in targets:
+            yield target, path
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--file-exts",
+        nargs="*",
+        default=[ext.strip(".") for ext in PROCESSOR_PATHS],
+        help="e.g., txt pdf",
+    )
+    parser.add_argument("--sizes", nargs="*", default=list(SIZES))
+    parser.add_argument("--targets", nargs="*", default=list(TARGETS))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--corpus", type=Path, help="benchmark the docs of a directory"
+    )
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    file_exts = [FileExt(f".{ext.lstrip('.')}") for ext in args.file_exts]
+    if args.corpus:
+        paths = load_corpus(args.corpus, file_exts)
+    else:
+        paths = generate_corpus(
+            DEFAULT_CORPUS_DIR, file_exts, args.sizes, args.seed
+        )
+
+    # metrics would be dumped where the service's sink picks them up
+    METRICS.enabled = False
+
+    results = []
+    for target, path in _cases(paths, args.targets):
+        result = _run_isolated(target, path, args.repeats)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output:
+        report = {"environment": _environment(args), "results": results}
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline["environment"] != _environment(args):
+            print(
+                "Baseline was run in another environment:"
+                f" {json.dumps(baseline['environment'])}",
+                file=sys.stderr,
+            )
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(json.dumps({"regression": regression}), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
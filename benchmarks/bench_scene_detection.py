@@ -0,0 +1,88 @@
+"""Benchmark the accuracy/speed trade-off of scene detection settings.
+
+Every setting is compared against a reference run that analyses
+every frame at full resolution. A reference boundary is matched if
+the setting found a boundary within the tolerance of it.
+
+    python -m benchmarks.bench_scene_detection [VIDEO ...]
+"""
+
+import argparse
+import itertools
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import VIDEO_SCENE_TOLERANCE_SECONDS
+from processors.video import detect_scenes
+
+DEFAULT_VIDEOS = sorted(Path("tests/data").glob("*.mp4"))
+DOWNSCALES = (1, 2, 4, 8, None)
+FRAME_SKIPS = (0, 1, 2, 4)
+
+
+def _boundaries(video: Path, **settings) -> List[float]:
+    scenes = detect_scenes(str(video), max_scenes=None, **settings)
+    return [start.get_seconds() for start, _ in scenes[1:]]
+
+
+def _recall(
+    reference: List[float], found: List[float], tolerance: float
+) -> float:
+    if not reference:
+        return 1.0
+    matched = sum(
+        any(abs(ref - t) <= tolerance for t in found) for ref in reference
+    )
+    return matched / len(reference)
+
+
+def bench(video: Path, tolerance: float) -> List[Dict]:
+    no_tolerance = float("inf")  # don't let detect_scenes cap frame skip
+    reference = _boundaries(
+        video, downscale=1, frame_skip=0, tolerance=no_tolerance
+    )
+
+    results = []
+    for downscale, frame_skip in itertools.product(DOWNSCALES, FRAME_SKIPS):
+        start = time.perf_counter()
+        found = _boundaries(
+            video,
+            downscale=downscale,
+            frame_skip=frame_skip,
+            tolerance=no_tolerance,
+        )
+        elapsed = time.perf_counter() - start
+        recall = _recall(reference, found, tolerance)
+        results.append(
+            {
+                "video": str(video),
+                "downscale": downscale or "auto",
+                "frame_skip": frame_skip,
+                "seconds": round(elapsed, 3),
+                "n_boundaries": len(found),
+                "n_reference_boundaries": len(reference),
+                "recall": round(recall, 3),
+                "within_tolerance": recall == 1.0
+                and len(found) == len(reference),
+            }
+        )
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("videos", nargs="*", type=Path, default=DEFAULT_VIDEOS)
+    parser.add_argument(
+        "--tolerance", type=float, default=VIDEO_SCENE_TOLERANCE_SECONDS
+    )
+    args = parser.parse_args(argv)
+
+    for video in args.videos:
+        for result in bench(video, args.tolerance):
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark worker startup time and memory per served file types.
+
+Each configuration runs in a fresh interpreter, which imports the
+worker entrypoint, then initializes as a lane worker serving the
+file types does (warming up those of `WARM_UP_FILE_EXTS`) and loads
+their processors, as a worker does before processing its first doc.
+
+    python -m benchmarks.bench_startup
+"""
+
+import json
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+CONFIGS: Dict[str, List[str]] = {
+    "text": ["TXT", "MD", "PY"],
+    "image": ["JPEG", "JPG", "PNG"],
+    "light": ["TXT", "MD", "PY", "JPEG", "JPG", "PNG"],
+    "video": ["MP4"],
+    "pdf": ["PDF"],
+    "heavy": ["MP4", "PDF"],
+    "all": ["TXT", "MD", "PY", "JPEG", "JPG", "PNG", "MP4", "PDF"],
+}
+
+WORKER = """
+import json, logging, resource, sys, time
+start = time.perf_counter()
+from event_core.domain.types import FileExt
+import app
+from config import WARM_UP_FILE_EXTS
+from processors import PROCESSORS_BY_EXT
+from workers import _init_worker_process
+file_exts = [FileExt[name] for name in sys.argv[1:]]
+_init_worker_process(
+    file_exts,
+    [ext for ext in WARM_UP_FILE_EXTS if ext in file_exts],
+    logging.WARNING,
+)
+for file_ext in file_exts:
+    PROCESSORS_BY_EXT[file_ext]
+print(json.dumps({
+    "import_seconds": time.perf_counter() - start,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "n_modules": len(sys.modules),
+}))
+"""
+
+
+def bench(file_ext_names: List[str]) -> Dict:
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", WORKER, *file_ext_names],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["startup_seconds"] = time.perf_counter() - start
+    return result
+
+
+def main() -> None:
+    for name, file_ext_names in CONFIGS.items():
+        result = bench(file_ext_names)
+        print(
+            json.dumps(
+                {
+                    "config": name,
+                    "file_exts": file_ext_names,
+                    **{k: round(v, 3) for k, v in result.items()},
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
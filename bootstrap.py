@@ -2,12 +2,15 @@ from dependency_injector import containers, providers
 from event_core.adapters.services.meta import RedisMetaMapping
 from event_core.adapters.services.storage import StorageAPIClient
 
+from cache import UnitCache
+
 MODULES = ("app", "__main__")
 
 
 class DIContainer(containers.DeclarativeContainer):
     storage = providers.Singleton(StorageAPIClient)
     meta = providers.Singleton(RedisMetaMapping)
+    unit_cache = providers.Singleton(UnitCache)
 
 
 def bootstrap() -> None:
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from contextlib import suppress
+from pathlib import Path
+from typing import IO, Iterable, Iterator, Optional, Union
+
+from event_core.domain.types import FileExt
+
+import config
+from metrics import METRICS
+from processors.common import DocData, Unit, iter_doc_chunks
+
+logger = logging.getLogger(__name__)
+
+# settings that change the units a processor generates
+PROCESSOR_SETTINGS = (
+    "PROCESSOR_VERSION",
+    "THUMB_WIDTH",
+    "THUMB_HEIGHT",
+    "IMG_EXT",
+    "THUMB_FORMATS",
+    "THUMB_JPEG_DRAFT",
+    "TEXT_CHUNK_SIZE",
+    "TEXT_CHUNK_OVERLAP",
+    "TEXT_CHUNK_MIN_SIZE",
+    "CODE_CHUNK_SIZE",
+    "PDF_ADAPTIVE_STRATEGY",
+    "PDF_MIN_TEXT_CHARS",
+    "PDF_MAX_IMAGE_AREA_RATIO",
+    "PDF_MAX_DRAWINGS",
+    "PDF_IMAGE_DPI",
+    "VIDEO_DETECT_DOWNSCALE",
+    "VIDEO_DETECT_FRAME_SKIP",
+    "VIDEO_SCENE_TOLERANCE_SECONDS",
+    "VIDEO_MAX_SCENES",
+    "VIDEO_DETECT_WINDOW_SECONDS",
+)
+
+
+def _discard(f: IO[bytes], tmp_path: str) -> None:
+    f.close()
+    Path(tmp_path).unlink(missing_ok=True)
+
+
+def _config_version() -> str:
+    settings = tuple(getattr(config, name) for name in PROCESSOR_SETTINGS)
+    return hashlib.sha256(repr(settings).encode("utf-8")).hexdigest()[:16]
+
+
+class UnitCache:
+    """Content-addressed cache of the units generated from a doc.
+
+    Units are cached by the hash of the doc's content, its
+    file type and the processor settings in `config`, so a
+    re-uploaded doc replays the units of its first upload
+    instead of being processed again. Keys are not cached
+    as they depend on the doc key, which may differ.
+
+    Entries are pickled to `cache_dir` a unit at a time, as
+    units are generated and replayed, so that no entry is held
+    in memory. `cache_dir` may be shared by multiple worker
+    processes. The least recently used entries are evicted
+    once the cache exceeds `max_bytes`. Hits, misses and
+    evictions are counted in `METRICS`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = config.UNIT_CACHE_DIR,
+        max_bytes: int = config.UNIT_CACHE_MAX_BYTES,
+        max_entry_bytes: int = config.UNIT_CACHE_MAX_ENTRY_BYTES,
+    ):
+        self._dir = Path(cache_dir)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_entry_bytes
+        self._version = _config_version()
+
+    def key_for(self, data: DocData, file_ext: FileExt) -> str:
+        hasher = hashlib.sha256()
+        for chunk in iter_doc_chunks(data):
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+        return f"{digest}-{file_ext.value.strip('.')}-{self._version}"
+
+    def get(self, key: str) -> Optional[Iterator[Unit]]:
+        """Units cached as `key`, read one at a time as they are
+        iterated, or None if there are none"""
+        path = self._dir / key
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            METRICS.inc("preprocessor_unit_cache_lookups_total", result="miss")
+            return None
+        with suppress(FileNotFoundError):  # evicted since opened
+            os.utime(path)  # mark as recently used
+        METRICS.inc("preprocessor_unit_cache_lookups_total", result="hit")
+        return self._load(key, f)
+
+    def _load(self, key: str, f: IO[bytes]) -> Iterator[Unit]:
+        with f:
+            while True:
+                try:
+                    unit = pickle.load(f)
+                except EOFError:
+                    return
+                except Exception:
+                    logger.warning(f"Dropping corrupted cache entry {key}")
+                    (self._dir / key).unlink(missing_ok=True)
+                    raise
+                yield unit
+
+    def put(self, key: str, units: Iterable[Unit]) -> None:
+        for _ in self.record(key, units):
+            pass
+
+    def record(self, key: str, units: Iterable[Unit]) -> Iterator[Unit]:
+        """Yields `units`, writing each to the cache as it is
+        yielded. The entry is only added once all have been
+        yielded. Units of docs too large to cache are passed
+        through as is.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix=".tmp-")
+        f: Optional[IO[bytes]] = os.fdopen(fd, "wb")
+        try:
+            for unit in units:
+                if f is not None:
+                    try:
+                        pickle.dump(unit, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    except Exception as e:
+                        logger.warning(f"Failed to cache {key}. Error: {e}")
+                        _discard(f, tmp_path)
+                        f = None
+                    else:
+                        if f.tell() > self._max_entry_bytes:
+                            _discard(f, tmp_path)
+                            f = None
+                yield unit
+
+            if f is not None:
+                f.close()
+                f = None
+                try:
+                    os.replace(tmp_path, self._dir / key)
+                except OSError as e:
+                    logger.warning(f"Failed to cache {key}. Error: {e}")
+                    Path(tmp_path).unlink(missing_ok=True)
+                else:
+                    self._evict()
+        finally:
+            if f is not None:  # not every unit was yielded
+                _discard(f, tmp_path)
+
+    def _evict(self) -> None:
+        # partial entries, like those of killed workers, are
+        # evicted along with the rest, once no longer written
+        entries = []
+        for path in self._dir.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # evicted by another worker
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            METRICS.inc("preprocessor_unit_cache_evictions_total")
@@ -1,11 +1,155 @@
+import os
+import tempfile
+from pathlib import Path
+
 from event_core.domain.types import FileExt
 
 THUMB_WIDTH = 300
 THUMB_HEIGHT = 200
 IMG_EXT = FileExt.PNG
+# thumbnail format per kind of source. photographic sources are
+# encoded as JPEG, icons as PNG with fast (light) compression
+THUMB_FORMATS = {
+    "image": dict(ext=FileExt.JPG, quality=85),
+    "video": dict(ext=FileExt.JPG, quality=85),
+    "pdf": dict(ext=FileExt.JPG, quality=85),
+    "icon": dict(ext=FileExt.PNG, compress_level=1),
+}
+# decode JPEGs at reduced size for thumbnails. thumbnails then differ
+# from a full decode by a mean absolute difference per channel of up to
+# THUMB_DRAFT_TOLERANCE
+THUMB_JPEG_DRAFT = True
+THUMB_DRAFT_TOLERANCE = 12
+THUMB_WORKERS = 4
+THUMB_BATCH_SIZE = 16
 
 TEXT_CHUNK_SIZE = 300
 TEXT_CHUNK_OVERLAP = 0
 TEXT_CHUNK_MIN_SIZE = 50
 
 CODE_CHUNK_SIZE = 1024
+
+# PDFs of at least PDF_PARALLEL_MIN_PAGES pages are partitioned in
+# ranges of PDF_PAGES_PER_TASK pages, on PDF_PAGE_WORKERS processes
+# per heavy lane worker (see below)
+PDF_PAGES_PER_TASK = 4
+PDF_PARALLEL_MIN_PAGES = 8
+
+# pages with a text layer and no figures or tables skip layout
+# detection and OCR, and have their text layer extracted instead
+PDF_ADAPTIVE_STRATEGY = True
+PDF_MIN_TEXT_CHARS = 32
+PDF_MAX_IMAGE_AREA_RATIO = 0.02
+PDF_MAX_DRAWINGS = 20
+PDF_IMAGE_DPI = 200
+
+# "seek": read the first frame of each scene from the original video
+# "split": split the video into a file per scene with ffmpeg/mkvmerge
+VIDEO_KEYFRAME_MODE = "seek"
+# scene detection: frames are downscaled by VIDEO_DETECT_DOWNSCALE (None
+# picks a factor from the video's width) and VIDEO_DETECT_FRAME_SKIP
+# frames are skipped after each analysed frame, as long as boundaries stay
+# within VIDEO_SCENE_TOLERANCE_SECONDS. Past VIDEO_MAX_SCENES cuts, the
+# rest of a video is sampled evenly instead
+VIDEO_DETECT_DOWNSCALE = None
+VIDEO_DETECT_FRAME_SKIP = 2
+VIDEO_SCENE_TOLERANCE_SECONDS = 0.25
+VIDEO_MAX_SCENES = 500
+# scenes are detected, and their units emitted, this many seconds
+# of video at a time
+VIDEO_DETECT_WINDOW_SECONDS = 60
+# scene starts closer than this are reached by grabbing frames
+VIDEO_SEEK_MIN_FRAMES = 48
+
+# docs are streamed to and from disk in chunks of this size
+DOC_READ_CHUNK_SIZE = 1024 * 1024
+
+# bump when processors change the units they generate
+PROCESSOR_VERSION = 4
+
+# lanes keep cheap doc types from queueing behind expensive ones.
+# memory_mb is how much each worker process may grow by, and
+# timeout_seconds how long it may take per doc
+N_CPUS = os.cpu_count() or 1
+N_HEAVY_WORKERS = max(1, N_CPUS // 2)
+LANES = {
+    "heavy": dict(
+        file_exts=(FileExt.MP4, FileExt.PDF),
+        n_workers=N_HEAVY_WORKERS,
+        mode="process",
+        memory_mb=4096,
+        timeout_seconds=1800,
+    ),
+    "light": dict(
+        file_exts=(
+            FileExt.TXT,
+            FileExt.MD,
+            FileExt.PY,
+            FileExt.JPEG,
+            FileExt.JPG,
+            FileExt.PNG,
+        ),
+        n_workers=max(1, N_CPUS // 2),
+        mode="process",
+        memory_mb=1024,
+        timeout_seconds=300,
+    ),
+}
+DEFAULT_LANE = "light"
+# every heavy lane worker may partition a large PDF at once, so their
+# page workers split the CPUs between them rather than each taking all
+PDF_PAGE_WORKERS = max(1, N_CPUS // N_HEAVY_WORKERS)
+# how often lane workers are checked for exceeding their timeout
+# or memory_mb, after which they are killed and replaced
+WORKER_POLL_SECONDS = 0.5
+
+# processors whose models are loaded by the lane workers that serve
+# them before they are ready, so that no doc pays for loading them.
+# Workers of other lanes never load them. PDF page workers are forked
+# off a server that has loaded the models, and share them copy-on-write
+WARM_UP_FILE_EXTS = (FileExt.PDF,)
+# created once lane workers have warmed up and the service listens
+# for docs, for readiness probes
+READY_FILE = Path(tempfile.gettempdir()) / "preprocessor-ready"
+
+# backfills keep this many docs in flight per lane worker, and
+# checkpoint and report their progress every so many seconds
+BACKFILL_IN_FLIGHT_PER_WORKER = 2
+BACKFILL_CHECKPOINT_SECONDS = 10
+BACKFILL_PROGRESS_SECONDS = 30
+# doc keys under a prefix are listed from the storage service this
+# many at a time
+BACKFILL_LIST_PAGE_SIZE = 1000
+BACKFILL_LIST_TIMEOUT_SECONDS = 30
+
+# "prometheus": serve metrics on http://0.0.0.0:METRICS_PORT/metrics
+# "file": write them to METRICS_FILE every METRICS_FILE_SECONDS
+# None: do not record metrics. Worker processes dump their metrics
+# to METRICS_DIR, for the sink to merge
+METRICS_SINK = "prometheus"
+METRICS_PORT = 9400
+METRICS_FILE = Path(tempfile.gettempdir()) / "preprocessor.prom"
+METRICS_FILE_SECONDS = 15
+METRICS_DIR = Path(tempfile.gettempdir()) / "preprocessor-metrics"
+
+# opt-in profiling of docs that take longer than PROFILE_SLOW_SECONDS
+# (None: none), and of a PROFILE_SAMPLE_RATE fraction of docs (e.g.,
+# 0.01), by sampling stacks every PROFILE_INTERVAL_SECONDS. The latest
+# PROFILE_MAX_PROFILES profiles are kept in PROFILE_DIR
+PROFILE_SLOW_SECONDS = None
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_INTERVAL_SECONDS = 0.01
+PROFILE_MAX_PROFILES = 100
+PROFILE_DIR = Path(tempfile.gettempdir()) / "preprocessor-profiles"
+
+WRITE_BATCH_SIZE = 64
+WRITE_CONCURRENCY = 8
+# units of a doc are written at most this many seconds after they are
+# emitted, even while the next unit is slow to come, and the manifest
+# of a doc being written is saved every WRITE_CHECKPOINT_SECONDS
+WRITE_FLUSH_SECONDS = 2
+WRITE_CHECKPOINT_SECONDS = 30
+
+UNIT_CACHE_DIR = Path(tempfile.gettempdir()) / "preprocessor-unit-cache"
+UNIT_CACHE_MAX_BYTES = 2 * 1024**3
+UNIT_CACHE_MAX_ENTRY_BYTES = 256 * 1024**2
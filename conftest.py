@@ -7,6 +7,7 @@ from event_core.adapters.services.storage import FakeStorageClient
 from event_core.domain.types import FileExt, path_to_ext
 
 from bootstrap import MODULES, DIContainer
+from cache import UnitCache
 from processors import PROCESSORS_BY_EXT
 from processors.base import AbstractProcessor
 
@@ -51,9 +52,10 @@ def txt_processor(txt_file_path: Path) -> Iterator[AbstractProcessor]:
 
 
 @pytest.fixture
-def container() -> DIContainer:
+def container(tmp_path: Path) -> DIContainer:
     container = DIContainer()
     container.storage.override(FakeStorageClient())
     container.meta.override(FakeMetaMapping())
+    container.unit_cache.override(UnitCache(tmp_path / "unit-cache"))
     container.wire(modules=MODULES)
     return container
@@ -0,0 +1,469 @@
+"""Per-stage latency and throughput metrics of the pipeline.
+
+Each process records into its own `METRICS` registry, and dumps
+a snapshot of it to `METRICS_DIR` after every doc. The process
+that runs the sink merges the snapshots of every process (lane
+workers, PDF page workers, itself) and exports them in the
+Prometheus text format, either on an HTTP endpoint or to a
+local file. Recording a timing is a clock read and a dict
+update under a lock, so metrics can be left on in production.
+
+Timings are labelled by stage, and by the file type of the doc
+being processed, which is set once per doc with `doc_ext_label()`.
+"""
+
+import http.server
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from config import (
+    METRICS_DIR,
+    METRICS_FILE,
+    METRICS_FILE_SECONDS,
+    METRICS_PORT,
+    METRICS_SINK,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SECONDS_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+# 1 KiB to 4 GiB
+BYTES_BUCKETS = tuple(float(1024 * 4**i) for i in range(12))
+
+# name: (type, help, buckets of histograms)
+_SPECS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "preprocessor_stage_seconds": (
+        "histogram",
+        "Time spent in a stage of processing a doc",
+        SECONDS_BUCKETS,
+    ),
+    "preprocessor_doc_seconds": (
+        "histogram",
+        "Time spent processing a doc, end to end",
+        SECONDS_BUCKETS,
+    ),
+    "preprocessor_doc_bytes": (
+        "histogram",
+        "Size of the docs processed",
+        BYTES_BUCKETS,
+    ),
+    "preprocessor_rss_growth_bytes": (
+        "histogram",
+        "Growth of the peak RSS of a worker while processing a doc",
+        BYTES_BUCKETS,
+    ),
+    "preprocessor_docs_total": (
+        "counter",
+        "Docs processed, by whether all of their units were stored",
+        (),
+    ),
+    "preprocessor_bytes_in_total": ("counter", "Bytes of docs read", ()),
+    "preprocessor_bytes_out_total": ("counter", "Bytes of units emitted", ()),
+    "preprocessor_units_total": ("counter", "Units emitted, by type", ()),
+    "preprocessor_writes_total": (
+        "counter",
+        "Storage and meta writes of units, by result",
+        (),
+    ),
+    "preprocessor_unit_cache_lookups_total": (
+        "counter",
+        "Lookups of docs in the unit cache, by result",
+        (),
+    ),
+    "preprocessor_unit_cache_evictions_total": (
+        "counter",
+        "Entries evicted from the unit cache",
+        (),
+    ),
+    "preprocessor_pdf_pages_total": (
+        "counter",
+        "PDF pages partitioned, by strategy",
+        (),
+    ),
+    "preprocessor_peak_rss_bytes": (
+        "gauge",
+        "Peak RSS of the workers that processed docs",
+        (),
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+_Series = Tuple[str, Labels]
+
+_doc_ext: ContextVar[str] = ContextVar("doc_ext", default="")
+
+
+@contextmanager
+def doc_ext_label(file_ext: str) -> Iterator[None]:
+    """Label the metrics recorded in this context with the
+    file type of the doc being processed"""
+    token = _doc_ext.set(str(file_ext))
+    try:
+        yield
+    finally:
+        _doc_ext.reset(token)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def peak_rss_bytes() -> int:
+    # in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics:
+    """Counters, max gauges and histograms of a process"""
+
+    def __init__(self, directory: Path = METRICS_DIR, enabled: bool = True):
+        self._directory = directory
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: Dict[_Series, float] = {}
+        self._gauges: Dict[_Series, float] = {}
+        # bucket counts, the last of which is +Inf, then the sum
+        self._histograms: Dict[_Series, List[float]] = {}
+
+    def reset(self) -> None:
+        """Forget what was recorded, e.g., by the parent of a
+        forked worker, which dumps its own snapshot"""
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        if not self.enabled:
+            return
+        series = (name, _labels(labels))
+        with self._lock:
+            self._counters[series] = self._counters.get(series, 0.0) + value
+
+    def set_max(self, name: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        series = (name, _labels(labels))
+        with self._lock:
+            self._gauges[series] = max(self._gauges.get(series, value), value)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        buckets = _SPECS[name][2]
+        series = (name, _labels(labels))
+        i = bisect_left(buckets, value)
+        with self._lock:
+            if (hist := self._histograms.get(series)) is None:
+                hist = self._histograms[series] = [0.0] * (len(buckets) + 2)
+            hist[i] += 1
+            hist[-1] += value
+
+    @contextmanager
+    def timer(self, stage: str, file_ext: Optional[str] = None):
+        """Time a stage, labelled with the file type of the doc,
+        unless another is given"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                "preprocessor_stage_seconds",
+                time.perf_counter() - start,
+                stage=stage,
+                file_ext=str(file_ext or _doc_ext.get()),
+            )
+
+    def timed(self, items: Iterable[T], stage: str) -> Iterator[T]:
+        """Time the iteration of a lazy iterable as a stage,
+        leaving out the time spent by the caller between items"""
+        iterator = iter(items)
+        file_ext = _doc_ext.get()
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(
+                "preprocessor_stage_seconds",
+                elapsed,
+                stage=stage,
+                file_ext=file_ext,
+            )
+
+    def snapshot(self) -> Dict[str, list]:
+        with self._lock:
+            return {
+                kind: [
+                    [
+                        name,
+                        dict(labels),
+                        list(val) if kind == "histograms" else val,
+                    ]
+                    for (name, labels), val in series.items()
+                ]
+                for kind, series in (
+                    ("counters", self._counters),
+                    ("gauges", self._gauges),
+                    ("histograms", self._histograms),
+                )
+            }
+
+    def dump(self) -> None:
+        """Write a snapshot for the sink to merge. Snapshots are
+        named by pid, so the snapshot of a process that exited is
+        kept until its pid is reused"""
+        if not self.enabled:
+            return
+        path = self._directory / f"{os.getpid()}.json"
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            self._directory.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps(self.snapshot()))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to dump metrics. Error: {e}")
+
+
+METRICS = Metrics(enabled=METRICS_SINK is not None)
+os.register_at_fork(after_in_child=METRICS.reset)
+
+
+def _merge(snapshots: Iterable[Dict[str, list]]) -> Metrics:
+    merged = Metrics(enabled=False)
+    for snapshot in snapshots:
+        for name, labels, val in snapshot["counters"]:
+            series = (name, _labels(labels))
+            merged._counters[series] = merged._counters.get(series, 0) + val
+        for name, labels, val in snapshot["gauges"]:
+            series = (name, _labels(labels))
+            merged._gauges[series] = max(merged._gauges.get(series, val), val)
+        for name, labels, hist in snapshot["histograms"]:
+            series = (name, _labels(labels))
+            if (prev := merged._histograms.get(series)) is not None:
+                hist = [a + b for a, b in zip(prev, hist)]
+            merged._histograms[series] = hist
+    return merged
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _format_value(val: float) -> str:
+    return str(int(val)) if val == int(val) else repr(val)
+
+
+def render(directory: Path = METRICS_DIR) -> str:
+    """Merge the snapshots of every process into the
+    Prometheus text format"""
+    snapshots = []
+    for path in directory.glob("*.json"):
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue  # replaced while being read
+    merged = _merge(snapshots)
+
+    lines: List[str] = []
+    for name, (kind, help_, buckets) in _SPECS.items():
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+        if kind == "histogram":
+            for (series_name, labels), hist in sorted(
+                merged._histograms.items()
+            ):
+                if series_name != name:
+                    continue
+                n = 0.0
+                for le, count in zip(buckets + (float("inf"),), hist):
+                    n += count
+                    bucket_labels = labels + (
+                        ("le", "+Inf" if le == float("inf") else repr(le)),
+                    )
+                    lines.append(
+                        f"{name}_bucket{_format_labels(bucket_labels)}"
+                        f" {_format_value(n)}"
+                    )
+                lines.append(
+                    f"{name}_sum{_format_labels(labels)}"
+                    f" {_format_value(hist[-1])}"
+                )
+                lines.append(
+                    f"{name}_count{_format_labels(labels)}"
+                    f" {_format_value(n)}"
+                )
+        else:
+            series = merged._counters if kind == "counter" else merged._gauges
+            for (series_name, labels), val in sorted(series.items()):
+                if series_name == name:
+                    lines.append(
+                        f"{name}{_format_labels(labels)} {_format_value(val)}"
+                    )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsSink(ABC):
+    """Exports the merged metrics of every process"""
+
+    def __init__(self, directory: Path = METRICS_DIR):
+        self._directory = directory
+
+    @abstractmethod
+    def start(self) -> None: ...
+
+    @abstractmethod
+    def stop(self) -> None: ...
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+class PrometheusSink(MetricsSink):
+    """Serves the metrics on http://0.0.0.0:{port}/metrics"""
+
+    def __init__(
+        self, directory: Path = METRICS_DIR, port: int = METRICS_PORT
+    ):
+        super().__init__(directory)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render(directory).encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("", port), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        self._thread.start()
+        logger.info(f"Serving metrics on port {self.port}")
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FileSink(MetricsSink):
+    """Writes the metrics to a file every `interval` seconds,
+    and once more when stopped, e.g., for node exporter's
+    textfile collector"""
+
+    def __init__(
+        self,
+        directory: Path = METRICS_DIR,
+        path: Path = METRICS_FILE,
+        interval: float = METRICS_FILE_SECONDS,
+    ):
+        super().__init__(directory)
+        self._path = path
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics", daemon=True
+        )
+
+    def write(self) -> None:
+        tmp_path = self._path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text(render(self._directory))
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.warning(f"Failed to write metrics. Error: {e}")
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.write()
+
+    def start(self) -> None:
+        self._thread.start()
+        logger.info(f"Writing metrics to {self._path}")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+
+SINKS: Dict[str, Type[MetricsSink]] = {
+    "prometheus": PrometheusSink,
+    "file": FileSink,
+}
+
+
+def start_sink(
+    sink: Optional[str] = METRICS_SINK, directory: Path = METRICS_DIR
+) -> Optional[MetricsSink]:
+    """Clear the snapshots of a previous run, and start the
+    configured sink, if any"""
+    if sink is None:
+        return None
+    for path in directory.glob("*.json"):
+        path.unlink(missing_ok=True)
+    metrics_sink = SINKS[sink](directory)
+    metrics_sink.start()
+    return metrics_sink
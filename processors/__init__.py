@@ -1,29 +1,101 @@
+import importlib
 from functools import partial
-from typing import Callable, Dict, Iterator
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Iterator,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
 
 from event_core.domain.types import FileExt
 
 from processors.base import AbstractProcessor
-from processors.code import CodeProcessor
-from processors.common import Unit
-from processors.image import ImageProcessor
-from processors.markdown import MarkdownProcessor
-from processors.pdf import PdfProcessor
-from processors.text import TextProcessor
-from processors.video import VideoProcessor
-
-PROCESSORS_BY_EXT: Dict[FileExt, Callable[..., AbstractProcessor]] = {
-    FileExt.TXT: partial(TextProcessor, file_ext=FileExt.TXT),
-    FileExt.JPEG: partial(ImageProcessor, file_ext=FileExt.JPEG),
-    FileExt.JPG: partial(ImageProcessor, file_ext=FileExt.JPG),
-    FileExt.PNG: partial(ImageProcessor, file_ext=FileExt.PNG),
-    FileExt.MP4: partial(VideoProcessor, file_ext=FileExt.MP4),
-    FileExt.PDF: partial(PdfProcessor, file_ext=FileExt.PDF),
-    FileExt.MD: partial(MarkdownProcessor, file_ext=FileExt.MD),
-    FileExt.PY: partial(CodeProcessor, file_ext=FileExt.PY),
+from processors.common import DocData, Unit
+from processors.exceptions import FileTypeNotServed
+
+# module and class of the processor of each file type
+PROCESSOR_PATHS: Dict[FileExt, Tuple[str, str]] = {
+    FileExt.TXT: ("processors.text", "TextProcessor"),
+    FileExt.JPEG: ("processors.image", "ImageProcessor"),
+    FileExt.JPG: ("processors.image", "ImageProcessor"),
+    FileExt.PNG: ("processors.image", "ImageProcessor"),
+    FileExt.MP4: ("processors.video", "VideoProcessor"),
+    FileExt.PDF: ("processors.pdf", "PdfProcessor"),
+    FileExt.MD: ("processors.markdown", "MarkdownProcessor"),
+    FileExt.PY: ("processors.code", "CodeProcessor"),
 }
 
 
-def extract_elems_and_assets(data: bytes, file_ext: FileExt) -> Iterator[Unit]:
+class ProcessorRegistry(Mapping[FileExt, Callable[..., AbstractProcessor]]):
+    """Maps file types to processors, importing the module of
+    a processor on first use of its file type.
+
+    Processor modules pull in heavy dependencies (unstructured,
+    torch, cv2, scenedetect), so a worker only pays for those
+    of the types it processes. A worker can also declare the
+    types it serves with `serve()`, after which processors of
+    other types can never be loaded.
+
+    `warm_up()` loads the processors of some types ahead of
+    their first doc, along with whatever they load lazily,
+    like models. Processes forked afterwards share it.
+    """
+
+    def __init__(self, paths: Dict[FileExt, Tuple[str, str]]):
+        self._paths = paths
+        self._served: Optional[Collection[FileExt]] = None
+        self._classes: Dict[FileExt, Type[AbstractProcessor]] = {}
+        self._processors: Dict[FileExt, Callable[..., AbstractProcessor]] = {}
+        self._warm: Set[Type[AbstractProcessor]] = set()
+
+    def serve(self, file_exts: Optional[Collection[FileExt]]) -> None:
+        """Restrict processing to `file_exts`, or lift the
+        restriction if None"""
+        self._served = None if file_exts is None else frozenset(file_exts)
+
+    def _is_served(self, file_ext: FileExt) -> bool:
+        return self._served is None or file_ext in self._served
+
+    def __getitem__(
+        self, file_ext: FileExt
+    ) -> Callable[..., AbstractProcessor]:
+        if not self._is_served(file_ext):
+            raise FileTypeNotServed(file_ext)
+
+        if file_ext not in self._processors:
+            module_name, cls_name = self._paths[file_ext]
+            cls = getattr(importlib.import_module(module_name), cls_name)
+            self._classes[file_ext] = cls
+            self._processors[file_ext] = partial(cls, file_ext=file_ext)
+        return self._processors[file_ext]
+
+    def warm_up(self, file_exts: Collection[FileExt]) -> None:
+        """Load the processors of `file_exts` and their models.
+        Processors shared by several file types warm up once"""
+        for file_ext in file_exts:
+            self[file_ext]
+            cls = self._classes[file_ext]
+            if cls not in self._warm:
+                cls.warm_up()
+                self._warm.add(cls)
+
+    def __iter__(self) -> Iterator[FileExt]:
+        return (ext for ext in self._paths if self._is_served(ext))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+PROCESSORS_BY_EXT = ProcessorRegistry(PROCESSOR_PATHS)
+
+
+def extract_elems_and_assets(
+    data: DocData, file_ext: FileExt
+) -> Iterator[Unit]:
     with PROCESSORS_BY_EXT[file_ext](data) as processor:
         yield from processor()
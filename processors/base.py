@@ -1,9 +1,20 @@
+import mmap
+import shutil
+import tempfile
 from abc import ABC, abstractmethod
-from typing import Iterator
+from pathlib import Path
+from typing import IO, Iterator, Optional, Union
 
 from event_core.domain.types import FileExt
 
-from processors.common import Unit
+from config import DOC_READ_CHUNK_SIZE
+from processors.common import (
+    THUMB_FORMAT_BY_SOURCE,
+    DocData,
+    Unit,
+    open_doc,
+)
+from processors.thumbnails import ThumbnailEngine
 
 
 class AbstractProcessor(ABC):
@@ -40,17 +51,78 @@ class AbstractProcessor(ABC):
     All concrete processors implement a `__call__()`
     method to provide a unified entrypoint to creating
     these units.
+
+    The doc can be given as bytes, as a path or as a binary
+    file. Processors read it through `_read()` or `_path()`,
+    so a doc that is already on disk is never copied into
+    memory by processors that work off a file. Processors that
+    scan a doc map it into memory with `_map()` instead.
+
+    Thumbnails are generated through `self._thumbs`, in the
+    format configured for the processor's `thumb_source`.
     """
 
-    def __init__(self, data: bytes, file_ext: FileExt):
+    thumb_source = "image"
+
+    def __init__(self, data: DocData, file_ext: FileExt):
         self._data = data
         self._file_ext = file_ext
+        self._spool_file: Optional[IO[bytes]] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._thumbs = ThumbnailEngine(
+            THUMB_FORMAT_BY_SOURCE[self.thumb_source]
+        )
 
     @abstractmethod
     def __call__(self) -> Iterator[Unit]:
         raise NotImplementedError
 
+    @classmethod
+    def warm_up(cls) -> None:
+        """Load whatever the processor would otherwise load
+        lazily on its first doc, like models"""
+
+    def _read(self) -> bytes:
+        if isinstance(self._data, bytes):
+            return self._data
+        with open_doc(self._data) as f:
+            return f.read()
+
+    def _path(self) -> Path:
+        if isinstance(self._data, Path):
+            return self._data
+
+        # spool doc to a temp file that lives as long as the processor
+        if self._spool_file is None:
+            self._spool_file = tempfile.NamedTemporaryFile(
+                suffix=self._file_ext
+            )
+            with open_doc(self._data) as f:
+                shutil.copyfileobj(f, self._spool_file, DOC_READ_CHUNK_SIZE)
+            self._spool_file.flush()
+        return Path(self._spool_file.name)
+
+    def _map(self) -> Union[bytes, mmap.mmap]:
+        """Get the doc as bytes, without reading it into memory
+        if it is a file: the file is mapped, and read by the OS
+        page by page as it is accessed"""
+        if isinstance(self._data, bytes):
+            return self._data
+
+        if self._mmap is None:
+            path = self._path()
+            if not path.stat().st_size:
+                return b""  # empty files cannot be mapped
+            with open(path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
     def __enter__(self):
         return self
 
-    def __exit__(self, *_): ...
+    def __exit__(self, *_):
+        self._thumbs.close()
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._spool_file is not None:
+            self._spool_file.close()
@@ -0,0 +1,490 @@
+import codecs
+import re
+from bisect import bisect_right
+from collections import deque
+from mmap import mmap
+from typing import (
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from config import DOC_READ_CHUNK_SIZE
+
+# a doc mapped into memory, or read into it
+Buffer = Union[bytes, mmap]
+
+# a chunk of a buffer: its start and end bytes, and its number of chars
+Span = Tuple[int, int, int]
+
+# bytes 10xxxxxx continue a UTF-8 encoded char
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+# a packed split: a chunk, or a split too long to be packed, of None chars
+_Packed = Tuple[int, int, Optional[int]]
+
+# separators are searched for this many bytes at a time
+_CUT_WINDOW = 64 * 1024
+
+
+def char_len(data: bytes) -> int:
+    """Number of chars in UTF-8 encoded `data`"""
+    if data.isascii():
+        return len(data)
+    return len(data.translate(None, _CONTINUATION_BYTES))
+
+
+def check_utf8(buf: Buffer) -> bool:
+    """Raise UnicodeDecodeError if `buf` is not UTF-8, decoding
+    it block by block. Returns whether `buf` is all ASCII"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    is_ascii = True
+    for start in range(0, len(buf), DOC_READ_CHUNK_SIZE):
+        block = buf[start : start + DOC_READ_CHUNK_SIZE]
+        if is_ascii and block.isascii():
+            continue
+        is_ascii = False
+        decoder.decode(block)
+    decoder.decode(b"", final=True)
+    return is_ascii
+
+
+class _Merger:
+    """Packs consecutive splits into chunks of up to
+    `chunk_size` chars, carrying `chunk_overlap` chars over
+    to the next chunk. Splits and chunks are spans, so a chunk
+    is a single slice of the buffer, never a concatenation"""
+
+    def __init__(self, chunk_size: int, chunk_overlap: int):
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._splits: Deque[Span] = deque()
+        self._total = 0
+
+    def add(self, start: int, end: int, n_chars: int) -> Optional[Span]:
+        """Add a split, and get the chunk it completes, if any"""
+        chunk = None
+        if self._splits and self._total + n_chars > self._chunk_size:
+            chunk = self._splits[0][0], self._splits[-1][1], self._total
+            while self._total > self._chunk_overlap or (
+                self._total + n_chars > self._chunk_size and self._total > 0
+            ):
+                self._total -= self._splits.popleft()[2]
+        self._splits.append((start, end, n_chars))
+        self._total += n_chars
+        return chunk
+
+    def flush(self) -> Optional[Span]:
+        """Get the chunk of the splits added since the last one"""
+        chunk = None
+        if self._splits:
+            chunk = self._splits[0][0], self._splits[-1][1], self._total
+        self._splits.clear()
+        self._total = 0
+        return chunk
+
+
+class StreamingTextSplitter:
+    """Splits text into chunks like langchain's
+    `RecursiveCharacterTextSplitter`, chunk for chunk, when
+    separators are kept (`keep_separator` is "start" or "end")
+    and whitespace is not stripped.
+
+    Text is given as UTF-8 bytes, typically a memory mapped
+    doc, and chunks are yielded as soon as they are complete.
+    Splits are tracked as offsets into the buffer, found by a
+    single scan per level for the occurrences of its separator,
+    starting from the occurrence that picked the separator, and
+    packed into chunks by bisecting these offsets. Nothing is
+    copied out of the buffer but the chunks, so memory does not
+    grow with the size of the doc.
+
+    Separators are ASCII, hence never match inside a multi-byte
+    char. Lengths are counted in chars, which for ASCII text
+    are the lengths in bytes. Otherwise the chars of a window
+    are counted once, for its splits at all levels.
+
+    The splitter holds no state between calls, so one instance
+    can be shared.
+    """
+
+    def __init__(
+        self,
+        separators: Sequence[str],
+        chunk_size: int,
+        chunk_overlap: int = 0,
+        keep_separator: str = "end",
+    ):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Chunk overlap ({chunk_overlap}) is larger than "
+                f"chunk size ({chunk_size})"
+            )
+        if keep_separator not in ("start", "end"):
+            raise ValueError(f"Unsupported keep_separator {keep_separator}")
+        if not all(sep.isascii() for sep in separators):
+            raise ValueError("Separators must be ASCII")
+
+        self._separators: List[bytes] = [sep.encode() for sep in separators]
+        self._patterns: Dict[bytes, Pattern[bytes]] = {
+            sep: re.compile(re.escape(sep)) for sep in self._separators if sep
+        }
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._keep_end = keep_separator == "end"
+
+    def split(self, buf: Buffer, is_ascii: bool = False) -> Iterator[bytes]:
+        for start, end, _ in self.split_spans(buf, is_ascii):
+            yield buf[start:end]
+
+    def split_spans(
+        self,
+        buf: Buffer,
+        is_ascii: bool = False,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> Iterator[Span]:
+        """Spans of the chunks of `buf`, or of `buf[start:end]`.
+        Pass `is_ascii` if `buf` is known to be ASCII, to count
+        chars without slicing"""
+        if end is None:
+            end = len(buf)
+        yield from _Split(self, buf, is_ascii).split(start, end, 0)
+
+
+class _Split:
+    """A run of a `StreamingTextSplitter` over a buffer"""
+
+    def __init__(
+        self, splitter: StreamingTextSplitter, buf: Buffer, is_ascii: bool
+    ):
+        self._separators = splitter._separators
+        self._patterns = splitter._patterns
+        self._chunk_size = splitter._chunk_size
+        self._chunk_overlap = splitter._chunk_overlap
+        self._keep_end = splitter._keep_end
+        self._buf = buf
+        self._is_ascii = is_ascii
+        # the window being split, as returned by `_window_chars`, and
+        # the char offsets in it of the bounds of its too long splits
+        self._chars: Optional[bytes] = None
+        self._char_at: Dict[int, int] = {}
+
+    def split(self, start: int, end: int, level: int) -> Iterator[Span]:
+        """Split `buf[start:end]` with the separators from
+        `level` on, descending into splits that are too long.
+
+        Levels are kept on a stack rather than recursed into,
+        so chunks are not passed up through nested generators.
+        """
+        stack: List[Tuple[Iterator[_Packed], int]] = []
+        if frame := self._descend(start, end, level):
+            stack.append(frame)
+        else:
+            yield from self._split_chars(start, end)
+
+        while stack:
+            packed, level = stack[-1]
+            for split_start, split_end, n_chars in packed:
+                if n_chars is not None:
+                    yield split_start, split_end, n_chars
+                elif level == len(self._separators):
+                    n_chars = self._count(split_start, split_end)
+                    yield split_start, split_end, n_chars
+                elif frame := self._descend(split_start, split_end, level):
+                    stack.append(frame)
+                    break
+                else:
+                    yield from self._split_chars(split_start, split_end)
+            else:
+                stack.pop()
+
+    def _descend(
+        self, start: int, end: int, level: int
+    ) -> Optional[Tuple[Iterator[_Packed], int]]:
+        """Start splitting `buf[start:end]` with the separators
+        from `level` on: get its packed splits and the level of
+        the next separator, or None if it is split into chars"""
+        sep, level, first = self._pick_separator(start, end, level)
+        if not sep:
+            return None
+        if self._chunk_overlap:
+            return self._merge(start, end, sep, first), level
+        if end - start <= _CUT_WINDOW:
+            return iter(self._pack_window(start, end, sep)), level
+        return self._pack(start, end, sep, first), level
+
+    def _pack_window(self, start: int, end: int, sep: bytes) -> List[_Packed]:
+        """Pack the splits of a range that fits in a window,
+        like `_pack`, but with all its cuts at hand"""
+        char_start, char_end = self._char_range(start, end)
+        cuts, char_cuts, _, _ = self._window_cuts(
+            start, end, sep, start, self._chars, char_start, char_end
+        )
+        bounds = [start, *cuts]
+        offsets = bounds if char_cuts is None else [char_start, *char_cuts]
+        if bounds[-1] < end:
+            bounds.append(end)
+            if char_cuts is not None:
+                offsets.append(char_end)
+
+        size = self._chunk_size
+        packed: List[_Packed] = []
+        i = 0
+        while i < len(bounds) - 1:
+            j = bisect_right(offsets, offsets[i] + size, i + 1) - 1
+            n_chars = offsets[j] - offsets[i]
+            if j == i or (j == i + 1 and n_chars == size):
+                packed.append((bounds[i], bounds[i + 1], None))  # too long
+                if char_cuts is not None:
+                    self._char_at[bounds[i]] = offsets[i]
+                    self._char_at[bounds[i + 1]] = offsets[i + 1]
+                i += 1
+            else:
+                packed.append((bounds[i], bounds[j], n_chars))
+                i = j
+        return packed
+
+    def _pack(
+        self, start: int, end: int, sep: bytes, first: int
+    ) -> Iterator[_Packed]:
+        """Pack the splits of `buf[start:end]` without overlap.
+
+        The greedy packing of `_Merger` makes a chunk of the
+        longest run of splits that fits in `chunk_size` chars,
+        which is found by bisecting the char offsets of the
+        cuts between splits, rather than adding splits one by
+        one.
+        """
+        size = self._chunk_size
+        windows = self._cuts(start, end, sep, first)
+        bounds = [start]  # byte offsets of cuts
+        offsets = bounds if self._is_ascii else [0]  # char offsets of cuts
+        i = 0  # cut the next chunk starts at
+        more = True
+        while True:
+            # have cuts up to more than a chunk past cut i
+            while more and offsets[-1] - offsets[i] <= size:
+                window = next(windows, None)
+                if window is None:
+                    more = False
+                    break
+                cuts, char_cuts = window
+                del bounds[:i]
+                bounds.extend(cuts)
+                if char_cuts is not None:
+                    del offsets[:i]
+                    offsets.extend(char_cuts)
+                i = 0
+
+            if i == len(bounds) - 1:
+                return
+
+            j = bisect_right(offsets, offsets[i] + size, i + 1) - 1
+            n_chars = offsets[j] - offsets[i]
+            if j == i or (j == i + 1 and n_chars == size):
+                yield bounds[i], bounds[i + 1], None  # too long
+                i += 1
+            else:
+                yield bounds[i], bounds[j], n_chars
+                i = j
+
+    def _merge(
+        self, start: int, end: int, sep: bytes, first: int
+    ) -> Iterator[_Packed]:
+        """Pack the splits of `buf[start:end]` with overlap"""
+        merger = _Merger(self._chunk_size, self._chunk_overlap)
+        split_start, split_offset = start, 0
+        for cuts, char_cuts in self._cuts(start, end, sep, first):
+            for k, split_end in enumerate(cuts):
+                offset = split_end if char_cuts is None else char_cuts[k]
+                n_chars = offset - split_offset
+                if n_chars < self._chunk_size:
+                    if chunk := merger.add(split_start, split_end, n_chars):
+                        yield chunk
+                else:
+                    if chunk := merger.flush():
+                        yield chunk
+                    yield split_start, split_end, None  # too long
+                split_start, split_offset = split_end, offset
+        if chunk := merger.flush():
+            yield chunk
+
+    def _count(self, start: int, end: int) -> int:
+        """Number of chars of `buf[start:end]`"""
+        if self._is_ascii:
+            return end - start
+        if end - start <= DOC_READ_CHUNK_SIZE:
+            return char_len(self._buf[start:end])
+        return sum(
+            char_len(self._buf[i : min(i + DOC_READ_CHUNK_SIZE, end)])
+            for i in range(start, end, DOC_READ_CHUNK_SIZE)
+        )
+
+    def _window_chars(self, start: int, end: int) -> Optional[bytes]:
+        """`buf[start:end]` without its UTF-8 continuation bytes,
+        which leaves a byte per char and the same ASCII
+        separators, whose positions are then char offsets. None
+        if it is ASCII, when char offsets are byte offsets"""
+        if self._is_ascii:
+            return None
+        window = self._buf[start:end]
+        if window.isascii():
+            return None
+        return window.translate(None, _CONTINUATION_BYTES)
+
+    def _char_range(self, start: int, end: int) -> Tuple[int, int]:
+        """Char offsets of `buf[start:end]` in the window being
+        split, which it becomes unless it is a too long split of
+        that window, so a window is only counted once"""
+        if self._is_ascii:
+            return start, end
+        char_at = self._char_at
+        if start in char_at and end in char_at:
+            return char_at[start], char_at[end]
+        self._chars = self._window_chars(start, end)
+        n_chars = end - start if self._chars is None else len(self._chars)
+        self._char_at = {start: 0, end: n_chars}
+        return 0, n_chars
+
+    def _pick_separator(
+        self, start: int, end: int, level: int
+    ) -> Tuple[bytes, int, int]:
+        """Pick the first separator from `level` on that occurs
+        in `buf[start:end]`, the level of the next separator,
+        and where the separator first occurs"""
+        for i in range(level, len(self._separators)):
+            sep = self._separators[i]
+            if not sep:
+                return sep, len(self._separators), start
+            if (first := self._buf.find(sep, start, end)) != -1:
+                return sep, i + 1, first
+        return self._separators[-1], len(self._separators), -1
+
+    def _window_cuts(
+        self,
+        pos: int,
+        window_end: int,
+        sep: bytes,
+        last_cut: int,
+        chars: Optional[bytes],
+        char_pos: int,
+        char_end: int,
+    ) -> Tuple[List[int], Optional[List[int]], int, int]:
+        """Cuts of the non-empty splits in `buf[pos:window_end]`
+        after `last_cut`, as byte offsets, and unless the buffer
+        is ASCII, as char offsets, where `pos` is at `char_pos`
+        and `window_end` at `char_end`. Also returns the byte and
+        char offsets right after the last occurrence of `sep`,
+        to resume from.
+
+        Char offsets are those of the occurrences in `chars`, as
+        returned by `_window_chars`."""
+        pattern = self._patterns[sep]
+        found = [
+            m.start() for m in pattern.finditer(self._buf, pos, window_end)
+        ]
+        if not found:
+            return [], [] if not self._is_ascii else None, pos, char_pos
+
+        shift = len(sep) if self._keep_end else 0
+        cuts = [i + shift for i in found]
+        resume = found[-1] + len(sep)
+        char_cuts = None
+        if not self._is_ascii:
+            if chars is None:
+                char_found = [i - pos + char_pos for i in found]
+            else:
+                char_found = [
+                    m.start()
+                    for m in pattern.finditer(chars, char_pos, char_end)
+                ]
+            char_cuts = [i + shift for i in char_found]
+            char_pos = char_found[-1] + len(sep)
+
+        if cuts[0] == last_cut:
+            del cuts[0]  # empty split at the start of the range
+            if char_cuts is not None:
+                del char_cuts[0]
+        return cuts, char_cuts, resume, char_pos
+
+    def _cuts(
+        self, start: int, end: int, sep: bytes, first: int
+    ) -> Iterator[Tuple[List[int], Optional[List[int]]]]:
+        """Cuts of the non-empty splits of `buf[start:end]`, up
+        to and including `end`, a window of `_CUT_WINDOW` bytes
+        at a time. Given the first occurrence of `sep` (-1 if
+        there is none), each window starts at the next
+        occurrence after the previous window."""
+        last_cut = start
+        pos, chars = start, 0
+        next_pos = first
+        while next_pos != -1:
+            chars += self._count(pos, next_pos)
+            window_end = min(next_pos + _CUT_WINDOW, end)
+            window = self._window_chars(next_pos, window_end)
+            char_end = window_end - next_pos if window is None else len(window)
+            cuts, char_cuts, pos, window_chars = self._window_cuts(
+                next_pos, window_end, sep, last_cut, window, 0, char_end
+            )
+            if char_cuts:
+                char_cuts = [chars + i for i in char_cuts]
+            chars += window_chars
+            if cuts:
+                last_cut = cuts[-1]
+                yield cuts, char_cuts
+            next_pos = self._buf.find(sep, pos, end)
+
+        if last_cut < end:
+            yield [end], (
+                None if self._is_ascii else [chars + self._count(pos, end)]
+            )
+
+    def _split_chars(self, start: int, end: int) -> Iterator[Span]:
+        """Split `buf[start:end]` into chars, and pack them"""
+        size = self._chunk_size
+        if not self._chunk_overlap and self._is_ascii:
+            # chunks are runs of chunk_size chars
+            for i in range(start, end, size):
+                yield i, min(i + size, end), min(size, end - i)
+            return
+
+        if not self._chunk_overlap:
+            pos = start
+            carry = ""
+            for text in self._decode(start, end):
+                carry += text
+                n_chunks = len(carry) // size
+                for k in range(n_chunks):
+                    chunk = carry[k * size : (k + 1) * size]
+                    chunk_end = pos + len(chunk.encode())
+                    yield pos, chunk_end, size
+                    pos = chunk_end
+                carry = carry[n_chunks * size :]
+            if carry:
+                yield pos, end, len(carry)
+            return
+
+        merger = _Merger(size, self._chunk_overlap)
+        pos = start
+        for text in self._decode(start, end):
+            for char in text:
+                char_end = pos + len(char.encode())
+                if chunk := merger.add(pos, char_end, 1):
+                    yield chunk
+                pos = char_end
+        if chunk := merger.flush():
+            yield chunk
+
+    def _decode(self, start: int, end: int) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for i in range(start, end, DOC_READ_CHUNK_SIZE):
+            block = self._buf[i : min(i + DOC_READ_CHUNK_SIZE, end)]
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
@@ -1,30 +1,162 @@
-from typing import Iterator
+import ast
+import re
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 from event_core.domain.types import Element, FileExt
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from config import CODE_CHUNK_SIZE
 from processors.base import AbstractProcessor
-from processors.common import Unit
+from processors.chunking import (
+    Buffer,
+    Span,
+    StreamingTextSplitter,
+    char_len,
+    check_utf8,
+)
+from processors.common import Unit, UnitMeta
+
+CODE_SPLITTER = StreamingTextSplitter(
+    chunk_size=CODE_CHUNK_SIZE,
+    chunk_overlap=0,
+    separators=["\n\n", "\n"],
+    keep_separator="start",
+)
+
+# line endings, as the Python tokenizer counts them
+_NEWLINE = re.compile(rb"\r\n?|\n")
+
+# a statement of a parsed module: its start and end bytes, its
+# number of chars, and its node, or None for the header of a class
+_Segment = Tuple[int, int, int, Optional[ast.stmt]]
+
+
+class _CodeChunker:
+    """Packs the statements of a Python module into chunks of
+    up to `CODE_CHUNK_SIZE` chars, so that functions and classes
+    are never cut, as long as they fit in a chunk.
+
+    Each top-level statement covers its lines, along with the
+    comments and blank lines above it. Consecutive statements
+    are packed together. A class too long for a chunk is packed
+    statement by statement, method by method, with its header
+    in the first chunk. Other statements too long for a chunk
+    are split by `CODE_SPLITTER`.
+    """
+
+    def __init__(self, code: Buffer, is_ascii: bool):
+        self._code = code
+        self._is_ascii = is_ascii
+        self._line_starts = [0]
+        self._line_starts.extend(m.end() for m in _NEWLINE.finditer(code))
+
+    def chunks(self, module: ast.Module) -> Iterator[Span]:
+        yield from self._pack(self._segments(module.body, 0, len(self._code)))
+
+    def lines(self, start: int, end: int) -> Tuple[int, int]:
+        """First and last line (1-indexed) of `code[start:end]`"""
+        first = bisect_right(self._line_starts, start)
+        return first, max(first, bisect_right(self._line_starts, end - 1))
+
+    def _offset(self, line: int) -> int:
+        """Byte offset of the start of `line` (1-indexed)"""
+        if line > len(self._line_starts):
+            return len(self._code)
+        return self._line_starts[line - 1]
+
+    def _count(self, start: int, end: int) -> int:
+        if self._is_ascii:
+            return end - start
+        return char_len(self._code[start:end])
+
+    def _segments(
+        self, body: Sequence[ast.stmt], start: int, end: int
+    ) -> List[_Segment]:
+        """Cover `code[start:end]` with the statements of `body`.
+        The last statement also covers whatever follows it"""
+        segments = []
+        for i, node in enumerate(body):
+            if i == len(body) - 1:
+                node_end = end
+            else:
+                node_end = self._offset(node.end_lineno + 1)  # type: ignore
+            segments.append(
+                (start, node_end, self._count(start, node_end), node)
+            )
+            start = node_end
+        return segments
+
+    def _class_segments(self, segment: _Segment) -> List[_Segment]:
+        """Split a class into its header and its statements"""
+        start, end, _, node = segment
+        body = node.body  # type: ignore
+        header_end = self._offset(body[0].lineno)
+        for decorator in getattr(body[0], "decorator_list", ()):
+            header_end = min(header_end, self._offset(decorator.lineno))
+        header = (start, header_end, self._count(start, header_end), None)
+        return [header] + self._segments(body, header_end, end)
+
+    def _pack(self, segments: List[_Segment]) -> Iterator[Span]:
+        chunk: Optional[Span] = None
+        for segment in segments:
+            start, end, n_chars, node = segment
+            if n_chars > CODE_CHUNK_SIZE:
+                if chunk:
+                    yield chunk
+                    chunk = None
+                if isinstance(node, ast.ClassDef):
+                    yield from self._pack(self._class_segments(segment))
+                else:
+                    yield from CODE_SPLITTER.split_spans(
+                        self._code, self._is_ascii, start, end
+                    )
+            elif chunk and chunk[2] + n_chars <= CODE_CHUNK_SIZE:
+                chunk = (chunk[0], end, chunk[2] + n_chars)
+            else:
+                if chunk:
+                    yield chunk
+                chunk = (start, end, n_chars)
+        if chunk:
+            yield chunk
+
+
+def _parse(code: Buffer, file_ext: FileExt) -> Optional[ast.Module]:
+    # code that fits in a chunk is a chunk, parsed or not
+    if file_ext != FileExt.PY or len(code) <= CODE_CHUNK_SIZE:
+        return None
+    try:
+        module = ast.parse(code[:])
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+    return module if module.body else None
 
 
 class CodeProcessor(AbstractProcessor):
+    """Chunks Python along its functions and classes, and other
+    code, or Python that does not parse, along blank lines and
+    lines. The lines of each chunk are set as its
+    `UnitMeta.LINES`"""
 
     def __call__(self) -> Iterator[Unit]:
+        code = self._map()
+        is_ascii = check_utf8(code)
+        chunker = _CodeChunker(code, is_ascii)
+        if module := _parse(code, self._file_ext):
+            spans = chunker.chunks(module)
+        else:
+            spans = CODE_SPLITTER.split_spans(code, is_ascii)
 
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CODE_CHUNK_SIZE,
-            chunk_overlap=0,
-            length_function=len,
-            separators=["\n\n", "\n"],
-            is_separator_regex=False,
-            strip_whitespace=False,
-        )
-        chunks = splitter.split_text(self._data.decode("utf-8"))
-        for i, chunk in enumerate(chunks, start=1):
+        seq = 1
+        for start, end, _ in spans:
+            chunk = code[start:end]
+            if not chunk.strip():
+                continue
+            first, last = chunker.lines(start, end)
             yield Unit(
-                seq=i,
-                data=chunk.encode("utf-8"),
+                seq=seq,
+                data=chunk,
                 type=Element.CODE,
                 file_ext=self._file_ext,
+                meta={UnitMeta.LINES: f"{first}-{last}"},
             )
+            seq += 1
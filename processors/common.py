@@ -1,17 +1,39 @@
+import math
+from contextlib import contextmanager
 from dataclasses import dataclass
+from enum import StrEnum
 from io import BytesIO
-from typing import Any, Dict, Optional
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Union
 
 from event_core.adapters.services.meta import Meta
 from event_core.domain.types import FileExt, RepoObject
 from PIL import Image, ImageOps
 
 from config import (
-    IMG_EXT,
+    DOC_READ_CHUNK_SIZE,
+    THUMB_FORMATS,
     THUMB_HEIGHT,
+    THUMB_JPEG_DRAFT,
     THUMB_WIDTH,
 )
 
+# a doc is passed around as its bytes, its path, or a binary file
+DocData = Union[bytes, Path, BinaryIO]
+
+
+class UnitMeta(StrEnum):
+    """Meta that event_core's `Meta` has no key for"""
+
+    LANGUAGE = "LANGUAGE"  # language of a fenced code block
+    HEADINGS = "HEADINGS"  # headings a unit is under, outermost first
+    LINES = "LINES"  # first and last line of a code unit, as "first-last"
+    MANIFEST = "MANIFEST"  # keys and digests of what a doc is stored as
+    FAILURE = "FAILURE"  # why a doc failed, until it is processed fully
+
+
+MetaKey = Union[Meta, UnitMeta]
+
 
 @dataclass
 class Unit:
@@ -21,11 +43,85 @@ class Unit:
     data: bytes
     type: RepoObject
     file_ext: FileExt
-    meta: Optional[Dict[Meta, Any]] = None
+    meta: Optional[Dict[MetaKey, Any]] = None
+
+
+@dataclass(frozen=True)
+class ThumbFormat:
+    """How thumbnails are encoded. `quality` applies to JPEG,
+    `compress_level` (0 fastest, 9 smallest) applies to PNG"""
+
+    ext: FileExt
+    quality: int = 85
+    compress_level: int = 6
+
+    def save_kwargs(self) -> Dict[str, Any]:
+        fmt = ext_to_pil_fmt(self.ext)
+        if fmt == "JPEG":
+            return dict(format=fmt, quality=self.quality)
+        if fmt == "PNG":
+            return dict(format=fmt, compress_level=self.compress_level)
+        return dict(format=fmt)
+
+
+# thumbnail format per kind of thumbnail source
+THUMB_FORMAT_BY_SOURCE: Dict[str, ThumbFormat] = {
+    source: ThumbFormat(**fmt) for source, fmt in THUMB_FORMATS.items()
+}
+
+
+@contextmanager
+def open_doc(data: DocData) -> Iterator[BinaryIO]:
+    if isinstance(data, bytes):
+        yield BytesIO(data)
+    elif isinstance(data, Path):
+        with open(data, "rb") as f:
+            yield f
+    else:
+        data.seek(0)
+        yield data
+
+
+def iter_doc_chunks(
+    data: DocData, chunk_size: int = DOC_READ_CHUNK_SIZE
+) -> Iterator[bytes]:
+    with open_doc(data) as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def _draft_for_thumb(image: Image.Image) -> None:
+    """Have JPEGs decoded at the smallest power-of-2 scale that
+    still covers the region `ImageOps.fit` keeps for the thumb.
+    Decoding skips most of the work, but DCT scaling averages
+    pixels, where full decoding and nearest resizing samples
+    them, so thumbs may differ by up to `THUMB_DRAFT_TOLERANCE`
+    (mean absolute difference per channel)."""
+    if image.format != "JPEG":
+        return
+
+    width, height = image.size
+    ratio = THUMB_WIDTH / THUMB_HEIGHT
+    if width / height > ratio:
+        crop_width, crop_height = height * ratio, height
+    else:
+        crop_width, crop_height = width, width / ratio
+    scale = max(THUMB_WIDTH / crop_width, THUMB_HEIGHT / crop_height)
+    image.draft(
+        image.mode, (math.ceil(width * scale), math.ceil(height * scale))
+    )
 
 
-def resize_to_thumb(data: bytes) -> bytes:
-    image = Image.open(BytesIO(data))
+def resize_to_thumb(
+    data: Union[bytes, Image.Image],
+    thumb_fmt: ThumbFormat = THUMB_FORMAT_BY_SOURCE["icon"],
+) -> bytes:
+    if isinstance(data, Image.Image):
+        image = data
+    else:
+        image = Image.open(BytesIO(data))
+        if THUMB_JPEG_DRAFT:
+            _draft_for_thumb(image)
     image = ImageOps.fit(
         image,
         (THUMB_WIDTH, THUMB_HEIGHT),
@@ -33,11 +129,13 @@ def resize_to_thumb(data: bytes) -> bytes:
         bleed=0.0,
         centering=(0.5, 0.5),
     )  # type: ignore
-    image_fmt = ext_to_pil_fmt(IMG_EXT)
+    save_kwargs = thumb_fmt.save_kwargs()
+    if save_kwargs["format"] == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")  # JPEG has no alpha channel
     image_bytes = BytesIO()
-    image.save(image_bytes, format=image_fmt)
+    image.save(image_bytes, **save_kwargs)
     return image_bytes.getvalue()
 
 
 def ext_to_pil_fmt(file_ext: FileExt) -> str:
-    return file_ext.value.strip(".").upper()  # .png -> PNG
+    return Image.registered_extensions()[file_ext.value]  # .jpg -> JPEG
@@ -8,3 +8,6 @@ class FrameReadError(Exception): ...
 
 
 class EmptyPDF(Exception): ...
+
+
+class FileTypeNotServed(KeyError): ...
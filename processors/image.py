@@ -2,29 +2,30 @@ from typing import Iterator
 
 from event_core.domain.types import Asset, Element
 
-from config import IMG_EXT
 from processors.base import AbstractProcessor
-from processors.common import Unit, resize_to_thumb
+from processors.common import Unit
 
 
 class ImageProcessor(AbstractProcessor):
 
     def __call__(self) -> Iterator[Unit]:
+        data = self._read()
+        thumb = self._thumbs.thumb(data)
         yield Unit(
             seq=0,
-            data=resize_to_thumb(self._data),
+            data=thumb,
             type=Asset.DOC_THUMBNAIL,
-            file_ext=IMG_EXT,
+            file_ext=self._thumbs.ext,
         )
         yield Unit(
             seq=1,
-            data=self._data,
+            data=data,
             type=Element.IMAGE,
             file_ext=self._file_ext,
         )
         yield Unit(
             seq=1,
-            data=resize_to_thumb(self._data),
+            data=thumb,
             type=Asset.ELEM_THUMBNAIL,
-            file_ext=IMG_EXT,
+            file_ext=self._thumbs.ext,
         )
@@ -1,39 +1,222 @@
-from typing import Iterator
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterator, List, Match, Optional, Pattern, Tuple
 
 from event_core.domain.types import Element, FileExt
 
 from processors.base import AbstractProcessor
-from processors.code import CodeProcessor
-from processors.common import Unit
-from processors.text import TextProcessor
+from processors.chunking import Buffer, check_utf8
+from processors.code import CODE_SPLITTER
+from processors.common import DocData, MetaKey, Unit, UnitMeta
+from processors.text import chunk_text
+
+# lines that may open a fence, or be a heading, a setext
+# heading underline, or a list item. Other lines are skipped
+_CANDIDATE = re.compile(rb"^[ \t]*(?:[#`~=*+-]|\d{1,9}[.)])", re.M)
+_FENCE = re.compile(rb"(`{3,}|~{3,})[ \t]*([^`\s]*)[^`]*")
+_HEADING = re.compile(rb"(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*")
+_SETEXT_UNDERLINE = re.compile(rb"(?:=+|-+)[ \t]*")
+_LIST_ITEM = re.compile(rb"(?:[-*+]|\d{1,9}[.)])(?:[ \t]+|$)")
+
+# lines indented by more than this are indented code, or the
+# continuation of a list item, rather than a fence or heading
+_MAX_INDENT = 3
+
+
+@dataclass
+class _Block:
+    """A fenced code block, or the text between two fences or
+    headings, as a span of the doc"""
+
+    start: int
+    end: int
+    headings: Tuple[str, ...]
+    language: Optional[str] = None
+
+    @property
+    def is_code(self) -> bool:
+        return self.language is not None
+
+
+@lru_cache(maxsize=None)
+def _fence_closer(chars: bytes) -> Pattern[bytes]:
+    return re.compile(
+        rb"^[ \t]*"
+        + re.escape(chars)
+        + re.escape(chars[:1])
+        + rb"*[ \t]*\r?$",
+        re.M,
+    )
+
+
+@lru_cache(maxsize=None)
+def _list_end(list_indent: int) -> Pattern[bytes]:
+    """A blank line, then a line less indented than list items"""
+    return re.compile(
+        rb"\n[ \t]*\r?\n(?:[ \t]*\r?\n)*[ \t]{0,%d}[^ \t\r\n]"
+        % (list_indent - 1)
+    )
+
+
+class _BlockScanner:
+    """Tokenizes markdown into code and text blocks, in a single
+    scan. Only lines that start like a fence, a heading or a list
+    item are looked at, the rest are skipped over by regexes.
+
+    Text is cut before each heading, so a text block is under
+    one heading path. Fences may be indented as far as the
+    content of the list item they are in.
+    """
+
+    def __init__(self, md: Buffer):
+        self._md = md
+        self._headings: List[Tuple[int, str]] = []
+        self._text_start = 0
+        # indent of the content of the current list item
+        self._list_indent: Optional[int] = None
+        # end of the last line that cannot be a setext heading title
+        self._block_end = 0
+
+    def __iter__(self) -> Iterator[_Block]:
+        md = self._md
+        pos = 0
+        while match := _CANDIDATE.search(md, pos):
+            line_start = match.start()
+            pos = line_end = self._line_end(line_start)
+            line = md[line_start:line_end].rstrip(b"\r\n")
+            stripped = line.lstrip(b" \t")
+            indent = len(line) - len(stripped)
+
+            if self._list_indent is not None:
+                if _list_end(self._list_indent).search(
+                    md, self._block_end - 1, line_start + indent + 1
+                ):
+                    self._list_indent = None
+            max_indent = _MAX_INDENT + (self._list_indent or 0)
+
+            if item := _LIST_ITEM.match(stripped):
+                self._list_indent = indent + item.end()
+                self._block_end = line_end
+                stripped = stripped[item.end() :]
+                indent = self._list_indent
+
+            if indent <= max_indent and (fence := _FENCE.fullmatch(stripped)):
+                yield from self._cut(line_start)
+                yield from self._fence(fence, line_end)
+                pos = self._text_start
+                continue
+
+            if indent > _MAX_INDENT or (
+                self._list_indent is not None and indent >= self._list_indent
+            ):
+                continue
+
+            if heading := _HEADING.fullmatch(stripped):
+                yield from self._section(
+                    len(heading.group(1)), heading.group(2) or b"", line_start
+                )
+                self._block_end = line_end
+            elif _SETEXT_UNDERLINE.fullmatch(stripped):
+                yield from self._setext(stripped[:1], line_start, line_end)
+
+        yield from self._cut(len(md))
+
+    def _line_end(self, line_start: int) -> int:
+        line_end = self._md.find(b"\n", line_start) + 1
+        return line_end or len(self._md)
+
+    def _path(self) -> Tuple[str, ...]:
+        return tuple(title for _, title in self._headings)
+
+    def _cut(self, end: int) -> Iterator[_Block]:
+        """Cut the text block up to `end`"""
+        if end > self._text_start:
+            yield _Block(self._text_start, end, self._path())
+        self._text_start = end
+
+    def _fence(
+        self, opener: Match[bytes], content_start: int
+    ) -> Iterator[_Block]:
+        chars, language = opener.group(1), opener.group(2).decode("utf-8")
+        closer = _fence_closer(chars).search(self._md, content_start)
+        if closer is None:  # an unclosed fence runs to the end
+            content_end = end = len(self._md)
+        else:
+            content_end = closer.start()
+            end = self._line_end(content_end)
+        yield _Block(content_start, content_end, self._path(), language)
+        self._text_start = self._block_end = end
+
+    def _section(
+        self, level: int, title: bytes, start: int
+    ) -> Iterator[_Block]:
+        """Cut the text block at a heading, and enter its section"""
+        yield from self._cut(start)
+        while self._headings and self._headings[-1][0] >= level:
+            self._headings.pop()
+        self._headings.append((level, title.decode("utf-8").strip()))
+        self._list_indent = None
+
+    def _setext(
+        self, char: bytes, line_start: int, line_end: int
+    ) -> Iterator[_Block]:
+        """Enter the section of a setext heading, if the line
+        above its underline is a paragraph line"""
+        if line_start <= self._block_end:
+            return
+        title_start = self._md.rfind(b"\n", 0, line_start - 1) + 1
+        title = self._md[title_start:line_start].strip()
+        if title_start < self._block_end or not title:
+            return
+        level = 1 if char == b"=" else 2
+        yield from self._section(level, title, title_start)
+        self._block_end = line_end
 
 
 class MarkdownProcessor(AbstractProcessor):
+    """Chunks text with `TEXT_SPLITTER` and fenced code with
+    `CODE_SPLITTER`, as blocks are scanned from the mapped doc.
+
+    Units are tagged with the headings they are under, and
+    code units with the language of their fence, if any.
+    """
+
     def __init__(
-        self, data: bytes, file_ext: FileExt = FileExt.MD, *args, **kwargs
+        self, data: DocData, file_ext: FileExt = FileExt.MD, *args, **kwargs
     ):
         super().__init__(data, file_ext, *args, **kwargs)
 
     def __call__(self) -> Iterator[Unit]:
-        blocks = self._data.decode("utf-8").split("```")
+        md = self._map()
+        is_ascii = check_utf8(md)
         seq = 0
-        for i, block in enumerate(blocks):
-            block = block.strip()
-            if not block:
-                continue
+        for block in _BlockScanner(md):
+            meta: Dict[MetaKey, str] = {}
+            if block.headings:
+                meta[UnitMeta.HEADINGS] = " > ".join(block.headings)
 
-            enc_block = block.encode("utf-8")
-            if i % 2:
-                # code block
-                for unit in CodeProcessor(
-                    enc_block, FileExt.PY
-                )():  # any file ext will do
-                    unit.seq = (seq := seq + 1)
-                    unit.type = Element.CODE
-                    yield unit
+            if block.is_code:
+                if block.language:
+                    meta[UnitMeta.LANGUAGE] = block.language
+                for start, end, _ in CODE_SPLITTER.split_spans(
+                    md, is_ascii, block.start, block.end
+                ):
+                    chunk = md[start:end]
+                    if chunk.strip():
+                        yield Unit(
+                            seq=(seq := seq + 1),
+                            data=chunk.strip(b"\r\n"),
+                            type=Element.CODE,
+                            file_ext=FileExt.PY,  # any file ext will do
+                            meta=dict(meta),
+                        )
             else:
-                # text block
-                for unit in TextProcessor(enc_block)():
-                    unit.seq = (seq := seq + 1)
-                    unit.type = Element.TEXT
-                    yield unit
+                for chunk in chunk_text(md, is_ascii, block.start, block.end):
+                    yield Unit(
+                        seq=(seq := seq + 1),
+                        data=chunk,
+                        type=Element.TEXT,
+                        file_ext=FileExt.TXT,
+                        meta=dict(meta),
+                    )
@@ -1,23 +1,42 @@
 import base64
-from io import BytesIO
-from typing import Iterator, cast
+import logging
+import multiprocessing
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, cast
 
+import fitz
+import pypdfium2 as pdfium
 from event_core.adapters.services.meta import Meta
 from event_core.domain.types import Asset, Element, FileExt
-from pdf2image import convert_from_bytes
-from unstructured.documents.elements import CoordinatesMetadata, ElementType
+from PIL import Image, ImageDraw
+from pypdf import PdfReader, PdfWriter
+from unstructured.documents.coordinates import PixelSpace
+from unstructured.documents.elements import CoordinatesMetadata
+from unstructured.documents.elements import Element as PdfElement
+from unstructured.documents.elements import ElementType
 from unstructured.partition.pdf import partition_pdf
+from unstructured_inference.models import tables
 
-from processors.base import AbstractProcessor
-from processors.common import (
-    IMG_EXT,
-    Unit,
-    ext_to_pil_fmt,
-    resize_to_thumb,
+from config import (
+    PDF_ADAPTIVE_STRATEGY,
+    PDF_IMAGE_DPI,
+    PDF_MAX_DRAWINGS,
+    PDF_MAX_IMAGE_AREA_RATIO,
+    PDF_MIN_TEXT_CHARS,
+    PDF_PAGE_WORKERS,
+    PDF_PAGES_PER_TASK,
+    PDF_PARALLEL_MIN_PAGES,
 )
+from metrics import METRICS
+from processors.base import AbstractProcessor
+from processors.common import DocData, Unit
 from processors.exceptions import EmptyPDF
 from processors.text import TextProcessor
 
+logger = logging.getLogger(__name__)
+
 IMAGE_TYPES = {
     ElementType.IMAGE: Element.IMAGE,
     ElementType.TABLE: Element.PLOT,
@@ -33,49 +52,249 @@ MIME_TYPE_TO_EXT = {
 
 MIN_TEXT_CHUNKSIZE = 16
 
+HI_RES = "hi_res"
+FAST = "fast"
+
+PARTITION_KWARGS = {
+    HI_RES: dict(
+        strategy=HI_RES,
+        infer_table_structure=True,
+        extract_image_block_types=list(IMAGE_TYPES.keys()),
+        extract_image_block_to_payload=True,
+        pdf_image_dpi=PDF_IMAGE_DPI,
+    ),
+    FAST: dict(strategy=FAST),
+}
+
+_page_pool: Optional[Executor] = None
+
+
+def _render_first_page(path: Path) -> Optional[Image.Image]:
+    """Render the first page of a PDF with pdfium, in-process
+    rather than through poppler, or None if it has no pages"""
+    pdf = pdfium.PdfDocument(str(path))
+    try:
+        if not len(pdf):
+            return None
+        page = pdf[0]
+        try:
+            return page.render(scale=PDF_IMAGE_DPI / 72).to_pil()
+        finally:
+            page.close()
+    finally:
+        pdf.close()
+
+
+def _warm_up_models() -> None:
+    """Load the layout detection, table structure and OCR
+    models, by partitioning a one-page PDF with hi_res"""
+    page = Image.new("RGB", (850, 1100), "white")
+    ImageDraw.Draw(page).text((100, 100), "Warm up", fill="black")
+    with tempfile.NamedTemporaryFile(suffix=FileExt.PDF) as pdf_file:
+        page.save(pdf_file, format="PDF")
+        pdf_file.flush()
+        partition_pdf(filename=pdf_file.name, **PARTITION_KWARGS[HI_RES])
+
+    # only loaded once a table is found
+    tables.load_agent()
+
+
+def _get_page_pool() -> Executor:
+    global _page_pool
+    if _page_pool is None:
+        # not forked off the calling worker, which may be running
+        # threads, but off a server that loads the models once.
+        # the pool is kept for the lifetime of the worker
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["processors.pdf_models"])
+        _page_pool = ProcessPoolExecutor(
+            max_workers=PDF_PAGE_WORKERS, mp_context=ctx
+        )
+    return _page_pool
+
+
+def _page_strategy(page: fitz.Page) -> str:
+    """Pick the cheapest strategy that extracts a page fully.
+
+    Pages with a text layer and no figures or tables only
+    need their text layer extracted. Scanned pages, and pages
+    with images or many vector drawings (tables, charts), go
+    through layout detection and OCR.
+    """
+    if not PDF_ADAPTIVE_STRATEGY:
+        return HI_RES
+
+    if len(page.get_text("text").strip()) < PDF_MIN_TEXT_CHARS:
+        return HI_RES
+
+    page_area = abs(page.rect)
+    image_area = sum(
+        abs(fitz.Rect(image["bbox"]) & page.rect)
+        for image in page.get_image_info()
+    )
+    if page_area and image_area / page_area > PDF_MAX_IMAGE_AREA_RATIO:
+        return HI_RES
+
+    if len(page.get_drawings()) > PDF_MAX_DRAWINGS:
+        return HI_RES
+
+    return FAST
 
-def _get_pdf_thumbnail(data: bytes) -> bytes:
-    images = convert_from_bytes(data, first_page=1, last_page=1)
-    if not images:
-        raise EmptyPDF
-    thumb_io = BytesIO()
-    img = images[0]
-    img.save(thumb_io, format=ext_to_pil_fmt(IMG_EXT))
-    thumb_io.seek(0)
-    return thumb_io.getvalue()
+
+def _classify_pages(path: Path) -> List[str]:
+    with fitz.open(path) as pdf:
+        return [_page_strategy(page) for page in pdf]
+
+
+def _plan_tasks(
+    strategies: List[str], pages_per_task: int
+) -> List[Tuple[str, int, int]]:
+    """Group consecutive pages of the same strategy into
+    tasks of at most `pages_per_task` pages"""
+    tasks: List[Tuple[str, int, int]] = []
+    for page, strategy in enumerate(strategies, start=1):
+        if tasks:
+            prev_strategy, first, last = tasks[-1]
+            if prev_strategy == strategy and page - first < pages_per_task:
+                tasks[-1] = (strategy, first, page)
+                continue
+        tasks.append((strategy, page, page))
+    return tasks
+
+
+def _to_image_space(elem: PdfElement) -> None:
+    """Scale coordinates of a text-layer element from PDF
+    points to pixels of the page rendered for layout
+    detection, so they are in the same space as hi_res"""
+    coords = elem.metadata.coordinates
+    if coords is None or coords.system is None:
+        return
+    scale = PDF_IMAGE_DPI / 72
+    elem.metadata.coordinates = CoordinatesMetadata(
+        points=tuple((x * scale, y * scale) for x, y in coords.points),
+        system=PixelSpace(
+            width=coords.system.width * scale,
+            height=coords.system.height * scale,
+        ),
+    )
+
+
+def _partition_pages(
+    path: str, strategy: str, first_page: int, last_page: int, n_pages: int
+) -> List[PdfElement]:
+    """Partition pages `first_page` to `last_page` (inclusive,
+    1-indexed) of a PDF, numbering pages as in the whole PDF"""
+    with tempfile.NamedTemporaryFile(suffix=FileExt.PDF) as pages_file:
+        if first_page == 1 and last_page == n_pages:
+            pages_path = path
+        else:
+            reader = PdfReader(path)
+            writer = PdfWriter()
+            for i in range(first_page - 1, last_page):
+                writer.add_page(reader.pages[i])
+            writer.write(pages_file)
+            pages_file.flush()
+            pages_path = pages_file.name
+
+        # page workers are not labelled with the doc's file type
+        with METRICS.timer("partition_pdf", FileExt.PDF):
+            elems = partition_pdf(
+                filename=pages_path,
+                starting_page_number=first_page,
+                **PARTITION_KWARGS[strategy],
+            )
+
+    if strategy == FAST:
+        for elem in elems:
+            _to_image_space(elem)
+    METRICS.dump()  # page workers are not lane workers
+    return elems
+
+
+def _partition(path: Path) -> Iterable[PdfElement]:
+    """Partition a PDF into elements, in page order.
+
+    Pages are classified and grouped into tasks of up to
+    `PDF_PAGES_PER_TASK` pages of the same strategy. Tasks of
+    large PDFs are partitioned in parallel, and even without
+    page workers, their elements are yielded task by task,
+    rather than once every page is partitioned. Layout
+    detection and OCR are done page by page, so this yields
+    the same elements, with the same page numbers, as a
+    single call.
+    """
+    with METRICS.timer("classify_pages"):
+        strategies = _classify_pages(path)
+    for strategy in (HI_RES, FAST):
+        METRICS.inc(
+            "preprocessor_pdf_pages_total",
+            strategies.count(strategy),
+            strategy=strategy,
+        )
+    logger.info(
+        f"Partitioning {path.name}: "
+        f"{strategies.count(HI_RES)} {HI_RES} pages, "
+        f"{strategies.count(FAST)} {FAST} pages"
+    )
+
+    n_pages = len(strategies)
+    if n_pages < PDF_PARALLEL_MIN_PAGES:
+        tasks = _plan_tasks(strategies, pages_per_task=n_pages)
+    else:
+        tasks = _plan_tasks(strategies, PDF_PAGES_PER_TASK)
+
+    if PDF_PAGE_WORKERS <= 1 or n_pages < PDF_PARALLEL_MIN_PAGES:
+        results: Iterable[List[PdfElement]] = (
+            _partition_pages(str(path), *task, n_pages) for task in tasks
+        )
+    else:
+        results = _get_page_pool().map(
+            _partition_pages,
+            [str(path)] * len(tasks),
+            *zip(*tasks),
+            [n_pages] * len(tasks),
+        )
+    return (elem for elems in results for elem in elems)
 
 
 class PdfProcessor(AbstractProcessor):
+    thumb_source = "pdf"
 
     def __init__(
-        self, data: bytes, file_ext: FileExt = FileExt.PDF, *args, **kwargs
+        self, data: DocData, file_ext: FileExt = FileExt.PDF, *args, **kwargs
     ):
         super().__init__(data, file_ext, *args, **kwargs)
 
+    @classmethod
+    def warm_up(cls) -> None:
+        _warm_up_models()
+        if PDF_PAGE_WORKERS > 1:
+            # start a page worker, and the server it is forked
+            # off, which loads the models first
+            _get_page_pool().submit(int).result()
+
     def __call__(self) -> Iterator[Unit]:
+        first_page = _render_first_page(self._path())
+        if first_page is None:
+            raise EmptyPDF
+
         # doc thumbnail
-        doc_thumb = _get_pdf_thumbnail(self._data)
-        doc_thumb = resize_to_thumb(doc_thumb)
+        doc_thumb = self._thumbs.thumb(first_page)
         yield Unit(
             seq=0,
             data=doc_thumb,
             type=Asset.DOC_THUMBNAIL,
-            file_ext=IMG_EXT,
+            file_ext=self._thumbs.ext,
         )
 
         # extract elements
         seq = 1
-        chunks = partition_pdf(
-            file=BytesIO(self._data),
-            infer_table_structure=True,
-            strategy="hi_res",
-            extract_image_block_types=list(IMAGE_TYPES.keys()),
-            extract_image_block_to_payload=True,
-        )
+        chunks = _partition(self._path())
 
         for chunk in chunks:
             # image and plot elements
-            if elem_type := IMAGE_TYPES.get(chunk.category):
+            elem_type = IMAGE_TYPES.get(chunk.category)
+            if elem_type and chunk.metadata.image_base64:
                 meta = chunk.metadata
                 ext = MIME_TYPE_TO_EXT[cast(str, meta.image_mime_type)]
                 img = base64.b64decode(cast(str, meta.image_base64))
@@ -94,9 +313,9 @@ class PdfProcessor(AbstractProcessor):
                 )
                 yield Unit(
                     seq=seq,
-                    data=resize_to_thumb(img),
+                    data=self._thumbs.thumb(img),
                     type=Asset.ELEM_THUMBNAIL,
-                    file_ext=IMG_EXT,
+                    file_ext=self._thumbs.ext,
                 )
                 seq += 1
 
@@ -0,0 +1,9 @@
+"""Loads the models of `PdfProcessor` on import.
+
+Preloaded by the server that PDF page workers are forked off,
+so that they start with the models loaded, and share them.
+"""
+
+from processors.pdf import _warm_up_models
+
+_warm_up_models()
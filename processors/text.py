@@ -1,50 +1,73 @@
-from typing import Iterator
+from typing import Iterator, List, Optional
 
 from event_core.domain.types import Element, FileExt
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from config import TEXT_CHUNK_MIN_SIZE, TEXT_CHUNK_OVERLAP, TEXT_CHUNK_SIZE
 from processors.base import AbstractProcessor
-from processors.common import Unit
+from processors.chunking import Buffer, StreamingTextSplitter, check_utf8
+from processors.common import DocData, Unit
+
+TEXT_SPLITTER = StreamingTextSplitter(
+    chunk_size=TEXT_CHUNK_SIZE - TEXT_CHUNK_MIN_SIZE,
+    chunk_overlap=TEXT_CHUNK_OVERLAP,
+    separators=["\n\n", "\n", ". ", ",", " ", ""],
+    keep_separator="end",
+)
+
+
+def chunk_text(
+    text: Buffer,
+    is_ascii: bool = False,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Iterator[bytes]:
+    """Chunks of `text[start:end]`, of at least
+    `TEXT_CHUNK_MIN_SIZE` chars except for the last, stripped.
+
+    Chunks of `TEXT_SPLITTER` are accumulated as spans of the
+    text, sliced out once. They only overlap if
+    `TEXT_CHUNK_OVERLAP` is set.
+    """
+    spans = TEXT_SPLITTER.split_spans(text, is_ascii, start, end)
+    parts: List[bytes] = []
+    end = start
+    n_chars = 0
+    for chunk_start, chunk_end, chunk_len in spans:
+        if chunk_start != end:
+            parts.append(text[start:end])
+            start = chunk_start
+        end = chunk_end
+        n_chars += chunk_len
+        if n_chars >= TEXT_CHUNK_MIN_SIZE:
+            parts.append(text[start:end])
+            yield b"".join(parts).strip()
+            parts = []
+            start = end
+            n_chars = 0
+
+    # str.strip() also strips non-ASCII whitespace
+    parts.append(text[start:end])
+    if rest := b"".join(parts).decode("utf-8").strip():
+        yield rest.encode("utf-8")
 
 
 class TextProcessor(AbstractProcessor):
+    """Chunks text as it is read, so that a large doc is
+    never held in memory, whole or as a list of chunks"""
 
     def __init__(
-        self, data: bytes, file_ext: FileExt = FileExt.TXT, *args, **kwargs
+        self, data: DocData, file_ext: FileExt = FileExt.TXT, *args, **kwargs
     ):
         super().__init__(data, file_ext, *args, **kwargs)
-        self._text = data.decode("utf-8")
+        self._text = self._map()
+        self._is_ascii = check_utf8(self._text)
 
     def __call__(self) -> Iterator[Unit]:
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=TEXT_CHUNK_SIZE - TEXT_CHUNK_MIN_SIZE,
-            chunk_overlap=TEXT_CHUNK_OVERLAP,
-            length_function=len,
-            separators=["\n\n", "\n", ". ", ",", " ", ""],
-            is_separator_regex=False,
-            keep_separator="end",
-            strip_whitespace=False,
-        )
-        texts = splitter.split_text(self._text)
-        accumulated = ""
-        seq = 1
-        for doc in texts:
-            accumulated += doc
-            if len(accumulated) >= TEXT_CHUNK_MIN_SIZE:
-                yield Unit(
-                    seq=seq,
-                    data=accumulated.encode("utf-8").strip(),
-                    type=Element.TEXT,
-                    file_ext=FileExt.TXT,
-                )
-                seq += 1
-                accumulated = ""
-
-        if accumulated := accumulated.strip():
+        chunks = chunk_text(self._text, self._is_ascii)
+        for seq, chunk in enumerate(chunks, start=1):
             yield Unit(
                 seq=seq,
-                data=accumulated.encode("utf-8"),
+                data=chunk,
                 type=Element.TEXT,
                 file_ext=FileExt.TXT,
             )
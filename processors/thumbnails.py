@@ -0,0 +1,68 @@
+import hashlib
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, Iterable, List, Optional, Union
+
+from event_core.domain.types import FileExt
+from PIL import Image
+
+from config import THUMB_WORKERS
+from metrics import METRICS
+from processors.common import ThumbFormat, resize_to_thumb
+
+
+class ThumbnailEngine:
+    """Generates the thumbnails of a doc.
+
+    Thumbnails are memoized by the content of their source
+    image, so an image that appears more than once in a doc
+    (e.g., as both the doc and the element of an image doc,
+    or a logo on every page of a PDF) is only resized and
+    encoded once. Batches are resized and encoded on a pool
+    of threads, as PIL releases the GIL while doing so.
+
+    All thumbnails are encoded in `thumb_fmt`, whose file
+    extension is exposed as `ext` for the thumbnail units.
+    """
+
+    def __init__(self, thumb_fmt: ThumbFormat, n_workers: int = THUMB_WORKERS):
+        self._thumb_fmt = thumb_fmt
+        self._n_workers = n_workers
+        self._executor: Optional[Executor] = None
+        self._memo: Dict[bytes, bytes] = {}
+
+    @property
+    def ext(self) -> FileExt:
+        return self._thumb_fmt.ext
+
+    def _resize(self, image: Union[bytes, Image.Image]) -> bytes:
+        with METRICS.timer("resize_to_thumb"):
+            return resize_to_thumb(image, self._thumb_fmt)
+
+    def thumb(self, image: Union[bytes, Image.Image]) -> bytes:
+        if isinstance(image, Image.Image):
+            return self._resize(image)
+
+        key = hashlib.blake2b(image, digest_size=16).digest()
+        if key not in self._memo:
+            self._memo[key] = self._resize(image)
+        return self._memo[key]
+
+    def thumbs(
+        self, images: Iterable[Union[bytes, Image.Image]]
+    ) -> List[bytes]:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._n_workers, thread_name_prefix="thumbnails"
+            )
+        # in the context of the caller, for metrics labels
+        futures = [
+            self._executor.submit(copy_context().run, self.thumb, image)
+            for image in images
+        ]
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._memo.clear()
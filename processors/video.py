@@ -1,15 +1,33 @@
+import itertools
 import tempfile
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, List, Optional, Tuple
 
 import cv2
 from event_core.adapters.services.meta import Meta
 from event_core.domain.types import Asset, Element, FileExt
-from scenedetect import AdaptiveDetector, detect, video_splitter  # type: ignore
+from scenedetect import (  # type: ignore
+    AdaptiveDetector,
+    FrameTimecode,
+    SceneManager,
+    open_video,
+    video_splitter,
+)
 
-from config import IMG_EXT
+from config import (
+    IMG_EXT,
+    THUMB_BATCH_SIZE,
+    VIDEO_DETECT_DOWNSCALE,
+    VIDEO_DETECT_FRAME_SKIP,
+    VIDEO_DETECT_WINDOW_SECONDS,
+    VIDEO_KEYFRAME_MODE,
+    VIDEO_MAX_SCENES,
+    VIDEO_SCENE_TOLERANCE_SECONDS,
+    VIDEO_SEEK_MIN_FRAMES,
+)
+from metrics import METRICS
 from processors.base import AbstractProcessor
-from processors.common import Unit, resize_to_thumb
+from processors.common import Unit
 from processors.exceptions import (
     FrameReadError,
     UnableToOpenVideo,
@@ -36,30 +54,190 @@ def _extract_first_frame(
         cap.release()
 
 
+Scene = Tuple[FrameTimecode, FrameTimecode]
+
+
+def _sample_scenes(
+    start: FrameTimecode, n_frames: int, n_scenes: int
+) -> List[Scene]:
+    bounds = [start + n_frames * i // n_scenes for i in range(n_scenes + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _scene_manager(
+    frame_rate: float,
+    downscale: Optional[int],
+    frame_skip: int,
+    tolerance: float,
+) -> Tuple[SceneManager, int]:
+    """A scene manager, and the frame skip capped to keep
+    boundaries within `tolerance` seconds"""
+    max_skip = max(0, int(tolerance * frame_rate) - 1)
+    manager = SceneManager()
+    if downscale:
+        manager.auto_downscale = False
+        manager.downscale = downscale
+    manager.add_detector(AdaptiveDetector())
+    return manager, min(frame_skip, max_skip)
+
+
+def detect_scenes(
+    video_path: str,
+    downscale: Optional[int] = VIDEO_DETECT_DOWNSCALE,
+    frame_skip: int = VIDEO_DETECT_FRAME_SKIP,
+    max_scenes: Optional[int] = VIDEO_MAX_SCENES,
+    tolerance: float = VIDEO_SCENE_TOLERANCE_SECONDS,
+) -> List[Scene]:
+    """Detect scenes of a video, trading accuracy for speed.
+
+    Frames are downscaled by `downscale` before analysis (by
+    default, a factor is picked from the video's width), and
+    `frame_skip` frames are skipped without being decoded
+    after every analysed frame. Frame skipping is capped so
+    that boundaries stay within `tolerance` seconds of the
+    ones found when analysing every frame.
+
+    If more than `max_scenes` scenes are found, the cuts are
+    deemed unreliable, and the video is sampled into
+    `max_scenes` evenly spaced scenes instead.
+    """
+    video = open_video(video_path)
+    manager, frame_skip = _scene_manager(
+        video.frame_rate, downscale, frame_skip, tolerance
+    )
+    manager.detect_scenes(video, frame_skip=frame_skip)
+    scenes = manager.get_scene_list()
+
+    if max_scenes and len(scenes) > max_scenes:
+        start, end = scenes[0][0], scenes[-1][1]
+        n_frames = end.get_frames() - start.get_frames()
+        return _sample_scenes(start, n_frames, max_scenes)
+    return scenes
+
+
+def iter_scene_starts(
+    video_path: str,
+    window_seconds: float = VIDEO_DETECT_WINDOW_SECONDS,
+    downscale: Optional[int] = VIDEO_DETECT_DOWNSCALE,
+    frame_skip: int = VIDEO_DETECT_FRAME_SKIP,
+    max_scenes: Optional[int] = VIDEO_MAX_SCENES,
+    tolerance: float = VIDEO_SCENE_TOLERANCE_SECONDS,
+) -> Iterator[List[FrameTimecode]]:
+    """Detect scenes as `detect_scenes` does, but `window_seconds`
+    of the video at a time, yielding the starts of the scenes
+    found in each window as soon as it has been analysed. The
+    first scene starts with the video.
+
+    Scenes of earlier windows are yielded already by the time
+    more than `max_scenes` scenes are found, so only the rest
+    of the video is sampled instead, as evenly spaced as
+    `max_scenes` scenes over the whole video would be.
+    """
+    video = open_video(video_path)
+    manager, frame_skip = _scene_manager(
+        video.frame_rate, downscale, frame_skip, tolerance
+    )
+    yield [video.base_timecode]
+    n_starts = 1
+    while manager.detect_scenes(
+        video, duration=float(window_seconds), frame_skip=frame_skip
+    ):
+        # no scenes until the first cut, then the first one
+        # starts with the video
+        starts = [start for start, _ in manager.get_scene_list()]
+        if max_scenes and len(starts) > max_scenes:
+            yield starts[n_starts:max_scenes]
+            last, n_frames = (
+                starts[max_scenes - 1],
+                video.duration.get_frames(),
+            )
+            step = max(1, n_frames // max_scenes)
+            n_rest = (n_frames - last.get_frames() - 1) // step
+            yield [last + step * i for i in range(1, n_rest + 1)]
+            return
+        yield starts[n_starts:]
+        n_starts = max(n_starts, len(starts))
+
+
+class _FrameReader:
+    """Reads frames of a video in ascending order of frame
+    number, over any number of calls to `read`, in a single
+    pass over a single capture of the video. Frames far enough
+    ahead are seeked to, nearer frames are reached by grabbing
+    (without decoding) the frames in between."""
+
+    def __init__(self, video_path: str):
+        self._video_path = video_path
+        self._cap = cv2.VideoCapture(video_path)
+        if not self._cap.isOpened():
+            self._cap.release()
+            raise UnableToOpenVideo(f"Video {video_path} could not be opened")
+        self._pos = 0
+
+    def __enter__(self) -> "_FrameReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._cap.release()
+
+    def read(
+        self, frame_nums: List[int], frame_ext: FileExt = IMG_EXT
+    ) -> Iterator[bytes]:
+        for frame_num in frame_nums:
+            ahead = frame_num - self._pos
+            if ahead >= VIDEO_SEEK_MIN_FRAMES or ahead < 0:
+                self._seek(frame_num)
+            else:
+                for _ in range(ahead):
+                    self._cap.grab()
+
+            success, frame = self._cap.read()
+            if not success:
+                raise FrameReadError(
+                    f"Could not read frame {frame_num} of video "
+                    f"{self._video_path}"
+                )
+            self._pos = frame_num + 1
+            _, buffer = cv2.imencode(frame_ext, frame)
+            yield buffer.tobytes()
+
+    def _seek(self, frame_num: int) -> None:
+        """Seek to `frame_num`. Seeking can land on a nearby
+        keyframe instead, so if it lands past the frame, an
+        earlier frame is seeked to, and the frames up to
+        `frame_num` are grabbed"""
+        target = frame_num
+        while True:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            pos = int(self._cap.get(cv2.CAP_PROP_POS_FRAMES))
+            if pos <= frame_num or target == 0:
+                break
+            target = max(0, target - VIDEO_SEEK_MIN_FRAMES)
+        for _ in range(frame_num - pos):
+            self._cap.grab()
+
+
 class VideoProcessor(AbstractProcessor):
+    thumb_source = "video"
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
-        # persist video to temp file
-        self._temp_file = tempfile.NamedTemporaryFile(suffix=self._file_ext)
-        self._temp_file_path = self._temp_file.name
-        with open(self._temp_file_path, "wb") as vid_file:
-            vid_file.write(self._data)
+        # videos are read from disk, spool doc if not already there
+        self._temp_file_path = str(self._path())
 
     def __call__(self) -> Iterator[Unit]:
         yield Unit(
             seq=0,
             data=self._get_thumb(),
             type=Asset.DOC_THUMBNAIL,
-            file_ext=IMG_EXT,
+            file_ext=self._thumbs.ext,
         )
         yield from self._chunk()
 
     def _process_scene(
-        self, seq: int, seconds: float, video_path: str
+        self, seq: int, seconds: float, frame: bytes, thumb: bytes
     ) -> Iterator[Unit]:
-        frame = _extract_first_frame(video_path, IMG_EXT)
         yield Unit(
             seq=seq,
             data=frame,
@@ -69,24 +247,57 @@ class VideoProcessor(AbstractProcessor):
         )
         yield Unit(
             seq=seq,
-            data=resize_to_thumb(frame),
+            data=thumb,
             type=Asset.ELEM_THUMBNAIL,
-            file_ext=IMG_EXT,
+            file_ext=self._thumbs.ext,
         )
 
     def _chunk(self) -> Iterator[Unit]:
-        scene_list = detect(self._temp_file_path, AdaptiveDetector())
+        if VIDEO_KEYFRAME_MODE == "seek":
+            yield from self._chunk_by_seeking()
+        else:
+            with METRICS.timer("detect_scenes"):
+                scene_list = detect_scenes(self._temp_file_path)
+            yield from self._chunk_by_splitting(scene_list)
 
+    def _chunk_by_seeking(self) -> Iterator[Unit]:
+        # first frame of each scene, read from the original video
+        # as soon as the window of the video it is in is analysed
+        windows = METRICS.timed(
+            iter_scene_starts(self._temp_file_path), "detect_scenes"
+        )
+        seq = 0
+        with _FrameReader(self._temp_file_path) as reader:
+            for starts in windows:
+                frames = reader.read(
+                    [start.get_frames() for start in starts], IMG_EXT
+                )
+                scenes = zip(starts, frames)
+                # thumbnail scenes in batches, in parallel
+                while batch := list(
+                    itertools.islice(scenes, THUMB_BATCH_SIZE)
+                ):
+                    thumbs = self._thumbs.thumbs(frame for _, frame in batch)
+                    for (start, frame), thumb in zip(batch, thumbs):
+                        seq += 1
+                        yield from self._process_scene(
+                            seq, start.get_seconds(), frame, thumb
+                        )
+
+    def _chunk_by_splitting(self, scene_list: List[Scene]) -> Iterator[Unit]:
+        # first frame of each scene, read from a split video per scene
         with tempfile.TemporaryDirectory() as temp_dir:
             # split video into scenes
             if video_splitter.is_ffmpeg_available():
-                video_splitter.split_video_ffmpeg(
-                    self._temp_file_path, scene_list, output_dir=temp_dir
-                )
+                with METRICS.timer("split_video_ffmpeg"):
+                    video_splitter.split_video_ffmpeg(
+                        self._temp_file_path, scene_list, output_dir=temp_dir
+                    )
             elif video_splitter.is_mkvmerge_available():
-                video_splitter.split_video_mkvmerge(
-                    self._temp_file_path, scene_list, output_dir=temp_dir
-                )
+                with METRICS.timer("split_video_mkvmerge"):
+                    video_splitter.split_video_mkvmerge(
+                        self._temp_file_path, scene_list, output_dir=temp_dir
+                    )
             else:
                 raise VideoSplitterUnavailable(
                     "Neither ffmpeg nor mkvmerge found. Try:\n"
@@ -100,17 +311,18 @@ class VideoProcessor(AbstractProcessor):
                     # E.g., tmpazhewchn-Scene-001.mp4
                     scene_idx = int(video_path.stem.rsplit("-", 1)[1]) - 1
                     scene_seconds = scene_list[scene_idx][0].get_seconds()
+                    frame = _extract_first_frame(str(video_path), IMG_EXT)
+                    thumb = self._thumbs.thumb(frame)
                     yield from self._process_scene(
-                        seq, scene_seconds, str(video_path)
+                        seq, scene_seconds, frame, thumb
                     )
             else:
                 # single scene video
-                yield from self._process_scene(1, 0, self._temp_file_path)
+                frame = _extract_first_frame(self._temp_file_path, IMG_EXT)
+                thumb = self._thumbs.thumb(frame)
+                yield from self._process_scene(1, 0, frame, thumb)
 
     def _get_thumb(self) -> bytes:
         frame = _extract_first_frame(self._temp_file_path)
-        frame_thumb = resize_to_thumb(frame)
+        frame_thumb = self._thumbs.thumb(frame)
         return frame_thumb
-
-    def __exit__(self, *_):
-        self._temp_file.close()
@@ -0,0 +1,185 @@
+"""Opt-in profiling of docs in production.
+
+While a doc is processed, a sampler thread records the stack of
+the thread processing it every `PROFILE_INTERVAL_SECONDS`. The
+profile is saved if the doc took longer than
+`PROFILE_SLOW_SECONDS`, or if the doc was picked at random, with
+probability `PROFILE_SAMPLE_RATE`, and dropped otherwise. As the
+profiled thread is only interrupted by a sample, overhead is
+bounded by the interval, whether or not a profile is saved.
+
+Profiles are saved to `PROFILE_DIR` in the folded format of
+flamegraph.pl and speedscope (one `frame;frame;... count` line
+per stack), next to a JSON file of the doc key, file type, size
+and latency. Only the latest `PROFILE_MAX_PROFILES` are kept.
+"""
+
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Dict, Iterator, List, Optional
+
+from config import (
+    PROFILE_DIR,
+    PROFILE_INTERVAL_SECONDS,
+    PROFILE_MAX_PROFILES,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_SLOW_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StackSampler:
+    """Counts the stacks of a thread, sampled every `interval`
+    seconds, as folded stacks"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._labels: Dict[CodeType, str] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler", daemon=True
+        )
+        self.stacks: Counter[str] = Counter()
+
+    def _label(self, code: CodeType) -> str:
+        if (label := self._labels.get(code)) is None:
+            label = self._labels[code] = (
+                f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+            )
+        return label
+
+    def _fold(self, frame: Optional[FrameType]) -> str:
+        labels: List[str] = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            if frame := sys._current_frames().get(self._thread_id):
+                self.stacks[self._fold(frame)] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+
+@dataclass
+class DocProfile:
+    doc_key: str
+    file_ext: str
+    size_bytes: Optional[int] = None
+    seconds: float = 0.0
+    # "slow" or "sampled"
+    reason: Optional[str] = None
+    interval: float = PROFILE_INTERVAL_SECONDS
+    n_samples: int = 0
+    stacks: Counter[str] = field(default_factory=Counter)
+
+
+class DocProfiler:
+    """Profiles docs that are slower than `slow_seconds`, and a
+    `sample_rate` fraction of all docs, to `profile_dir`"""
+
+    def __init__(
+        self,
+        profile_dir: Path = PROFILE_DIR,
+        slow_seconds: Optional[float] = PROFILE_SLOW_SECONDS,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        interval: float = PROFILE_INTERVAL_SECONDS,
+        max_profiles: int = PROFILE_MAX_PROFILES,
+    ):
+        self._dir = profile_dir
+        self._slow_seconds = slow_seconds
+        self._sample_rate = sample_rate
+        self._interval = interval
+        self._max_profiles = max_profiles
+
+    @property
+    def enabled(self) -> bool:
+        return self._slow_seconds is not None or self._sample_rate > 0
+
+    @contextmanager
+    def profile(self, doc_key: str, file_ext: str) -> Iterator[DocProfile]:
+        """Profile the calling thread. The size of the doc may be
+        set on the yielded profile once it is known"""
+        profile = DocProfile(doc_key, str(file_ext), interval=self._interval)
+        if not self.enabled:
+            yield profile
+            return
+
+        sampled = random.random() < self._sample_rate
+        sampler = StackSampler(threading.get_ident(), self._interval)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield profile
+        finally:
+            sampler.stop()
+            profile.seconds = time.perf_counter() - start
+            if (
+                self._slow_seconds is not None
+                and profile.seconds > self._slow_seconds
+            ):
+                profile.reason = "slow"
+            elif sampled:
+                profile.reason = "sampled"
+            if profile.reason is not None:
+                profile.stacks = sampler.stacks
+                profile.n_samples = sum(sampler.stacks.values())
+                self._save(profile)
+
+    def _save(self, profile: DocProfile) -> None:
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        info = {k: v for k, v in asdict(profile).items() if k != "stacks"}
+        try:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            (self._dir / f"{name}.folded").write_text(
+                "".join(
+                    f"{stack} {count}\n"
+                    for stack, count in profile.stacks.most_common()
+                )
+            )
+            # written last, as profiles are listed by their info
+            (self._dir / f"{name}.json").write_text(json.dumps(info))
+        except OSError as e:
+            logger.warning(
+                f"Failed to save profile of {profile.doc_key}. Error: {e}"
+            )
+            return
+        logger.info(
+            f"Saved {profile.reason} profile of {profile.doc_key}"
+            f" ({profile.seconds:.1f}s) as {name}"
+        )
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self._dir.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue  # evicted by another worker
+        entries.sort()
+        for _, path in entries[: max(0, len(entries) - self._max_profiles)]:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".folded").unlink(missing_ok=True)
+
+
+PROFILER = DocProfiler()
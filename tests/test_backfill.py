@@ -0,0 +1,120 @@
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from event_core.domain.events import DocStored
+
+import backfill as backfill_module
+from backfill import Checkpoint, backfill, list_doc_keys, read_manifest
+from workers import DocWorkerPool, WorkerMode
+
+
+def _backfill(keys: List[str], checkpoint_path: Path) -> List[str]:
+    processed: List[str] = []
+    lock = threading.Lock()
+
+    def callback(event: DocStored) -> None:
+        with lock:
+            processed.append(event.key)
+
+    checkpoint = Checkpoint(checkpoint_path)
+    with DocWorkerPool(callback, 4, WorkerMode.THREAD) as pool:
+        backfill(keys, pool.submit, checkpoint, max_in_flight=3)
+    return processed
+
+
+def test_backfill_processes_docs_once(tmp_path: Path) -> None:
+    keys = [f"docs/{i:02}.txt" for i in range(20)]
+    checkpoint_path = tmp_path / "checkpoint.json"
+
+    assert sorted(_backfill(keys, checkpoint_path)) == keys
+    assert _backfill(keys, checkpoint_path) == []
+    assert _backfill(keys + ["docs/new.txt"], checkpoint_path) == [
+        "docs/new.txt"
+    ]
+
+
+def test_checkpoint_resumes_after_last_contiguous_doc(tmp_path: Path) -> None:
+    checkpoint = Checkpoint(tmp_path / "checkpoint.json")
+    for i, key in enumerate(["a.txt", "b.txt", "c.txt", "d.txt"]):
+        checkpoint.submitted(i, key)
+    checkpoint.mark_done(0)
+    checkpoint.mark_done(2)
+    checkpoint.save()
+
+    assert Checkpoint(tmp_path / "checkpoint.json").last_key == "a.txt"
+
+
+def test_manifest_keys_are_sorted_and_unique(tmp_path: Path) -> None:
+    manifest = tmp_path / "keys.txt"
+    manifest.write_text("b.txt\n\na.txt\nb.txt\n")
+
+    assert read_manifest(manifest) == ["a.txt", "b.txt"]
+
+
+def _list_page_of(keys: List[str], pages: List[Optional[str]]):
+    def list_page(
+        prefix: str, start_after: Optional[str], limit: int
+    ) -> List[str]:
+        pages.append(start_after)
+        listed = [
+            key
+            for key in sorted(keys)
+            if key.startswith(prefix)
+            and (start_after is None or key > start_after)
+        ]
+        return listed[:limit]
+
+    return list_page
+
+
+def test_listing_leaves_out_units_and_unserved_types(monkeypatch) -> None:
+    monkeypatch.setattr(backfill_module, "BACKFILL_LIST_PAGE_SIZE", 2)
+    keys = [
+        "user/doc.pdf",
+        "user/doc/1__TEXT.txt",
+        "user/doc/0__DOC_THUMBNAIL.jpg",
+        "user/notes.md",
+        "user/archive.zip",
+        "other/doc.txt",
+    ]
+    pages: List[Optional[str]] = []
+
+    listed = list_doc_keys("user/", list_page=_list_page_of(keys, pages))
+
+    assert list(listed) == ["user/doc.pdf", "user/notes.md"]
+    assert pages == [None, "user/doc.pdf", "user/doc/1__TEXT.txt"]
+
+
+def test_listed_docs_are_submitted_as_pages_are_listed(
+    tmp_path: Path, monkeypatch
+) -> None:
+    monkeypatch.setattr(backfill_module, "BACKFILL_LIST_PAGE_SIZE", 2)
+    keys = [f"user/{i}.txt" for i in range(6)]
+    pages: List[Optional[str]] = []
+    n_pages_by_doc: Dict[str, int] = {}
+
+    def submit(event: DocStored) -> Future:
+        n_pages_by_doc[event.key] = len(pages)
+        future: Future = Future()
+        future.set_result(None)
+        return future
+
+    checkpoint_path = tmp_path / "checkpoint.json"
+    checkpoint_path.write_text('{"last_key": "user/1.txt"}')
+    checkpoint = Checkpoint(checkpoint_path)
+    listed = list_doc_keys(
+        "user/",
+        start_after=checkpoint.last_key,
+        list_page=_list_page_of(keys, pages),
+    )
+    backfill(listed, submit, checkpoint)
+
+    assert n_pages_by_doc == {
+        "user/2.txt": 1,
+        "user/3.txt": 1,
+        "user/4.txt": 2,
+        "user/5.txt": 2,
+    }
+    assert Checkpoint(checkpoint_path).last_key == "user/5.txt"
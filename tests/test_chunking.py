@@ -0,0 +1,138 @@
+import random
+from pathlib import Path
+from typing import List
+
+import pytest
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from config import CODE_CHUNK_SIZE, TEXT_CHUNK_MIN_SIZE, TEXT_CHUNK_SIZE
+from processors import chunking
+from processors.chunking import StreamingTextSplitter
+from processors.code import CODE_SPLITTER
+from processors.text import TextProcessor
+
+TEXT_SEPARATORS = ["\n\n", "\n", ". ", ",", " ", ""]
+
+
+def _random_text(seed: int, n_tokens: int = 2000) -> str:
+    tokens = ["lorem", "ipsum", "é", "字", "😀", " ", "\n", "\n\n", ". ", ","]
+    rng = random.Random(seed)
+    return "".join(rng.choices(tokens, k=n_tokens))
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("chunk_size", (20, 250))
+@pytest.mark.parametrize("keep_separator", ("start", "end"))
+def test_chunks_match_recursive_character_splitter(
+    seed: int, chunk_size: int, keep_separator: str
+) -> None:
+    text = _random_text(seed)
+    expected = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=0,
+        separators=TEXT_SEPARATORS,
+        keep_separator=keep_separator,  # type: ignore
+        strip_whitespace=False,
+    ).split_text(text)
+
+    splitter = StreamingTextSplitter(
+        TEXT_SEPARATORS, chunk_size, keep_separator=keep_separator
+    )
+    chunks: List[str] = [
+        chunk.decode("utf-8") for chunk in splitter.split(text.encode())
+    ]
+    assert chunks == expected
+
+
+@pytest.mark.parametrize("chunk_overlap", (0, 5))
+def test_chunks_match_across_cut_windows(
+    chunk_overlap: int, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(chunking, "_CUT_WINDOW", 16)
+    text = _random_text(seed=0)
+    expected = RecursiveCharacterTextSplitter(
+        chunk_size=20,
+        chunk_overlap=chunk_overlap,
+        separators=TEXT_SEPARATORS,
+        keep_separator="end",
+        strip_whitespace=False,
+    ).split_text(text)
+
+    splitter = StreamingTextSplitter(TEXT_SEPARATORS, 20, chunk_overlap)
+    chunks = [chunk.decode("utf-8") for chunk in splitter.split(text.encode())]
+    assert chunks == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chunks_match_with_ascii_and_non_ascii_paragraphs(
+    seed: int, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(chunking, "_CUT_WINDOW", 256)
+    rng = random.Random(seed)
+    words = ["lorem"] * 10 + ["ipsum."]
+    paragraphs = [
+        " ".join(rng.choices(words + ["é", "字"] * (k % 2), k=30))
+        for k in range(50)
+    ]
+    text = "\n\n".join(paragraphs)
+    expected = RecursiveCharacterTextSplitter(
+        chunk_size=50,
+        chunk_overlap=0,
+        separators=TEXT_SEPARATORS,
+        keep_separator="end",
+        strip_whitespace=False,
+    ).split_text(text)
+
+    splitter = StreamingTextSplitter(TEXT_SEPARATORS, 50)
+    chunks = [chunk.decode("utf-8") for chunk in splitter.split(text.encode())]
+    assert chunks == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_text_units_match_langchain_text_units(seed: int) -> None:
+    text = _random_text(seed)
+    expected = []
+    accumulated = ""
+    for doc in RecursiveCharacterTextSplitter(
+        chunk_size=TEXT_CHUNK_SIZE - TEXT_CHUNK_MIN_SIZE,
+        chunk_overlap=0,
+        separators=TEXT_SEPARATORS,
+        keep_separator="end",
+        strip_whitespace=False,
+    ).split_text(text):
+        accumulated += doc
+        if len(accumulated) >= TEXT_CHUNK_MIN_SIZE:
+            expected.append(accumulated.encode("utf-8").strip())
+            accumulated = ""
+    if accumulated := accumulated.strip():
+        expected.append(accumulated.encode("utf-8"))
+
+    units = TextProcessor(text.encode())()
+    assert [unit.data for unit in units] == expected
+
+
+def test_code_chunks_match_langchain_code_chunks() -> None:
+    lines = ["def f(x):", "    return x", "", "class A:", "    y = 字"]
+    code = "\n".join(random.Random(0).choices(lines, k=2000))
+    expected = RecursiveCharacterTextSplitter(
+        chunk_size=CODE_CHUNK_SIZE,
+        chunk_overlap=0,
+        separators=["\n\n", "\n"],
+        strip_whitespace=False,
+    ).split_text(code)
+
+    chunks = CODE_SPLITTER.split(code.encode())
+    assert [chunk.decode("utf-8") for chunk in chunks] == expected
+
+
+def test_text_doc_without_separators_is_chunked(tmp_path: Path) -> None:
+    path = tmp_path / "doc.txt"
+    path.write_text("x" * 10_000)
+    with TextProcessor(path) as processor:
+        units = list(processor())
+    assert b"".join(unit.data for unit in units) == b"x" * 10_000
+
+
+def test_invalid_utf8_text_doc_is_rejected() -> None:
+    with pytest.raises(UnicodeDecodeError):
+        TextProcessor(b"text \xff")
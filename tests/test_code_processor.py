@@ -0,0 +1,71 @@
+import ast
+import textwrap
+from typing import List
+
+from event_core.domain.types import FileExt
+
+from config import CODE_CHUNK_SIZE
+from processors.code import CODE_SPLITTER, CodeProcessor
+from processors.common import Unit, UnitMeta
+
+
+def _function(name: str, n_lines: int) -> str:
+    body = "".join(f"    {name}_{i} = {i}\n" for i in range(n_lines))
+    return f"# {name}\n@decorator\ndef {name}():\n{body}    return 0\n\n\n"
+
+
+def _units(code: str, file_ext: FileExt = FileExt.PY) -> List[Unit]:
+    return list(CodeProcessor(code.encode("utf-8"), file_ext)())
+
+
+def test_functions_are_packed_whole() -> None:
+    functions = [_function(f"f{i}", n_lines=10) for i in range(20)]
+    units = _units("".join(functions))
+
+    assert len(units) < len(functions)
+    for unit in units:
+        assert len(unit.data.decode("utf-8")) <= CODE_CHUNK_SIZE
+        ast.parse(unit.data)
+    for function in functions:
+        assert any(
+            function.strip() in unit.data.decode("utf-8") for unit in units
+        )
+
+
+def test_long_class_is_chunked_by_method() -> None:
+    methods = [_function(f"m{i}", n_lines=10) for i in range(10)]
+    code = "class A(Base):\n" + textwrap.indent("".join(methods), "    ")
+    units = _units(code)
+
+    assert units[0].data.startswith(b"class A(Base):\n    # m0\n")
+    for method in methods:
+        method = textwrap.indent(method.strip(), "    ")
+        assert any(method in unit.data.decode("utf-8") for unit in units)
+
+
+def test_long_function_is_split_by_lines() -> None:
+    function = _function("f", n_lines=200)
+    units = _units(function)
+
+    assert len(units) > 1
+    assert b"".join(unit.data for unit in units) == function.encode().strip()
+
+
+def test_unparsable_code_falls_back_to_splitter() -> None:
+    code = _function("f", n_lines=100).replace("def", "fn")
+    expected = [
+        chunk for chunk in CODE_SPLITTER.split(code.encode()) if chunk.strip()
+    ]
+
+    assert [unit.data for unit in _units(code)] == expected
+
+
+def test_units_have_their_line_range() -> None:
+    code = "".join(_function(f"f{i}", n_lines=20) for i in range(10))
+    lines = code.splitlines(keepends=True)
+    for unit in _units(code):
+        assert unit.meta
+        first, last = map(int, unit.meta[UnitMeta.LINES].split("-"))
+        assert unit.data.decode("utf-8").rstrip("\n") == "".join(
+            lines[first - 1 : last]
+        ).rstrip("\n")
@@ -1,13 +1,19 @@
 import re
 from io import BytesIO
 from pathlib import Path
+from typing import Dict, List, Tuple, cast
 
 import pytest
-from event_core.domain.types import Asset, Element
-from PIL import Image
+from event_core.adapters.services.meta import Meta
+from event_core.domain.types import Asset, Element, FileExt
+from PIL import Image, ImageChops, ImageStat
+from scenedetect import video_splitter  # type: ignore
 
 from config import THUMB_HEIGHT, THUMB_WIDTH
+from processors import video
 from processors.base import AbstractProcessor
+from processors.text import TextProcessor
+from processors.video import VideoProcessor
 
 
 def _to_alnum(s: str) -> str:
@@ -44,3 +50,53 @@ def test_text_doc_original_text_equals_chunks(
     ]
     concat_text = "".join(text_chunks)
     assert _to_alnum(original) == _to_alnum(concat_text)
+
+
+def test_text_doc_from_path_equals_text_doc_from_bytes(
+    txt_file_path: Path,
+) -> None:
+    from_bytes = list(TextProcessor(txt_file_path.read_bytes())())
+    with TextProcessor(txt_file_path) as processor:
+        from_path = list(processor())
+    assert from_path == from_bytes
+
+
+def test_spooled_video_doc_is_removed_on_exit(vid_file_path: Path) -> None:
+    with VideoProcessor(vid_file_path.read_bytes(), FileExt.MP4) as processor:
+        spooled_path = processor._path()
+        assert spooled_path.read_bytes() == vid_file_path.read_bytes()
+    assert not spooled_path.exists()
+
+
+@pytest.mark.skipif(
+    not video_splitter.is_ffmpeg_available(), reason="ffmpeg not installed"
+)
+def test_seeked_scene_frames_match_split_scene_frames(
+    vid_file_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def frames() -> List[Tuple[float, Image.Image]]:
+        with VideoProcessor(vid_file_path, FileExt.MP4) as processor:
+            return sorted(
+                (
+                    (
+                        cast(Dict, unit.meta)[Meta.FRAME_SECONDS],
+                        Image.open(BytesIO(unit.data)).convert("RGB"),
+                    )
+                    for unit in processor()
+                    if unit.type == Element.IMAGE
+                ),
+                key=lambda frame: frame[0],
+            )
+
+    monkeypatch.setattr(video, "VIDEO_KEYFRAME_MODE", "split")
+    split_frames = frames()
+    monkeypatch.setattr(video, "VIDEO_KEYFRAME_MODE", "seek")
+    seeked_frames = frames()
+
+    assert [seconds for seconds, _ in seeked_frames] == [
+        seconds for seconds, _ in split_frames
+    ]
+    for (_, seeked), (_, split) in zip(seeked_frames, split_frames):
+        # split scenes are re-encoded, so pixels differ slightly
+        diff = ImageStat.Stat(ImageChops.difference(seeked, split))
+        assert max(diff.mean) < 4
@@ -3,8 +3,8 @@ from collections import Counter
 import pytest
 from event_core.domain.types import Asset, Element, FileExt
 
-from config import IMG_EXT
 from processors.base import AbstractProcessor
+from processors.common import THUMB_FORMAT_BY_SOURCE
 
 
 def test_text_doc_generates_only_chunks(
@@ -35,17 +35,18 @@ def test_vid_doc_generates_chunks_with_thumbnails(
 
 
 @pytest.mark.parametrize(
-    "fixture_processor,chunk_file_ext",
+    "fixture_processor,chunk_file_ext,thumb_file_ext",
     (
-        ("txt_processor", FileExt.TXT),
-        ("img_processor", FileExt.JPG),
-        ("vid_processor", FileExt.PNG),
+        ("txt_processor", FileExt.TXT, None),
+        ("img_processor", FileExt.JPG, THUMB_FORMAT_BY_SOURCE["image"].ext),
+        ("vid_processor", FileExt.PNG, THUMB_FORMAT_BY_SOURCE["video"].ext),
     ),
 )
 def test_doc_generates_obj_with_correct_file_ext(
     fixture_processor: str,
     request: pytest.FixtureRequest,
     chunk_file_ext: FileExt,
+    thumb_file_ext: FileExt,
 ) -> None:
     processor: AbstractProcessor = request.getfixturevalue(fixture_processor)
     for unit in processor():
@@ -55,4 +56,4 @@ def test_doc_generates_obj_with_correct_file_ext(
             Asset.ELEM_THUMBNAIL,
             Asset.DOC_THUMBNAIL,
         ):
-            assert unit.file_ext == IMG_EXT
+            assert unit.file_ext == thumb_file_ext
@@ -6,9 +6,11 @@ from event_core.adapters.services.storage import FakeStorageClient, Payload
 from event_core.domain.events import DocStored
 from event_core.domain.types import Asset
 
-from app import _handle_doc_callback
+from app import _handle_doc_callback, _mark_doc_failed
 from bootstrap import DIContainer
-from processors.common import IMG_EXT
+from config import IMG_EXT
+from processors.common import THUMB_FORMAT_BY_SOURCE, UnitMeta
+from workers import DocTimeout
 
 
 def test_handle_mp4_doc_stored(
@@ -27,9 +29,10 @@ def test_handle_mp4_doc_stored(
     _handle_doc_callback(doc_stored_event)
 
     obj_key_prefix = vid_file_path.parent / vid_file_path.stem
+    thumb_ext = THUMB_FORMAT_BY_SOURCE["video"].ext
     chunk_key = str(obj_key_prefix / f"1__IMAGE{IMG_EXT}")
-    chunk_thumb_key = str(obj_key_prefix / f"1__ELEMENT_THUMBNAIL{IMG_EXT}")
-    doc_thumb_key = str(obj_key_prefix / f"0__DOCUMENT_THUMBNAIL{IMG_EXT}")
+    chunk_thumb_key = str(obj_key_prefix / f"1__ELEMENT_THUMBNAIL{thumb_ext}")
+    doc_thumb_key = str(obj_key_prefix / f"0__DOCUMENT_THUMBNAIL{thumb_ext}")
 
     assert Meta.DOC_THUMB in meta
     assert Meta.CHUNK_THUMB in meta
@@ -83,8 +86,9 @@ def test_handle_jpg_doc_stored(
     _handle_doc_callback(doc_stored_event)
 
     obj_key_prefix = img_file_path.parent / img_file_path.stem
+    thumb_ext = THUMB_FORMAT_BY_SOURCE["image"].ext
     chunk_key = str(obj_key_prefix / "1__IMAGE.jpg")
-    doc_thumb_key = str(obj_key_prefix / f"0__DOCUMENT_THUMBNAIL{IMG_EXT}")
+    doc_thumb_key = str(obj_key_prefix / f"0__DOCUMENT_THUMBNAIL{thumb_ext}")
 
     assert Meta.DOC_THUMB in meta
     assert Meta.PARENT in meta
@@ -93,3 +97,18 @@ def test_handle_jpg_doc_stored(
     assert doc_key in storage
     assert doc_thumb_key in storage
     assert chunk_key in storage
+
+
+def test_abandoned_doc_is_marked_failed_until_processed(
+    container: DIContainer,
+) -> None:
+    doc_key = "docs/notes.txt"
+    meta = cast(FakeMetaMapping, container.meta())
+    storage = cast(FakeStorageClient, container.storage())
+    storage[doc_key] = Payload(data=b"notes " * 100, type=Asset.DOC)
+
+    _mark_doc_failed(DocStored(key=doc_key), DocTimeout("Timed out"))
+    assert "Timed out" in meta[UnitMeta.FAILURE][doc_key]
+
+    _handle_doc_callback(DocStored(key=doc_key))
+    assert doc_key not in meta[UnitMeta.FAILURE]
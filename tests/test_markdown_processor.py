@@ -0,0 +1,90 @@
+from typing import List
+
+from event_core.domain.types import Element
+
+from processors.common import Unit, UnitMeta
+from processors.markdown import MarkdownProcessor
+
+DOC = b"""Intro.
+
+# Install
+
+Run:
+
+```bash
+pip install x
+```
+
+- with a fence in a list item:
+  ```python
+  def f():
+      return 1
+  ```
+
+## Usage ##
+
+Text under usage.
+
+Setext
+======
+
+    indented ``` code, not a fence
+
+~~~
+unclosed
+"""
+
+
+def _units(md: bytes) -> List[Unit]:
+    return list(MarkdownProcessor(md)())
+
+
+def test_blocks_are_chunked_by_type() -> None:
+    units = _units(DOC)
+
+    assert [unit.seq for unit in units] == list(range(1, len(units) + 1))
+    assert [(unit.type, unit.data) for unit in units] == [
+        (Element.TEXT, b"Intro."),
+        (Element.TEXT, b"# Install\n\nRun:"),
+        (Element.CODE, b"pip install x"),
+        (Element.TEXT, b"- with a fence in a list item:"),
+        (Element.CODE, b"  def f():\n      return 1"),
+        (Element.TEXT, b"## Usage ##\n\nText under usage."),
+        (
+            Element.TEXT,
+            b"Setext\n======\n\n    indented ``` code, not a fence",
+        ),
+        (Element.CODE, b"unclosed"),
+    ]
+
+
+def test_units_have_heading_path_and_fence_language() -> None:
+    metas = [unit.meta for unit in _units(DOC)]
+
+    assert metas == [
+        {},
+        {UnitMeta.HEADINGS: "Install"},
+        {UnitMeta.HEADINGS: "Install", UnitMeta.LANGUAGE: "bash"},
+        {UnitMeta.HEADINGS: "Install"},
+        {UnitMeta.HEADINGS: "Install", UnitMeta.LANGUAGE: "python"},
+        {UnitMeta.HEADINGS: "Install > Usage"},
+        {UnitMeta.HEADINGS: "Setext"},
+        {UnitMeta.HEADINGS: "Setext"},
+    ]
+
+
+def test_headings_in_fences_are_code_and_longer_fences_close() -> None:
+    md = b"# A\n\n```\n# not a heading\n````\n\ntext\n"
+    units = _units(md)
+
+    assert [unit.data for unit in units] == [
+        b"# A",
+        b"# not a heading",
+        b"text",
+    ]
+    assert all(unit.meta == {UnitMeta.HEADINGS: "A"} for unit in units)
+
+
+def test_units_are_streamed() -> None:
+    units = MarkdownProcessor(b"# A\n\ntext\n\n# B\n\n" + b"x\n" * 10**5)()
+    assert next(units).data == b"# A\n\ntext"
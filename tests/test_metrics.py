@@ -0,0 +1,111 @@
+import json
+import time
+import urllib.request
+from pathlib import Path
+
+from event_core.domain.types import FileExt
+
+from metrics import (
+    FileSink,
+    Metrics,
+    PrometheusSink,
+    doc_ext_label,
+    render,
+)
+
+
+def test_stages_are_labelled_with_the_file_type_of_the_doc(
+    tmp_path: Path,
+) -> None:
+    metrics = Metrics(tmp_path)
+    with doc_ext_label(FileExt.PDF):
+        with metrics.timer("download"):
+            pass
+    with metrics.timer("partition_pdf", FileExt.PDF):
+        pass
+    metrics.dump()
+
+    text = render(tmp_path)
+    assert (
+        'preprocessor_stage_seconds_count{file_ext=".pdf",stage="download"} 1'
+        in text
+    )
+    assert (
+        "preprocessor_stage_seconds_count"
+        '{file_ext=".pdf",stage="partition_pdf"} 1' in text
+    )
+
+
+def test_histogram_buckets_are_cumulative(tmp_path: Path) -> None:
+    metrics = Metrics(tmp_path)
+    for n_bytes in (512, 2048, 2048):
+        metrics.observe("preprocessor_doc_bytes", n_bytes, file_ext=".txt")
+    metrics.dump()
+
+    text = render(tmp_path)
+    series = 'preprocessor_doc_bytes_bucket{file_ext=".txt",le="%s"}'
+    assert f"{series % 1024.0} 1" in text
+    assert f"{series % 4096.0} 3" in text
+    assert f"{series % '+Inf'} 3" in text
+    assert 'preprocessor_doc_bytes_sum{file_ext=".txt"} 4608' in text
+
+
+def test_snapshots_of_processes_are_merged(tmp_path: Path) -> None:
+    metrics = Metrics(tmp_path)
+    metrics.inc("preprocessor_units_total", 2, file_ext=".md", type="TEXT")
+    metrics.set_max("preprocessor_peak_rss_bytes", 100, file_ext=".md")
+    metrics.dump()
+
+    # as dumped by another worker
+    other = Metrics(tmp_path)
+    other.inc("preprocessor_units_total", 3, file_ext=".md", type="TEXT")
+    other.set_max("preprocessor_peak_rss_bytes", 300, file_ext=".md")
+    (tmp_path / "other.json").write_text(json.dumps(other.snapshot()))
+
+    text = render(tmp_path)
+    assert 'preprocessor_units_total{file_ext=".md",type="TEXT"} 5' in text
+    assert 'preprocessor_peak_rss_bytes{file_ext=".md"} 300' in text
+
+
+def test_timed_iteration_leaves_out_the_caller(tmp_path: Path) -> None:
+    metrics = Metrics(tmp_path)
+    with doc_ext_label(FileExt.TXT):
+        for _ in metrics.timed(range(3), "process"):
+            time.sleep(0.05)
+
+    [(_, _, hist)] = metrics.snapshot()["histograms"]
+    assert hist[-1] < 0.05
+
+
+def test_disabled_metrics_are_not_recorded(tmp_path: Path) -> None:
+    metrics = Metrics(tmp_path, enabled=False)
+    with metrics.timer("download"):
+        pass
+    metrics.dump()
+    assert not list(tmp_path.iterdir())
+
+
+def test_file_sink_writes_metrics_when_stopped(tmp_path: Path) -> None:
+    metrics = Metrics(tmp_path)
+    metrics.inc("preprocessor_docs_total", file_ext=".py", status="complete")
+    metrics.dump()
+
+    path = tmp_path / "preprocessor.prom"
+    with FileSink(tmp_path, path, interval=60):
+        pass
+    assert (
+        'preprocessor_docs_total{file_ext=".py",status="complete"} 1'
+        in path.read_text()
+    )
+
+
+def test_prometheus_sink_serves_metrics(tmp_path: Path) -> None:
+    metrics = Metrics(tmp_path)
+    metrics.inc("preprocessor_bytes_in_total", 10, file_ext=".png")
+    metrics.dump()
+
+    with PrometheusSink(tmp_path, port=0) as sink:
+        url = f"http://127.0.0.1:{sink.port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode("utf-8")
+    assert 'preprocessor_bytes_in_total{file_ext=".png"} 10' in text
@@ -0,0 +1,147 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import List
+
+import fitz
+import pytest
+from event_core.adapters.services.meta import Meta
+from event_core.domain.types import Asset
+from PIL import Image
+from unstructured.documents.coordinates import PixelSpace
+
+from config import PDF_IMAGE_DPI, THUMB_HEIGHT, THUMB_WIDTH
+from metrics import Metrics, render
+from processors import pdf
+from processors.pdf import (
+    FAST,
+    HI_RES,
+    PdfProcessor,
+    _partition,
+    _partition_pages,
+    _plan_tasks,
+)
+
+
+@pytest.mark.parametrize(
+    "strategies,pages_per_task,expected",
+    (
+        ([HI_RES], 4, [(HI_RES, 1, 1)]),
+        ([HI_RES] * 4, 4, [(HI_RES, 1, 4)]),
+        (
+            [HI_RES] * 10,
+            4,
+            [(HI_RES, 1, 4), (HI_RES, 5, 8), (HI_RES, 9, 10)],
+        ),
+        (
+            [FAST, FAST, HI_RES, FAST],
+            4,
+            [(FAST, 1, 2), (HI_RES, 3, 3), (FAST, 4, 4)],
+        ),
+        ([FAST] * 3, 1, [(FAST, 1, 1), (FAST, 2, 2), (FAST, 3, 3)]),
+    ),
+)
+def test_tasks_cover_every_page_once_in_order(
+    strategies: list, pages_per_task: int, expected: list
+) -> None:
+    assert _plan_tasks(strategies, pages_per_task) == expected
+
+
+def _text_pdf(path: Path, n_pages: int) -> Path:
+    """A PDF of text pages, which are partitioned with the
+    fast strategy, without models"""
+    with fitz.open() as doc:
+        for i in range(1, n_pages + 1):
+            page = doc.new_page()
+            page.insert_textbox(
+                fitz.Rect(72, 72, 540, 720),
+                f"Page {i} is about the birds that cross the sea. " * 8,
+            )
+        doc.save(path)
+    return path
+
+
+def _units(path: Path) -> List[tuple]:
+    with PdfProcessor(path) as processor:
+        return [
+            (unit.seq, unit.type, unit.meta, unit.data) for unit in processor()
+        ]
+
+
+def test_pages_partitioned_in_parallel_match_pages_partitioned_serially(
+    tmp_path: Path, monkeypatch
+) -> None:
+    path = _text_pdf(tmp_path / "doc.pdf", n_pages=5)
+    monkeypatch.setattr(pdf, "PDF_PAGE_WORKERS", 1)
+    serial = _units(path)
+
+    monkeypatch.setattr(pdf, "PDF_PAGE_WORKERS", 2)
+    monkeypatch.setattr(pdf, "PDF_PARALLEL_MIN_PAGES", 2)
+    monkeypatch.setattr(pdf, "PDF_PAGES_PER_TASK", 2)
+    # without the models, which text pages do not need
+    page_pool = ProcessPoolExecutor(
+        2, mp_context=multiprocessing.get_context("forkserver")
+    )
+    monkeypatch.setattr(pdf, "_page_pool", page_pool)
+    try:
+        parallel = _units(path)
+    finally:
+        page_pool.shutdown()
+
+    pages = [meta[Meta.PAGE] for _, _, meta, _ in serial if meta]
+    assert pages == sorted(pages) and set(pages) == {1, 2, 3, 4, 5}
+    assert parallel == serial
+
+
+def test_fast_coords_are_in_the_pixel_space_of_hi_res(
+    tmp_path: Path,
+) -> None:
+    path = _text_pdf(tmp_path / "doc.pdf", n_pages=1)
+    elem = _partition_pages(str(path), FAST, 1, 1, 1)[0]
+
+    # hi_res lays out pages rendered at PDF_IMAGE_DPI
+    page_image = pdf._render_first_page(path)
+    coords = elem.metadata.coordinates
+    assert isinstance(coords.system, PixelSpace)
+    assert (coords.system.width, coords.system.height) == pytest.approx(
+        page_image.size, abs=1
+    )
+    # the text box starts an inch in from the top left
+    assert coords.points[0] == pytest.approx(
+        (PDF_IMAGE_DPI, PDF_IMAGE_DPI), abs=16
+    )
+
+
+def test_pages_per_strategy_are_recorded(tmp_path: Path, monkeypatch) -> None:
+    metrics = Metrics(tmp_path)
+    monkeypatch.setattr(pdf, "METRICS", metrics)
+    monkeypatch.setattr(pdf, "_classify_pages", lambda _: [FAST, HI_RES, FAST])
+    monkeypatch.setattr(pdf, "_partition_pages", lambda *_: [])
+
+    list(_partition(Path("doc.pdf")))
+    metrics.dump()
+
+    text = render(tmp_path)
+    assert 'preprocessor_pdf_pages_total{strategy="fast"} 2' in text
+    assert 'preprocessor_pdf_pages_total{strategy="hi_res"} 1' in text
+
+
+def test_doc_thumbnail_is_rendered_from_the_first_page(
+    tmp_path: Path,
+) -> None:
+    path = tmp_path / "doc.pdf"
+    with fitz.open() as doc:
+        for color in ((1, 0, 0), (0, 0, 1)):
+            page = doc.new_page()
+            page.draw_rect(page.rect, color=color, fill=color)
+        doc.save(path)
+
+    with PdfProcessor(path) as processor:
+        unit = next(processor())
+
+    assert unit.type == Asset.DOC_THUMBNAIL
+    thumb = Image.open(BytesIO(unit.data)).convert("RGB")
+    assert thumb.size == (THUMB_WIDTH, THUMB_HEIGHT)
+    r, _, b = thumb.getpixel((thumb.width // 2, thumb.height // 2))
+    assert r > 200 and b < 50
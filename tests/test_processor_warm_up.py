@@ -0,0 +1,31 @@
+from typing import List
+
+import pytest
+from event_core.domain.types import FileExt
+
+from processors import PROCESSOR_PATHS, ProcessorRegistry
+from processors.exceptions import FileTypeNotServed
+from processors.image import ImageProcessor
+
+
+def test_processor_shared_by_file_types_warms_up_once(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    calls: List[type] = []
+    monkeypatch.setattr(
+        ImageProcessor, "warm_up", classmethod(lambda cls: calls.append(cls))
+    )
+    registry = ProcessorRegistry(PROCESSOR_PATHS)
+
+    registry.warm_up([FileExt.JPEG, FileExt.JPG, FileExt.PNG])
+    registry.warm_up([FileExt.PNG])
+
+    assert calls == [ImageProcessor]
+
+
+def test_unserved_file_types_cannot_be_warmed_up() -> None:
+    registry = ProcessorRegistry(PROCESSOR_PATHS)
+    registry.serve([FileExt.TXT])
+
+    with pytest.raises(FileTypeNotServed):
+        registry.warm_up([FileExt.PDF])
@@ -0,0 +1,69 @@
+import json
+import time
+from pathlib import Path
+
+from profiling import DocProfiler
+
+
+def _busy_wait(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _profiles(profile_dir: Path) -> list:
+    return sorted(profile_dir.glob("*.json")) if profile_dir.exists() else []
+
+
+def test_slow_docs_are_profiled(tmp_path: Path) -> None:
+    profiler = DocProfiler(tmp_path, slow_seconds=0.05, interval=0.005)
+    with profiler.profile("doc.txt", ".txt") as profile:
+        profile.size_bytes = 123
+        _busy_wait(0.1)
+
+    [info_path] = _profiles(tmp_path)
+    info = json.loads(info_path.read_text())
+    assert info["doc_key"] == "doc.txt"
+    assert info["file_ext"] == ".txt"
+    assert info["size_bytes"] == 123
+    assert info["reason"] == "slow"
+    assert info["n_samples"] > 0
+    folded = info_path.with_suffix(".folded").read_text()
+    assert "_busy_wait" in folded
+
+
+def test_fast_docs_are_not_profiled_unless_sampled(tmp_path: Path) -> None:
+    profiler = DocProfiler(tmp_path, slow_seconds=10, interval=0.005)
+    with profiler.profile("doc.txt", ".txt"):
+        pass
+    assert not _profiles(tmp_path)
+
+    profiler = DocProfiler(
+        tmp_path, slow_seconds=10, sample_rate=1.0, interval=0.005
+    )
+    with profiler.profile("doc.txt", ".txt"):
+        _busy_wait(0.02)
+    [info_path] = _profiles(tmp_path)
+    assert json.loads(info_path.read_text())["reason"] == "sampled"
+
+
+def test_only_the_latest_profiles_are_kept(tmp_path: Path) -> None:
+    profiler = DocProfiler(
+        tmp_path, slow_seconds=None, sample_rate=1.0, max_profiles=2
+    )
+    for i in range(4):
+        with profiler.profile(f"doc{i}.txt", ".txt"):
+            pass
+        time.sleep(0.01)  # distinct mtimes
+
+    kept = [json.loads(p.read_text())["doc_key"] for p in _profiles(tmp_path)]
+    assert sorted(kept) == ["doc2.txt", "doc3.txt"]
+    assert len(list(tmp_path.glob("*.folded"))) == 2
+
+
+def test_profiling_is_off_by_default(tmp_path: Path) -> None:
+    profiler = DocProfiler(tmp_path, slow_seconds=None, sample_rate=0.0)
+    with profiler.profile("doc.txt", ".txt"):
+        _busy_wait(0.01)
+    assert not profiler.enabled
+    assert not _profiles(tmp_path)
@@ -0,0 +1,68 @@
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from event_core.domain.types import FileExt
+from PIL import Image, ImageChops, ImageStat
+
+from config import THUMB_DRAFT_TOLERANCE
+from processors import common
+from processors.common import ThumbFormat, resize_to_thumb
+from processors.thumbnails import ThumbnailEngine
+
+
+def _mean_abs_diff(a: bytes, b: bytes) -> float:
+    img_a = Image.open(BytesIO(a)).convert("RGB")
+    img_b = Image.open(BytesIO(b)).convert("RGB")
+    assert img_a.size == img_b.size
+    diff = ImageStat.Stat(ImageChops.difference(img_a, img_b))
+    return sum(diff.mean) / len(diff.mean)
+
+
+def test_draft_decoded_thumb_is_within_tolerance(
+    img_file_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    data = img_file_path.read_bytes()
+    monkeypatch.setattr(common, "THUMB_JPEG_DRAFT", False)
+    full_thumb = resize_to_thumb(data)
+    monkeypatch.setattr(common, "THUMB_JPEG_DRAFT", True)
+    draft_thumb = resize_to_thumb(data)
+
+    assert _mean_abs_diff(full_thumb, draft_thumb) <= THUMB_DRAFT_TOLERANCE
+
+
+def test_batched_thumbs_equal_single_thumbs(img_file_path: Path) -> None:
+    data = img_file_path.read_bytes()
+    engine = ThumbnailEngine(ThumbFormat(FileExt.PNG), n_workers=2)
+    try:
+        expected = resize_to_thumb(data, ThumbFormat(FileExt.PNG))
+        assert engine.thumbs([data, data]) == [expected] * 2
+    finally:
+        engine.close()
+
+
+def test_thumbs_are_memoized_by_content(img_file_path: Path) -> None:
+    data = img_file_path.read_bytes()
+    engine = ThumbnailEngine(ThumbFormat(FileExt.PNG))
+    assert engine.thumb(data) is engine.thumb(bytes(data))
+
+
+@pytest.mark.parametrize(
+    "thumb_fmt,pil_fmt",
+    (
+        (ThumbFormat(FileExt.JPG, quality=70), "JPEG"),
+        (ThumbFormat(FileExt.JPEG), "JPEG"),
+        (ThumbFormat(FileExt.PNG, compress_level=1), "PNG"),
+    ),
+)
+def test_thumbs_are_encoded_in_thumb_format(
+    img_file_path: Path, thumb_fmt: ThumbFormat, pil_fmt: str
+) -> None:
+    thumb = resize_to_thumb(img_file_path.read_bytes(), thumb_fmt)
+    assert Image.open(BytesIO(thumb)).format == pil_fmt
+
+
+def test_thumbs_of_transparent_images_can_be_jpeg() -> None:
+    image = Image.new("RGBA", (600, 400), (255, 0, 0, 128))
+    thumb = resize_to_thumb(image, ThumbFormat(FileExt.JPG))
+    assert Image.open(BytesIO(thumb)).mode == "RGB"
@@ -0,0 +1,136 @@
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, cast
+
+import pytest
+from event_core.adapters.services.meta import FakeMetaMapping, Meta
+from event_core.adapters.services.storage import FakeStorageClient, Payload
+from event_core.domain.events import DocStored
+from event_core.domain.types import Asset, Element, FileExt
+
+import cache as cache_module
+from app import _handle_doc_callback
+from bootstrap import DIContainer
+from cache import UnitCache
+from metrics import Metrics
+from processors.common import Unit
+
+
+@pytest.fixture
+def metrics(tmp_path: Path, monkeypatch) -> Metrics:
+    metrics = Metrics(tmp_path / "metrics")
+    monkeypatch.setattr(cache_module, "METRICS", metrics)
+    return metrics
+
+
+def _counts(metrics: Metrics) -> Dict[str, float]:
+    """Cache lookups by result, and evictions"""
+    counts = {}
+    for name, labels, value in metrics.snapshot()["counters"]:
+        if name == "preprocessor_unit_cache_lookups_total":
+            counts[labels["result"]] = value
+        elif name == "preprocessor_unit_cache_evictions_total":
+            counts["evicted"] = value
+    return counts
+
+
+def _units(n: int, size: int = 10) -> List[Unit]:
+    return [
+        Unit(seq=i, data=b"x" * size, type=Element.TEXT, file_ext=FileExt.TXT)
+        for i in range(1, n + 1)
+    ]
+
+
+def test_cached_units_are_replayed(tmp_path: Path, metrics: Metrics) -> None:
+    cache = UnitCache(tmp_path)
+    key = cache.key_for(b"doc", FileExt.TXT)
+    assert cache.get(key) is None
+
+    cache.put(key, _units(3))
+
+    assert list(cast(Iterator[Unit], cache.get(key))) == _units(3)
+    assert _counts(metrics) == {"hit": 1, "miss": 1}
+
+
+def test_cache_key_depends_on_content_and_file_type(tmp_path: Path) -> None:
+    cache = UnitCache(tmp_path)
+    key = cache.key_for(b"doc", FileExt.TXT)
+    assert key == cache.key_for(b"doc", FileExt.TXT)
+    assert key != cache.key_for(b"doc2", FileExt.TXT)
+    assert key != cache.key_for(b"doc", FileExt.MD)
+
+
+def test_least_recently_used_entries_are_evicted(
+    tmp_path: Path, metrics: Metrics
+) -> None:
+    cache = UnitCache(tmp_path)
+    cache.put("a", _units(1, size=1000))
+    entry_size = (tmp_path / "a").stat().st_size
+
+    cache = UnitCache(tmp_path, max_bytes=entry_size * 2)
+    cache.put("b", _units(1, size=1000))
+    os.utime(tmp_path / "a", (0, 0))
+    os.utime(tmp_path / "b", (1, 1))
+    cache.get("a")  # "a" becomes the most recently used entry
+    cache.put("c", _units(1, size=1000))
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert _counts(metrics)["evicted"] == 1
+
+
+def test_incomplete_iteration_is_not_cached(tmp_path: Path) -> None:
+    cache = UnitCache(tmp_path)
+
+    def failing_units() -> Iterator[Unit]:
+        yield from _units(2)
+        raise ValueError("corrupted doc")
+
+    recorded = cache.record("a", failing_units())
+    next(recorded)
+    recorded.close()
+
+    assert cache.get("a") is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_units_are_written_as_they_are_yielded(tmp_path: Path) -> None:
+    cache = UnitCache(tmp_path)
+    units = _units(3, size=100_000)
+
+    recorded = cache.record("a", iter(units))
+    next(recorded)
+    [partial] = list(tmp_path.iterdir())
+    assert partial.stat().st_size > 0
+    assert cache.get("a") is None
+
+    list(recorded)
+    assert list(cast(Iterator[Unit], cache.get("a"))) == units
+    assert [path.name for path in tmp_path.iterdir()] == ["a"]
+
+
+def test_docs_too_large_to_cache_are_passed_through(tmp_path: Path) -> None:
+    cache = UnitCache(tmp_path, max_entry_bytes=150_000)
+    units = _units(3, size=100_000)
+
+    assert list(cache.record("a", iter(units))) == units
+    assert cache.get("a") is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_reuploaded_doc_is_not_reprocessed(
+    txt_file_path: Path, container: DIContainer, metrics: Metrics
+) -> None:
+    storage = cast(FakeStorageClient, container.storage())
+    meta = cast(FakeMetaMapping, container.meta())
+
+    for doc_key in ("a/test.txt", "b/test.txt"):
+        storage[doc_key] = Payload(
+            data=txt_file_path.read_bytes(), type=Asset.DOC
+        )
+        _handle_doc_callback(DocStored(key=doc_key))
+
+    assert _counts(metrics) == {"hit": 1, "miss": 1}
+    assert storage["b/test/1__TEXT.txt"] == storage["a/test/1__TEXT.txt"]
+    assert meta[Meta.PARENT]["b/test/1__TEXT.txt"] == "b/test.txt"
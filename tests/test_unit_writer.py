@@ -0,0 +1,221 @@
+import time
+from typing import Collection
+
+import pytest
+from event_core.adapters.services.meta import FakeMetaMapping, Meta
+from event_core.adapters.services.storage import FakeStorageClient, Payload
+from event_core.domain.types import Element
+
+from processors.common import UnitMeta
+from writer import UnitWriteError, UnitWriter
+
+
+class _CountingStorage(FakeStorageClient):
+    def __init__(self, fail_keys: Collection[str] = ()):
+        super().__init__()
+        self.n_writes = 0
+        self._fail_keys = fail_keys
+
+    def __setitem__(self, key: str, payload: Payload) -> None:
+        if key in self._fail_keys:
+            raise ConnectionError("storage unavailable")
+        self.n_writes += 1
+        super().__setitem__(key, payload)
+
+
+def _payload(data: bytes = b"chunk") -> Payload:
+    return Payload(data=data, type=Element.TEXT)
+
+
+def test_writes_are_buffered_until_flush() -> None:
+    storage = _CountingStorage()
+    meta = FakeMetaMapping()
+    with UnitWriter(storage, meta, batch_size=10) as writer:
+        writer.store("doc/1__TEXT.txt", _payload())
+        writer.set_meta(Meta.PARENT, "doc/1__TEXT.txt", "doc.txt")
+        assert storage.n_writes == 0
+
+        writer.flush()
+
+    assert "doc/1__TEXT.txt" in storage
+    assert meta[Meta.PARENT]["doc/1__TEXT.txt"] == "doc.txt"
+
+
+def test_writer_flushes_every_batch_size_objects() -> None:
+    storage = _CountingStorage()
+    with UnitWriter(storage, FakeMetaMapping(), batch_size=2) as writer:
+        for i in range(5):
+            writer.store(f"doc/{i}__TEXT.txt", _payload())
+        assert storage.n_writes == 4
+        writer.flush()
+    assert storage.n_writes == 5
+
+
+def test_writer_flushes_writes_buffered_for_flush_seconds() -> None:
+    storage = _CountingStorage()
+    meta = FakeMetaMapping()
+    with UnitWriter(storage, meta, batch_size=10, flush_seconds=0) as writer:
+        writer.store("doc/1__TEXT.txt", _payload())
+        assert storage.n_writes == 1
+        writer.set_meta(Meta.PARENT, "doc/1__TEXT.txt", "doc.txt")
+        assert meta[Meta.PARENT]["doc/1__TEXT.txt"] == "doc.txt"
+
+
+def _wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_units_are_flushed_while_the_next_unit_is_generated() -> None:
+    storage = _CountingStorage()
+    visible = []
+
+    def units():
+        yield "doc/1__TEXT.txt"
+        # blocked, e.g., partitioning the next page
+        visible.append(_wait_for(lambda: "doc/1__TEXT.txt" in storage))
+        yield "doc/2__TEXT.txt"
+
+    with UnitWriter(
+        storage, FakeMetaMapping(), batch_size=10, flush_seconds=0.05
+    ) as writer:
+        for key in units():
+            writer.store(key, _payload())
+        writer.flush()
+
+    assert visible == [True]
+    assert "doc/2__TEXT.txt" in storage
+
+
+def test_failed_background_flush_is_raised_by_next_write() -> None:
+    storage = _CountingStorage(fail_keys=["doc/1__TEXT.txt"])
+    with UnitWriter(
+        storage, FakeMetaMapping(), batch_size=10, flush_seconds=0.05
+    ) as writer:
+        writer.store("doc/1__TEXT.txt", _payload())
+        assert _wait_for(lambda: writer.counts.failed == 1)
+
+        with pytest.raises(UnitWriteError) as exc_info:
+            writer.store("doc/2__TEXT.txt", _payload())
+
+    assert list(exc_info.value.failed) == ["doc/1__TEXT.txt"]
+    assert "doc/2__TEXT.txt" in storage
+
+
+def test_manifest_is_checkpointed_before_commit() -> None:
+    storage = _CountingStorage()
+    meta = FakeMetaMapping()
+    with UnitWriter(
+        storage,
+        meta,
+        doc_key="doc.txt",
+        flush_seconds=0,
+        checkpoint_seconds=0,
+    ) as writer:
+        writer.store("doc/1__TEXT.txt", _payload())
+    assert "doc.txt" in meta[UnitMeta.MANIFEST]
+
+    # a checkpoint does not delete units not written yet
+    _write_doc(storage, meta, n_units=2)
+    with UnitWriter(
+        storage,
+        meta,
+        doc_key="doc.txt",
+        flush_seconds=0,
+        checkpoint_seconds=0,
+    ) as writer:
+        writer.store("doc/1__TEXT.txt", _payload(b"chunk 1"))
+        writer.store("doc/3__TEXT.txt", _payload())
+    assert "doc/2__TEXT.txt" in storage
+
+
+def test_later_meta_update_of_same_key_wins() -> None:
+    meta = FakeMetaMapping()
+    with UnitWriter(_CountingStorage(), meta) as writer:
+        writer.set_meta(Meta.DOC_THUMB, "doc.txt", "assets/icons/txt.png")
+        writer.set_meta(Meta.DOC_THUMB, "doc.txt", "doc/0__THUMB.png")
+        writer.flush()
+    assert meta[Meta.DOC_THUMB]["doc.txt"] == "doc/0__THUMB.png"
+
+
+def test_failed_writes_are_reported_and_skip_dependent_meta() -> None:
+    storage = _CountingStorage(fail_keys=["doc/2__TEXT.txt"])
+    meta = FakeMetaMapping()
+    with UnitWriter(storage, meta) as writer:
+        for i in (1, 2):
+            writer.store(f"doc/{i}__TEXT.txt", _payload())
+            writer.set_meta(Meta.PARENT, f"doc/{i}__TEXT.txt", "doc.txt")
+
+        with pytest.raises(UnitWriteError) as exc_info:
+            writer.flush()
+
+    assert list(exc_info.value.failed) == ["doc/2__TEXT.txt"]
+    assert "doc/1__TEXT.txt" in storage
+    assert meta[Meta.PARENT]["doc/1__TEXT.txt"] == "doc.txt"
+    assert "doc/2__TEXT.txt" not in meta[Meta.PARENT]
+
+
+def _write_doc(
+    storage: FakeStorageClient,
+    meta: FakeMetaMapping,
+    n_units: int,
+    complete: bool = True,
+) -> UnitWriter:
+    with UnitWriter(storage, meta, doc_key="doc.txt") as writer:
+        for i in range(1, n_units + 1):
+            writer.store(f"doc/{i}__TEXT.txt", _payload(b"chunk %d" % i))
+            writer.set_meta(Meta.PARENT, f"doc/{i}__TEXT.txt", "doc.txt")
+        writer.commit(prune=complete)
+    return writer
+
+
+def test_unchanged_units_are_not_written_again() -> None:
+    storage = _CountingStorage()
+    meta = FakeMetaMapping()
+    _write_doc(storage, meta, n_units=3)
+
+    writer = _write_doc(storage, meta, n_units=3)
+
+    assert storage.n_writes == 3
+    assert (writer.counts.written, writer.counts.skipped) == (0, 6)
+
+
+def test_units_a_doc_no_longer_has_are_deleted() -> None:
+    storage = _CountingStorage()
+    meta = FakeMetaMapping()
+    _write_doc(storage, meta, n_units=3)
+
+    writer = _write_doc(storage, meta, n_units=2)
+
+    assert writer.counts.deleted == 2
+    assert "doc/3__TEXT.txt" not in storage
+    assert "doc/3__TEXT.txt" not in meta[Meta.PARENT]
+    assert "doc/2__TEXT.txt" in storage
+
+
+def test_units_are_kept_until_a_doc_is_complete() -> None:
+    storage = _CountingStorage()
+    meta = FakeMetaMapping()
+    _write_doc(storage, meta, n_units=3)
+
+    _write_doc(storage, meta, n_units=1, complete=False)
+    assert "doc/3__TEXT.txt" in storage
+
+    writer = _write_doc(storage, meta, n_units=1)
+    assert writer.counts.deleted == 4
+    assert "doc/3__TEXT.txt" not in storage
+
+
+def test_failed_writes_are_retried_next_time() -> None:
+    storage = _CountingStorage(fail_keys=["doc/2__TEXT.txt"])
+    meta = FakeMetaMapping()
+    with pytest.raises(UnitWriteError):
+        _write_doc(storage, meta, n_units=2)
+
+    storage._fail_keys = []
+    writer = _write_doc(storage, meta, n_units=2)
+
+    assert writer.counts.written == 2
+    assert meta[Meta.PARENT]["doc/2__TEXT.txt"] == "doc.txt"
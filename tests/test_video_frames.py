@@ -0,0 +1,65 @@
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from event_core.domain.types import FileExt
+
+from processors import video
+from processors.video import _FrameReader
+
+
+class _KeyframeCapture:
+    """A capture of a video with a keyframe every 10 frames,
+    which, like some backends, seeks to the first keyframe at
+    or after the frame asked for. Each frame is filled with
+    its frame number."""
+
+    n_frames = 100
+
+    def __init__(self, video_path: str):
+        self._pos = 0
+
+    def isOpened(self) -> bool:
+        return True
+
+    def release(self) -> None:
+        pass
+
+    def set(self, prop: int, frame_num: float) -> bool:
+        assert prop == cv2.CAP_PROP_POS_FRAMES
+        keyframe = -(-int(frame_num) // 10) * 10
+        self._pos = min(keyframe, self.n_frames)
+        return True
+
+    def get(self, prop: int) -> float:
+        assert prop == cv2.CAP_PROP_POS_FRAMES
+        return float(self._pos)
+
+    def grab(self) -> bool:
+        if self._pos >= self.n_frames:
+            return False
+        self._pos += 1
+        return True
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        if self._pos >= self.n_frames:
+            return False, None
+        frame = np.full((2, 2, 3), self._pos, dtype=np.uint8)
+        self._pos += 1
+        return True, frame
+
+
+def test_seeks_that_overshoot_step_back_to_the_frame(monkeypatch) -> None:
+    monkeypatch.setattr(video.cv2, "VideoCapture", _KeyframeCapture)
+    monkeypatch.setattr(video, "VIDEO_SEEK_MIN_FRAMES", 5)
+    # 25 overshoots to 30 once, 57 and 99 several times, and
+    # 3 and 58 are grabbed rather than seeked to
+    frame_nums = [3, 25, 57, 58, 99]
+
+    with _FrameReader("video.mp4") as reader:
+        frames = list(reader.read(frame_nums, FileExt.PNG))
+
+    assert [
+        cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)[0, 0, 0]
+        for frame in frames
+    ] == frame_nums
@@ -0,0 +1,262 @@
+import errno
+import mmap
+import multiprocessing
+import operator
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import psutil
+import pytest
+from event_core.domain.events import DocStored
+from event_core.domain.types import FileExt
+
+import workers
+from processors import PROCESSORS_BY_EXT
+from workers import (
+    DocAbandoned,
+    DocMemoryExceeded,
+    DocTimeout,
+    DocWorkerPool,
+    IsolatedProcessPool,
+    Lane,
+    LaneScheduler,
+    WorkerDied,
+    WorkerMode,
+    WorkerStartFailed,
+)
+
+
+def test_all_events_are_processed() -> None:
+    processed: List[str] = []
+    lock = threading.Lock()
+
+    def callback(event: DocStored) -> None:
+        time.sleep(0.01)
+        with lock:
+            processed.append(event.key)
+
+    keys = [f"docs/{i % 3}.txt" for i in range(12)]
+    with DocWorkerPool(callback, 4, WorkerMode.THREAD) as pool:
+        futures = [pool.submit(DocStored(key=key)) for key in keys]
+
+    assert all(future.done() for future in futures)
+    for key in set(keys):
+        assert processed.count(key) == keys.count(key)
+
+
+def test_same_doc_events_do_not_overlap() -> None:
+    active: List[str] = []
+    overlaps: List[str] = []
+
+    def callback(event: DocStored) -> None:
+        if event.key in active:
+            overlaps.append(event.key)
+        active.append(event.key)
+        time.sleep(0.01)
+        active.remove(event.key)
+
+    with DocWorkerPool(callback, 4, WorkerMode.THREAD) as pool:
+        for _ in range(5):
+            pool.submit(DocStored(key="docs/a.pdf"))
+
+    assert not overlaps
+
+
+def test_shutdown_drains_in_flight_events() -> None:
+    processed: List[str] = []
+
+    def callback(event: DocStored) -> None:
+        time.sleep(0.01)
+        processed.append(event.key)
+
+    pool = DocWorkerPool(callback, 2, WorkerMode.THREAD)
+    for i in range(10):
+        pool.submit(DocStored(key=f"docs/{i}.txt"))
+    pool.shutdown()
+
+    assert len(processed) == 10
+
+
+def test_failed_event_does_not_block_next_event_of_same_doc() -> None:
+    processed: List[int] = []
+
+    def callback(event: DocStored) -> None:
+        processed.append(len(processed))
+        if len(processed) == 1:
+            raise ValueError("corrupted doc")
+
+    with DocWorkerPool(callback, 2, WorkerMode.THREAD) as pool:
+        pool.submit(DocStored(key="docs/a.mp4"))
+        pool.submit(DocStored(key="docs/a.mp4"))
+
+    assert processed == [0, 1]
+
+
+def test_light_lane_is_not_blocked_by_heavy_lane() -> None:
+    release_heavy = threading.Event()
+
+    def callback(event: DocStored) -> None:
+        if event.key.endswith(".mp4"):
+            release_heavy.wait(timeout=5)
+
+    lanes = {
+        "heavy": Lane((FileExt.MP4,), n_workers=1, mode=WorkerMode.THREAD),
+        "light": Lane((FileExt.TXT,), n_workers=1, mode=WorkerMode.THREAD),
+    }
+    with LaneScheduler(callback, lanes, default_lane="light") as scheduler:
+        heavy = [
+            scheduler.submit(DocStored(key=f"docs/{i}.mp4")) for i in range(3)
+        ]
+        light = scheduler.submit(DocStored(key="docs/a.txt"))
+        light.result(timeout=1)
+        assert not any(future.done() for future in heavy)
+        release_heavy.set()
+
+
+def _balloon() -> None:
+    _ = b"x" * (512 * 1024 * 1024)
+    time.sleep(60)
+
+
+def _process_doc(event: DocStored) -> None:
+    # module level, to be sent to worker processes
+    if "hang" in event.key:
+        time.sleep(60)
+    elif "child-balloon" in event.key:
+        ctx = multiprocessing.get_context("fork")
+        ctx.Process(target=_balloon, daemon=True).start()
+        time.sleep(60)
+    elif "balloon" in event.key:
+        _balloon()
+    elif "crash" in event.key:
+        os._exit(1)
+    elif "large" in event.key:
+        with open(event.key, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                m[:: mmap.PAGESIZE]  # read every page
+                time.sleep(0.5)
+        Path(event.key).with_suffix(".done").touch()
+
+
+def _run_isolated(keys: List[str], **kwargs) -> List[Tuple[str, DocAbandoned]]:
+    abandoned: List[Tuple[str, DocAbandoned]] = []
+    with DocWorkerPool(
+        _process_doc,
+        1,
+        WorkerMode.PROCESS,
+        on_abandoned=lambda event, e: abandoned.append((event.key, e)),
+        **kwargs,
+    ) as pool:
+        futures = [pool.submit(DocStored(key=key)) for key in keys]
+    assert all(future.done() for future in futures)
+    return abandoned
+
+
+def test_hanging_doc_is_abandoned_and_worker_replaced(monkeypatch) -> None:
+    monkeypatch.setattr(workers, "WORKER_POLL_SECONDS", 0.05)
+    abandoned = _run_isolated(
+        ["docs/hang.mp4", "docs/a.txt", "docs/hang.pdf"], timeout=0.5
+    )
+
+    assert [key for key, _ in abandoned] == ["docs/hang.mp4", "docs/hang.pdf"]
+    assert all(isinstance(e, DocTimeout) for _, e in abandoned)
+
+
+def test_doc_over_memory_budget_is_abandoned(monkeypatch) -> None:
+    monkeypatch.setattr(workers, "WORKER_POLL_SECONDS", 0.05)
+    abandoned = _run_isolated(["docs/balloon.pdf", "docs/a.txt"], memory_mb=64)
+
+    assert [key for key, _ in abandoned] == ["docs/balloon.pdf"]
+    assert isinstance(abandoned[0][1], DocMemoryExceeded)
+
+
+def test_doc_larger_than_memory_budget_can_be_mapped(
+    tmp_path: Path, monkeypatch
+) -> None:
+    monkeypatch.setattr(workers, "WORKER_POLL_SECONDS", 0.05)
+    doc_path = tmp_path / "large.txt"
+    doc_path.write_bytes(b"x" * 128 * 1024 * 1024)
+
+    assert not _run_isolated([str(doc_path)], memory_mb=64)
+    assert doc_path.with_suffix(".done").exists()
+
+
+def test_memory_of_processes_started_by_worker_counts(monkeypatch) -> None:
+    monkeypatch.setattr(workers, "WORKER_POLL_SECONDS", 0.05)
+    abandoned = _run_isolated(
+        ["docs/child-balloon.pdf", "docs/a.txt"], memory_mb=64
+    )
+
+    assert [key for key, _ in abandoned] == ["docs/child-balloon.pdf"]
+    assert isinstance(abandoned[0][1], DocMemoryExceeded)
+
+
+def _record_warm_processors(event: DocStored) -> None:
+    # module level, to be sent to worker processes
+    with open(event.key, "w") as f:
+        f.writelines(f"{cls.__name__}\n" for cls in PROCESSORS_BY_EXT._warm)
+
+
+def test_only_lanes_serving_warm_up_types_warm_up_before_ready(
+    tmp_path: Path, monkeypatch
+) -> None:
+    monkeypatch.setattr(workers, "WARM_UP_FILE_EXTS", (FileExt.TXT,))
+    lanes = {
+        "text": Lane((FileExt.TXT,), n_workers=1),
+        "markdown": Lane((FileExt.MD,), n_workers=1),
+    }
+    with LaneScheduler(
+        _record_warm_processors, lanes, default_lane="text"
+    ) as scheduler:
+        scheduler.wait_ready()
+        for name in ("a.txt", "a.md"):
+            scheduler.submit(DocStored(key=str(tmp_path / name))).result()
+
+    assert (tmp_path / "a.txt").read_text().split() == ["TextProcessor"]
+    assert (tmp_path / "a.md").read_text().split() == []
+
+
+def test_crashed_worker_is_replaced() -> None:
+    abandoned = _run_isolated(["docs/crash.txt", "docs/a.txt"])
+
+    assert [key for key, _ in abandoned] == ["docs/crash.txt"]
+    assert isinstance(abandoned[0][1], WorkerDied)
+
+
+def test_docs_complete_after_worker_fails_to_start(monkeypatch) -> None:
+    start_worker = workers._WorkerProcess
+    n_starts = 0
+
+    def flaky_start(*args) -> workers._WorkerProcess:
+        nonlocal n_starts
+        n_starts += 1
+        if n_starts in (2, 3):  # the replacement of the crashed worker
+            raise OSError(errno.EAGAIN, "Resource temporarily unavailable")
+        return start_worker(*args)
+
+    monkeypatch.setattr(workers, "_WorkerProcess", flaky_start)
+    abandoned = _run_isolated(["docs/crash.txt", "docs/a.txt", "docs/b.txt"])
+
+    assert [key for key, _ in abandoned] == ["docs/crash.txt", "docs/a.txt"]
+    assert isinstance(abandoned[0][1], WorkerDied)
+    assert isinstance(abandoned[1][1], WorkerStartFailed)
+    assert n_starts == 4
+
+
+def test_memory_is_measured_without_proc(monkeypatch) -> None:
+    monkeypatch.setattr(workers, "_HAS_SMAPS_ROLLUP", False)
+    assert workers._anon_bytes(psutil.Process()) > 0
+
+
+def test_wait_ready_raises_when_initializer_fails() -> None:
+    pool = IsolatedProcessPool(2, operator.truediv, (1, 0))
+    try:
+        with pytest.raises(WorkerStartFailed, match="ZeroDivisionError"):
+            pool.wait_ready()
+        with pytest.raises(WorkerStartFailed):
+            pool.submit(len, "doc").result()
+    finally:
+        pool.shutdown()
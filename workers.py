@@ -0,0 +1,596 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from enum import StrEnum
+from multiprocessing.connection import Connection
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import psutil
+from event_core.domain.events import DocStored
+from event_core.domain.types import FileExt, path_to_ext
+
+from bootstrap import bootstrap
+from config import WARM_UP_FILE_EXTS, WORKER_POLL_SECONDS
+from processors import PROCESSOR_PATHS, PROCESSORS_BY_EXT
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerMode(StrEnum):
+    PROCESS = "process"  # CPU-bound docs (PDF, video)
+    THREAD = "thread"  # I/O-bound docs
+
+
+class DocAbandoned(Exception):
+    """The worker processing a doc was killed, or died"""
+
+
+class DocTimeout(DocAbandoned):
+    pass
+
+
+class DocMemoryExceeded(DocAbandoned):
+    pass
+
+
+class WorkerDied(DocAbandoned):
+    pass
+
+
+class WorkerStartFailed(DocAbandoned):
+    """No worker could be started to process a doc"""
+
+
+# anonymous memory is read from /proc, which macOS lacks
+_HAS_SMAPS_ROLLUP = os.path.exists("/proc/self/smaps_rollup")
+
+
+def _anon_bytes(process: psutil.Process) -> int:
+    """Anonymous memory of a process, e.g., its heap, with
+    pages it shares copy-on-write split between the processes
+    that share them. Pages of files it maps, like docs, are
+    left out. Without /proc, the memory unique to the process
+    is used instead, which counts the docs it maps"""
+    if not _HAS_SMAPS_ROLLUP:
+        return process.memory_full_info().uss
+    try:
+        with open(f"/proc/{process.pid}/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except (FileNotFoundError, ProcessLookupError):
+        raise psutil.NoSuchProcess(process.pid)  # exited
+    return sum(
+        int(fields[field].split()[0]) * 1024
+        for field in ("Pss_Anon", "SwapPss")
+    )
+
+
+def _init_worker_process(
+    file_exts: Optional[Collection[FileExt]],
+    warm_up: Collection[FileExt],
+    log_level: int,
+) -> None:
+    # workers are not forked off the service, so do not
+    # inherit its logging config
+    logging.basicConfig(level=log_level)
+    # the parent owns shutdown and drains in-flight docs
+    # before exiting, so children must not die mid-doc
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # never load the processors (and their dependencies) of
+    # file types that other workers serve
+    PROCESSORS_BY_EXT.serve(file_exts)
+    if warm_up:
+        # load models before the worker is ready, so that no
+        # doc pays for loading them
+        start = time.perf_counter()
+        PROCESSORS_BY_EXT.warm_up(warm_up)
+        logger.info(
+            f"Warmed up {[str(ext) for ext in warm_up]} processors"
+            f" in {time.perf_counter() - start:.1f}s"
+        )
+    bootstrap()  # fresh storage and meta clients per process
+
+
+def _serve_tasks(
+    conn: Connection, initializer: Callable[..., None], initargs: Tuple
+) -> None:
+    try:
+        initializer(*initargs)
+    except BaseException as e:
+        # reported by the pool, in place of ready
+        try:
+            conn.send(e)
+        except Exception as send_error:  # unpicklable exception
+            conn.send(RuntimeError(f"{e!r} ({send_error})"))
+        return
+    conn.send(None)  # ready
+    while (task := conn.recv()) is not None:
+        fn, args = task
+        try:
+            result: Tuple[bool, Any] = (True, fn(*args))
+        except BaseException as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:  # unpicklable result or exception
+            conn.send((False, RuntimeError(f"{result[1]!r} ({e})")))
+
+
+class _WorkerProcess:
+    """A process that runs tasks one at a time, under the
+    watch of the thread that sends it tasks"""
+
+    def __init__(self, initializer: Callable[..., None], initargs: Tuple):
+        # not forked off the service, whose other threads may
+        # hold locks that a child would inherit held, but off a
+        # server that runs no threads
+        ctx = multiprocessing.get_context("forkserver")
+        self._conn, child_conn = ctx.Pipe()
+        # not daemonic, as daemonic processes may not start
+        # processes of their own, like the PDF page pool
+        self._process = ctx.Process(
+            target=_serve_tasks, args=(child_conn, initializer, initargs)
+        )
+        self._process.start()
+        child_conn.close()
+        try:
+            error = self._recv()  # wait for the initializer
+            if error is not None:
+                raise error
+            self._psutil = psutil.Process(self._process.pid)
+            self._start_bytes = self._tree_bytes()
+        except BaseException:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+            raise
+
+    def _recv(self) -> Any:
+        try:
+            return self._conn.recv()
+        except EOFError:
+            self._process.join()
+            raise WorkerDied(
+                f"Worker exited with code {self._process.exitcode}"
+            )
+
+    def _tree_bytes(self) -> int:
+        """Anonymous memory of the worker and the processes it
+        started, like the PDF page pool"""
+        n_bytes = _anon_bytes(self._psutil)
+        for child in self._psutil.children(recursive=True):
+            try:
+                n_bytes += _anon_bytes(child)
+            except psutil.NoSuchProcess:
+                pass  # exited since listed
+        return n_bytes
+
+    def _growth_mb(self) -> float:
+        try:
+            n_bytes = self._tree_bytes()
+        except psutil.NoSuchProcess:
+            return 0.0  # reported by the pipe being closed
+        return (n_bytes - self._start_bytes) / 1024 / 1024
+
+    def run(
+        self,
+        fn: Callable,
+        args: Tuple,
+        timeout: Optional[float],
+        memory_mb: Optional[int],
+    ) -> Any:
+        try:
+            self._conn.send((fn, args))
+        except OSError as e:
+            raise WorkerDied(f"Worker is gone: {e!r}") from e
+        deadline = time.monotonic() + timeout if timeout else None
+        while not self._conn.poll(WORKER_POLL_SECONDS):
+            if deadline is not None and time.monotonic() > deadline:
+                raise DocTimeout(f"Timed out after {timeout}s")
+            if memory_mb and (growth := self._growth_mb()) > memory_mb:
+                raise DocMemoryExceeded(
+                    f"Worker grew by {growth:.0f}MB, over {memory_mb}MB"
+                )
+        ok, result = self._recv()
+        if ok:
+            return result
+        if isinstance(result, MemoryError):
+            # the worker could not allocate any more memory
+            raise DocMemoryExceeded("Worker ran out of memory") from result
+        raise result
+
+    def kill(self) -> None:
+        """Kill the worker and the processes it started, like
+        the PDF page pool"""
+        try:
+            children = self._psutil.children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        self._process.kill()
+        for child in children:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
+        self._process.join()
+        self._conn.close()
+
+    def stop(self) -> None:
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass  # already dead
+        self._process.join()
+        self._conn.close()
+
+
+class IsolatedProcessPool(Executor):
+    """Runs tasks on worker processes, each under a
+    wall-clock `timeout` and a `memory_mb` budget.
+
+    Unlike a `ProcessPoolExecutor`, which breaks along with
+    every pending task once one of its workers dies, a worker
+    that breaches its budget, or dies, is killed and replaced,
+    and only its task fails, with a `DocAbandoned` error.
+
+    Workers are watched by the thread that feeds them, every
+    `WORKER_POLL_SECONDS`. Memory is the growth, since a worker
+    was initialized, of the anonymous memory of the worker and
+    the processes it started. Docs it maps are not counted.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        initializer: Callable[..., None],
+        initargs: Tuple = (),
+        timeout: Optional[float] = None,
+        memory_mb: Optional[int] = None,
+    ):
+        self._initializer = initializer
+        self._initargs = initargs
+        self._timeout = timeout
+        self._memory_mb = memory_mb
+        self._tasks: queue.SimpleQueue = queue.SimpleQueue()
+        self._ready = [threading.Event() for _ in range(max_workers)]
+        self._start_errors: List[Optional[WorkerStartFailed]] = [
+            None
+        ] * max_workers
+        self._threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(i,),
+                name=f"doc-worker-{i}",
+                daemon=True,
+            )
+            for i in range(max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        if kwargs:
+            raise TypeError("Keyword arguments are not supported")
+        future: Future = Future()
+        self._tasks.put((future, fn, args))
+        return future
+
+    def wait_ready(self) -> None:
+        """Wait for every worker to be initialized. Raises
+        `WorkerStartFailed` if a worker could not be"""
+        for ready in self._ready:
+            ready.wait()
+        for error in self._start_errors:
+            if error is not None:
+                raise error
+
+    def _start_worker(self) -> _WorkerProcess:
+        try:
+            return _WorkerProcess(self._initializer, self._initargs)
+        except Exception as e:
+            raise WorkerStartFailed(f"Failed to start worker: {e!r}") from e
+
+    def _try_start_worker(self) -> Optional[_WorkerProcess]:
+        try:
+            return self._start_worker()
+        except WorkerStartFailed as e:
+            # retried, and reported, with the next task
+            logger.warning(str(e))
+            return None
+
+    def _feed(self, i: int) -> None:
+        # workers are started, and replaced, ahead of tasks
+        worker = None
+        try:
+            worker = self._start_worker()
+        except WorkerStartFailed as e:
+            # retried with the next task, and reported by
+            # `wait_ready()`
+            logger.warning(str(e))
+            self._start_errors[i] = e
+        finally:
+            self._ready[i].set()
+        while (task := self._tasks.get()) is not None:
+            future, fn, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if worker is None:
+                    worker = self._start_worker()
+                result = worker.run(fn, args, self._timeout, self._memory_mb)
+            except WorkerStartFailed as e:
+                future.set_exception(e)
+            except DocAbandoned as e:
+                worker.kill()
+                future.set_exception(e)
+                worker = self._try_start_worker()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        if worker is not None:
+            worker.stop()
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        for _ in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def _make_executor(
+    mode: WorkerMode,
+    n_workers: int,
+    memory_mb: Optional[int],
+    file_exts: Optional[Collection[FileExt]],
+    timeout: Optional[float],
+    warm_up: Collection[FileExt],
+) -> Executor:
+    if mode == WorkerMode.PROCESS:
+        return IsolatedProcessPool(
+            n_workers,
+            initializer=_init_worker_process,
+            initargs=(file_exts, warm_up, logging.getLogger().level),
+            timeout=timeout,
+            memory_mb=memory_mb,
+        )
+    if memory_mb or timeout or warm_up:
+        logger.warning(
+            "Memory budgets, timeouts and warm-up only apply to processes"
+        )
+    return ThreadPoolExecutor(
+        max_workers=n_workers, thread_name_prefix="doc-worker"
+    )
+
+
+class DocWorkerPool:
+    """Runs a `DocStored` callback on a pool of workers.
+
+    Events for different docs are processed in parallel,
+    while events for the same doc key are chained so that
+    they run one after another, in the order received. This
+    keeps the storage and meta writes of a doc ordered.
+
+    On shutdown, every event that has been submitted is
+    processed before the pool exits.
+
+    If `file_exts` is set, worker processes only load the
+    processors of these file types. Worker processes are
+    started along with the pool, and warm up the processors
+    of `warm_up` before they are ready (see `wait_ready()`).
+
+    A worker process that takes longer than `timeout` seconds
+    on a doc, or whose anonymous memory (along with that of the
+    processes it started) grows by more than `memory_mb`, is
+    killed and replaced. `on_abandoned` is then called with
+    the event and the `DocAbandoned` error, e.g., to mark the
+    doc failed.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[DocStored], None],
+        n_workers: int,
+        mode: WorkerMode = WorkerMode.PROCESS,
+        memory_mb: Optional[int] = None,
+        file_exts: Optional[Collection[FileExt]] = None,
+        timeout: Optional[float] = None,
+        on_abandoned: Optional[
+            Callable[[DocStored, DocAbandoned], None]
+        ] = None,
+        warm_up: Collection[FileExt] = (),
+    ):
+        self._callback = callback
+        self._on_abandoned = on_abandoned
+        self._executor = _make_executor(
+            mode, n_workers, memory_mb, file_exts, timeout, warm_up
+        )
+        self._lock = threading.Lock()
+        self._tails: Dict[str, Future] = {}
+        self._pending: Set[Future] = set()
+
+    def wait_ready(self) -> None:
+        if isinstance(self._executor, IsolatedProcessPool):
+            self._executor.wait_ready()
+
+    def submit(self, event: DocStored) -> Future:
+        done: Future = Future()
+        with self._lock:
+            prev = self._tails.get(event.key)
+            self._tails[event.key] = done
+            self._pending.add(done)
+
+        if prev is None:
+            self._run(event, done)
+        else:
+            prev.add_done_callback(lambda _: self._run(event, done))
+        return done
+
+    def _run(self, event: DocStored, done: Future) -> None:
+        try:
+            future = self._executor.submit(self._callback, event)
+        except Exception as e:
+            self._settle(event, done, e)
+            return
+        future.add_done_callback(
+            lambda f: self._settle(
+                event, done, None if f.cancelled() else f.exception()
+            )
+        )
+
+    def _settle(
+        self, event: DocStored, done: Future, exc: Optional[BaseException]
+    ) -> None:
+        if exc is not None:
+            logger.warning(f"Failed to process {event.key}. Error: {exc}")
+        if isinstance(exc, DocAbandoned) and self._on_abandoned is not None:
+            try:
+                self._on_abandoned(event, exc)
+            except Exception as e:
+                logger.warning(f"Failed to mark {event.key} failed: {e}")
+
+        with self._lock:
+            if self._tails.get(event.key) is done:
+                del self._tails[event.key]
+            self._pending.discard(done)
+        done.set_result(None)
+
+    def shutdown(self) -> None:
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            wait(pending)
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+
+
+@dataclass(frozen=True)
+class Lane:
+    file_exts: Collection[FileExt]
+    n_workers: int
+    mode: WorkerMode = WorkerMode.PROCESS
+    memory_mb: Optional[int] = None
+    timeout_seconds: Optional[float] = None
+
+
+class LaneScheduler:
+    """Routes `DocStored` events to a worker pool per lane.
+
+    Each lane serves a set of file types with its own
+    concurrency limit and memory budget, so that a backlog
+    of expensive docs (videos, PDFs) never queues up cheap
+    docs (text, code, images) behind it. Docs of a type that
+    no lane claims go to the default lane.
+
+    Worker processes of a lane only ever import the
+    processors of the file types the lane serves, and warm
+    up those of `WARM_UP_FILE_EXTS` among them.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[DocStored], None],
+        lanes: Dict[str, Lane],
+        default_lane: str,
+        on_abandoned: Optional[
+            Callable[[DocStored, DocAbandoned], None]
+        ] = None,
+    ):
+        self._lane_by_ext = {
+            file_ext: name
+            for name, lane in lanes.items()
+            for file_ext in lane.file_exts
+        }
+        unclaimed = set(PROCESSOR_PATHS) - set(self._lane_by_ext)
+        self._pools: Dict[str, DocWorkerPool] = {}
+        for name, lane in lanes.items():
+            file_exts = set(lane.file_exts)
+            if name == default_lane:
+                file_exts |= unclaimed
+            self._pools[name] = DocWorkerPool(
+                callback,
+                lane.n_workers,
+                lane.mode,
+                lane.memory_mb,
+                file_exts=file_exts,
+                timeout=lane.timeout_seconds,
+                on_abandoned=on_abandoned,
+                warm_up=[ext for ext in WARM_UP_FILE_EXTS if ext in file_exts],
+            )
+        self._default_pool = self._pools[default_lane]
+
+        self._dispatching = False
+        self._interrupted = False
+        self._stopping = False
+
+    def submit(self, event: DocStored) -> Future:
+        self._dispatching = True
+        try:
+            future = self._pool_for(event).submit(event)
+        finally:
+            self._dispatching = False
+
+        if self._interrupted:
+            raise KeyboardInterrupt
+        return future
+
+    def _pool_for(self, event: DocStored) -> DocWorkerPool:
+        try:
+            lane = self._lane_by_ext.get(path_to_ext(event.key))
+        except Exception:
+            lane = None  # unsupported ext, let the callback report it
+        return self._pools[lane] if lane else self._default_pool
+
+    def wait_ready(self) -> None:
+        """Wait for the workers of every lane to be warmed up"""
+        for pool in self._pools.values():
+            pool.wait_ready()
+
+    def install_signal_handlers(self) -> None:
+        """Turn SIGTERM into a graceful stop of the consumer loop"""
+        signal.signal(signal.SIGTERM, self._on_signal)
+
+    def _on_signal(self, signum: int, _) -> None:
+        if self._stopping:
+            return  # already draining
+        self._stopping = True
+        logger.info(f"Received signal {signum}, draining in-flight docs")
+        if self._dispatching:
+            # let the event being dispatched be registered first
+            self._interrupted = True
+        else:
+            raise KeyboardInterrupt
+
+    def shutdown(self) -> None:
+        self._stopping = True
+        for pool in self._pools.values():
+            pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
@@ -0,0 +1,357 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from event_core.adapters.services.meta import AbstractMetaMapping, Meta
+from event_core.adapters.services.storage import Payload, StorageClient
+
+from config import (
+    WRITE_BATCH_SIZE,
+    WRITE_CHECKPOINT_SECONDS,
+    WRITE_CONCURRENCY,
+    WRITE_FLUSH_SECONDS,
+)
+from metrics import METRICS
+from processors.common import MetaKey, UnitMeta
+
+logger = logging.getLogger(__name__)
+
+# an object key, or a meta key and the key it is set for
+Entry = Tuple[Optional[MetaKey], str]
+
+# a doc's manifest maps its entries to digests of their values
+Manifest = Dict[Entry, str]
+
+
+class UnitWriteError(Exception):
+    def __init__(self, failed: Dict[str, Exception]):
+        self.failed = failed
+        super().__init__(
+            f"{len(failed)} writes failed: "
+            + ", ".join(f"{key} ({e})" for key, e in failed.items())
+        )
+
+
+@dataclass
+class WriteCounts:
+    written: int = 0
+    skipped: int = 0  # unchanged since the doc was last processed
+    deleted: int = 0
+    failed: int = 0
+
+
+def _refers_to(val: Any, keys: Dict[str, Exception]) -> bool:
+    return isinstance(val, str) and val in keys
+
+
+def _digest(val: Any) -> str:
+    if isinstance(val, Payload):
+        data = val.data + str(val.type).encode("utf-8")
+    else:
+        data = repr(val).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _parse_meta_key(name: Optional[str]) -> Optional[MetaKey]:
+    if name is None:
+        return None
+    try:
+        return Meta(name)
+    except ValueError:
+        return UnitMeta(name)
+
+
+def _dump_manifest(manifest: Manifest) -> str:
+    return json.dumps(
+        [
+            [meta_key, key, digest]
+            for (meta_key, key), digest in manifest.items()
+        ]
+    )
+
+
+def _load_manifest(manifest: str) -> Manifest:
+    return {
+        (_parse_meta_key(meta_key), key): digest
+        for meta_key, key, digest in json.loads(manifest)
+    }
+
+
+class UnitWriter:
+    """Write-behind buffer for the storage and meta writes of a doc.
+
+    Instead of one blocking round trip per write, objects and
+    meta updates are buffered and flushed in batches, either
+    every `batch_size` objects, once the oldest buffered write
+    has waited `flush_seconds`, or when `flush()` is called.
+    Writes that are due are flushed by a background thread
+    while no more come, e.g., while the next page of a doc is
+    being processed. A flush uploads the buffered objects
+    concurrently, then writes the meta updates of the batch
+    concurrently.
+
+    Meta updates of a batch are written after its objects
+    are stored, and updates referring to an object that
+    failed to store are dropped, so meta never points to a
+    missing object. Failed writes are raised together as a
+    `UnitWriteError` once the rest of the batch is done, or,
+    if flushed in the background, by the next write or flush.
+
+    If `doc_key` is set, the writes of the doc are checked
+    against the manifest saved by its last `commit()`. Objects
+    and meta entries that are unchanged are not written again,
+    and those the doc no longer has are deleted on commit.
+    While a doc is being written, its manifest is also saved
+    every `checkpoint_seconds`, as of the next flush, so that
+    what has been written is known even if it is not committed.
+    """
+
+    def __init__(
+        self,
+        storage: StorageClient,
+        meta: AbstractMetaMapping,
+        batch_size: int = WRITE_BATCH_SIZE,
+        concurrency: int = WRITE_CONCURRENCY,
+        doc_key: Optional[str] = None,
+        flush_seconds: Optional[float] = WRITE_FLUSH_SECONDS,
+        checkpoint_seconds: float = WRITE_CHECKPOINT_SECONDS,
+    ):
+        self._storage = storage
+        self._meta = meta
+        self._batch_size = batch_size
+        self._flush_seconds = flush_seconds
+        self._checkpoint_seconds = checkpoint_seconds
+        self._buffered_since: Optional[float] = None
+        self._checkpointed_at = time.monotonic()
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="unit-writer"
+        )
+        self._objects: Dict[str, Payload] = {}
+        # later updates of the same meta key override earlier ones
+        self._metas: Dict[Tuple[MetaKey, str], Any] = {}
+        # failed writes of background flushes, to be raised
+        self._failed: Dict[str, Exception] = {}
+
+        self._doc_key = doc_key
+        # digests of what is stored, as far as the writer knows
+        self._stored: Manifest = {}
+        if doc_key is not None:
+            self._stored = self._load_manifest(doc_key)
+        self._prev_manifest = dict(self._stored)
+        # digests of what the doc is written as
+        self.manifest: Manifest = {}
+        self.counts = WriteCounts()
+
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        if flush_seconds:  # otherwise, every write is flushed
+            self._flusher = threading.Thread(
+                target=copy_context().run,  # for metrics labels
+                args=(self._flush_when_due,),
+                name="unit-flusher",
+                daemon=True,
+            )
+            self._flusher.start()
+
+    def _load_manifest(self, doc_key: str) -> Manifest:
+        try:
+            manifest = self._meta[UnitMeta.MANIFEST].get(doc_key)
+            return _load_manifest(manifest) if manifest else {}
+        except Exception as e:
+            logger.warning(f"Failed to load manifest of {doc_key}: {e}")
+            return {}
+
+    def _is_unchanged(self, entry: Entry, val: Any) -> bool:
+        if self._doc_key is None:
+            return False
+        digest = _digest(val)
+        self.manifest[entry] = digest
+        if self._stored.get(entry) == digest:
+            self.counts.skipped += 1
+            return True
+        return False
+
+    def store(self, key: str, payload: Payload) -> None:
+        with self._lock:
+            if self._is_unchanged((None, key), payload):
+                self._objects.pop(key, None)
+                return
+            self._objects[key] = payload
+            self._buffered()
+
+    def set_meta(self, meta_key: MetaKey, key: str, val: Any) -> None:
+        with self._lock:
+            if self._is_unchanged((meta_key, key), val):
+                self._metas.pop((meta_key, key), None)
+                return
+            self._metas[(meta_key, key)] = val
+            self._buffered()
+
+    def _is_due(self, now: float) -> bool:
+        return (
+            self._buffered_since is not None
+            and self._flush_seconds is not None
+            and now - self._buffered_since >= self._flush_seconds
+        )
+
+    def _buffered(self) -> None:
+        now = time.monotonic()
+        if self._buffered_since is None:
+            self._buffered_since = now
+        if (
+            len(self._objects) >= self._batch_size
+            or self._failed  # for them to be raised
+            or self._is_due(now)
+        ):
+            self._flush_due(now)
+
+    def _flush_when_due(self) -> None:
+        assert self._flush_seconds
+        timeout = self._flush_seconds
+        while not self._closed.wait(timeout):
+            with self._lock:
+                now = time.monotonic()
+                if self._is_due(now):
+                    try:
+                        self._flush_due(now)
+                    except UnitWriteError as e:
+                        self._failed = e.failed
+                timeout = self._flush_seconds
+                if self._buffered_since is not None:
+                    timeout += self._buffered_since - now
+
+    def _flush_due(self, now: float) -> None:
+        try:
+            self._flush()
+        finally:
+            if (
+                self._doc_key is not None
+                and now - self._checkpointed_at >= self._checkpoint_seconds
+            ):
+                self._checkpointed_at = now
+                with METRICS.timer("manifest"):
+                    self._save_manifest(self._doc_key, prune=False)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        objects, self._objects = self._objects, {}
+        metas, self._metas = self._metas, {}
+        self._buffered_since = None
+        failed_before, self._failed = self._failed, {}
+
+        with METRICS.timer("upload"):
+            failed = self._run(
+                (key, self._store, (key, payload))
+                for key, payload in objects.items()
+            )
+        written: List[Entry] = [
+            (None, key) for key in objects if key not in failed
+        ]
+        meta_writes = {
+            (meta_key, key): val
+            for (meta_key, key), val in metas.items()
+            if key not in failed and not _refers_to(val, failed)
+        }
+        with METRICS.timer("meta_write"):
+            meta_failed = self._run(
+                (key, self._set_meta, (meta_key, key, val))
+                for (meta_key, key), val in meta_writes.items()
+            )
+        written += [
+            entry for entry in meta_writes if entry[1] not in meta_failed
+        ]
+        failed |= meta_failed
+
+        if self._doc_key is not None:
+            for entry in written:
+                self._stored[entry] = self.manifest[entry]
+        self.counts.written += len(written)
+        self.counts.failed += len(objects) + len(metas) - len(written)
+        if failed := failed_before | failed:
+            raise UnitWriteError(failed)
+
+    def commit(self, prune: bool = True) -> None:
+        """Flush, then save the manifest of the doc.
+
+        If `prune`, that is, if every unit of the doc has been
+        written, objects and meta entries of the last manifest
+        that the doc no longer has are deleted first. Otherwise,
+        they are kept in the manifest, to be deleted next time.
+        """
+        with self._lock:
+            try:
+                self._flush()
+            except UnitWriteError:
+                prune = False
+                raise
+            finally:
+                if self._doc_key is not None:
+                    with METRICS.timer("manifest"):
+                        self._save_manifest(self._doc_key, prune)
+
+    def _save_manifest(self, doc_key: str, prune: bool) -> None:
+        # entries that failed to write are as they were stored
+        manifest = {
+            entry: self._stored[entry]
+            for entry in self.manifest
+            if entry in self._stored
+        }
+        orphans = [
+            entry for entry in self._prev_manifest if entry not in manifest
+        ]
+        if prune:
+            failed = self._run(
+                (key, self._delete, (meta_key, key))
+                for meta_key, key in orphans
+            )
+            self.counts.deleted += len(orphans) - len(failed)
+            orphans = [entry for entry in orphans if entry[1] in failed]
+        for entry in orphans:
+            manifest[entry] = self._prev_manifest[entry]
+
+        self._meta[UnitMeta.MANIFEST][doc_key] = _dump_manifest(manifest)
+
+    def _run(self, writes) -> Dict[str, Exception]:
+        futures = [
+            (key, self._executor.submit(fn, *args)) for key, fn, args in writes
+        ]
+        failed: Dict[str, Exception] = {}
+        for key, future in futures:
+            if exc := future.exception():
+                logger.warning(f"Failed to write {key}. Error: {exc}")
+                failed[key] = exc  # type: ignore
+        return failed
+
+    def _store(self, key: str, payload: Payload) -> None:
+        self._storage[key] = payload
+
+    def _set_meta(self, meta_key: MetaKey, key: str, val: Any) -> None:
+        self._meta[meta_key][key] = val
+
+    def _delete(self, meta_key: Optional[MetaKey], key: str) -> None:
+        if meta_key is None:
+            del self._storage[key]
+        else:
+            del self._meta[meta_key][key]
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()